@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Ancestor computation of build_taxid_data on a deep synthetic tree.
+
+Compares the single top-down traversal of `taxidtool.build_lineages` with
+the per-taxid walk to the root that build_taxid_data used to do.
+
+    python benchmarks/bench_build_lineages.py --taxids 200000 --depth 200
+
+"""
+import argparse
+import time
+
+from yax.shared.utilities.taxidtool import NodeRecord, build_lineages
+
+
+def make_nodes(num_taxids, depth):
+    # A spine of `depth` nodes with the remaining taxids hanging off of it
+    # round robin, so most lineages are close to `depth` long.
+    nodes = {'1': NodeRecord('1', '1', 'no rank')}
+    for taxid in range(2, num_taxids + 1):
+        if taxid <= depth:
+            parent_taxid = taxid - 1
+        else:
+            parent_taxid = depth - taxid % (depth // 2)
+        nodes[str(taxid)] = NodeRecord(str(taxid), str(parent_taxid),
+                                       'no rank')
+    children = {taxid: [] for taxid in nodes}
+    for record in nodes.values():
+        if record.taxid != '1':
+            children[record.parent_taxid].append(record.taxid)
+    return nodes, children
+
+
+def walk_to_root(nodes):
+    lineages = {}
+    for taxid in nodes:
+        parents = []
+        current_taxid = taxid
+        while nodes[current_taxid].taxid != \
+                nodes[current_taxid].parent_taxid:
+            parents.insert(0, nodes[current_taxid].parent_taxid)
+            current_taxid = nodes[current_taxid].parent_taxid
+        lineages[taxid] = parents
+    return lineages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--taxids', type=int, default=100000)
+    parser.add_argument('--depth', type=int, default=200)
+    args = parser.parse_args()
+
+    nodes, children = make_nodes(args.taxids, args.depth)
+
+    start = time.perf_counter()
+    expected = walk_to_root(nodes)
+    walk_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    observed = build_lineages(nodes, children)
+    traversal_time = time.perf_counter() - start
+
+    assert observed == expected
+    print("walk to root        %8.2f s" % walk_time)
+    print("top-down traversal  %8.2f s" % traversal_time)
+    print("speed-up            %8.1fx" % (walk_time / traversal_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Peak RSS and wall time of the NCBI dump parsers in taxidtool.
+
+Writes synthetic nodes.dmp, names.dmp and gi_taxid_nucl.dmp files with
+`--lines` records each and runs every case in a fresh interpreter, so the
+reported peak RSS belongs to that case alone.
+
+    python benchmarks/bench_dmp_parsers.py --lines 5000000
+
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from yax.shared.utilities import taxidtool
+
+
+def _readlines_baseline(fp):
+    # How the parsers used to read: the whole file as a list of lines.
+    with open(fp, mode='r') as fh:
+        return len(fh.readlines())
+
+
+CASES = {
+    'nodes-readlines': lambda d: _readlines_baseline(
+        os.path.join(d, 'nodes.dmp')),
+    'nodes-iter': lambda d: sum(1 for _ in taxidtool.iter_nodes_dmp(
+        os.path.join(d, 'nodes.dmp'))),
+    'nodes-parse': lambda d: len(taxidtool.parse_nodes_dmp(
+        os.path.join(d, 'nodes.dmp'))),
+    'names-readlines': lambda d: _readlines_baseline(
+        os.path.join(d, 'names.dmp')),
+    'names-iter': lambda d: sum(1 for _ in taxidtool.iter_names_dmp(
+        os.path.join(d, 'names.dmp'))),
+    'names-parse': lambda d: len(taxidtool.parse_names_dmp(
+        os.path.join(d, 'names.dmp'))),
+    'gi-readlines': lambda d: _readlines_baseline(
+        os.path.join(d, 'gi_taxid_nucl.dmp')),
+    'gi-iter': lambda d: sum(1 for _ in taxidtool.iter_gi_taxid_dmp(
+        os.path.join(d, 'gi_taxid_nucl.dmp'))),
+    'gi-parse': lambda d: len(taxidtool.parse_gi_taxid_dmp(
+        os.path.join(d, 'gi_taxid_nucl.dmp'))),
+}
+
+
+def write_dumps(dir_, num_lines):
+    with open(os.path.join(dir_, 'nodes.dmp'), mode='w') as fh:
+        fh.write("1\t|\t1\t|\tno rank\t|\t\t|\n")
+        for taxid in range(2, num_lines + 1):
+            fh.write("%d\t|\t%d\t|\tspecies\t|\t\t|\t0\t|\n"
+                     % (taxid, taxid // 2))
+    with open(os.path.join(dir_, 'names.dmp'), mode='w') as fh:
+        for taxid in range(1, num_lines + 1):
+            fh.write("%d\t|\tNode%d\t|\t\t|\tscientific name\t|\n"
+                     % (taxid, taxid))
+    with open(os.path.join(dir_, 'gi_taxid_nucl.dmp'), mode='w') as fh:
+        for gi in range(num_lines):
+            fh.write("%d\t%d\n" % (gi, gi % num_lines + 1))
+
+
+def run_case(name, dir_):
+    start = time.perf_counter()
+    count = CASES[name](dir_)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("%-16s %10d records %8.2f s %10.1f MiB peak RSS"
+          % (name, count, elapsed, peak_rss / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--lines', type=int, default=2000000)
+    parser.add_argument('--case', choices=sorted(CASES))
+    parser.add_argument('--dir')
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case, args.dir)
+        return
+
+    with tempfile.TemporaryDirectory() as dir_:
+        write_dumps(dir_, args.lines)
+        for name in CASES:
+            subprocess.check_call([sys.executable, __file__, '--case', name,
+                                   '--dir', dir_])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Peak RSS and wall time of building the gi index of a Taxonomy.
+
+Writes synthetic dumps with `--gis` gis spread over `--taxids` taxids and
+builds `Taxonomy.sorted_gis` in a fresh interpreter per case, so the reported
+peak RSS growth belongs to that case alone. The `keysort` case is the
+previous implementation, an argsort through a Python key function.
+
+    python benchmarks/bench_gi_index.py --gis 5000000
+
+"""
+import argparse
+import array
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from yax.shared.utilities.taxonomy import Taxonomy
+
+
+def _keysort_baseline(taxonomy):
+    gi_taxa = array.array('i')
+    for index in range(len(taxonomy.taxids)):
+        gi_taxa.extend([index] * (taxonomy.gi_offsets[index + 1] -
+                                  taxonomy.gi_offsets[index]))
+    order = sorted(range(len(taxonomy.gis)), key=taxonomy.gis.__getitem__)
+    taxonomy.sorted_gis = array.array('q', (taxonomy.gis[i] for i in order))
+    taxonomy.sorted_gi_taxa = array.array('i', (gi_taxa[i] for i in order))
+
+
+CASES = {
+    'keysort': _keysort_baseline,
+    'build_gi_index': Taxonomy.build_gi_index,
+}
+
+
+def write_dumps(dir_, num_taxids, num_gis):
+    with open(os.path.join(dir_, 'nodes.dmp'), mode='w') as fh:
+        fh.write("1\t|\t1\t|\tno rank\t|\t\t|\n")
+        for taxid in range(2, num_taxids + 1):
+            fh.write("%d\t|\t%d\t|\tspecies\t|\t\t|\n" % (taxid, taxid // 2))
+    with open(os.path.join(dir_, 'names.dmp'), mode='w') as fh:
+        for taxid in range(1, num_taxids + 1):
+            fh.write("%d\t|\tNode%d\t|\t\t|\tscientific name\t|\n"
+                     % (taxid, taxid))
+    with open(os.path.join(dir_, 'gi_taxid_nucl.dmp'), mode='w') as fh:
+        for gi in range(num_gis):
+            fh.write("%d\t%d\n" % (gi, gi % num_taxids + 1))
+
+
+def _peak_rss():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(name, dir_):
+    taxonomy = Taxonomy.from_dmp(os.path.join(dir_, 'nodes.dmp'),
+                                 os.path.join(dir_, 'names.dmp'),
+                                 os.path.join(dir_, 'gi_taxid_nucl.dmp'))
+    before = _peak_rss()
+    start = time.perf_counter()
+    CASES[name](taxonomy)
+    elapsed = time.perf_counter() - start
+    print("%-16s %10d gis %8.2f s %10.1f MiB peak RSS growth"
+          % (name, len(taxonomy.sorted_gis), elapsed, _peak_rss() - before))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--gis', type=int, default=2000000)
+    parser.add_argument('--taxids', type=int, default=100000)
+    parser.add_argument('--case', choices=sorted(CASES))
+    parser.add_argument('--dir')
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case, args.dir)
+        return
+
+    with tempfile.TemporaryDirectory() as dir_:
+        write_dumps(dir_, args.taxids, args.gis)
+        for name in CASES:
+            subprocess.check_call([sys.executable, __file__, '--case', name,
+                                   '--dir', dir_])
+
+
+if __name__ == '__main__':
+    main()
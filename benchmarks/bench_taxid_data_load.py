@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Cold-load time of a TaxIDData artifact, TSV versus binary format.
+
+Builds a synthetic taxonomy with `--taxids` nodes and `--gis` gis per node,
+writes it in both formats and times reading each one back.
+
+    python benchmarks/bench_taxid_data_load.py --taxids 1000000
+
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from yax.shared.utilities import taxidtool
+from yax.shared.utilities.taxonomy import Taxonomy
+
+
+def write_dumps(dir_, num_taxids, gis_per_taxid):
+    with open(os.path.join(dir_, 'nodes.dmp'), mode='w') as fh:
+        fh.write("1\t|\t1\t|\tno rank\t|\t\t|\n")
+        for taxid in range(2, num_taxids + 1):
+            fh.write("%d\t|\t%d\t|\tspecies\t|\t\t|\n" % (taxid, taxid // 2))
+    with open(os.path.join(dir_, 'names.dmp'), mode='w') as fh:
+        for taxid in range(1, num_taxids + 1):
+            fh.write("%d\t|\tNode%d\t|\t\t|\tscientific name\t|\n"
+                     % (taxid, taxid))
+    with open(os.path.join(dir_, 'gi_taxid_nucl.dmp'), mode='w') as fh:
+        for gi in range(num_taxids * gis_per_taxid):
+            fh.write("%d\t%d\n" % (gi, gi % num_taxids + 1))
+
+
+def timed(label, function):
+    start = time.perf_counter()
+    result = function()
+    print("%-24s %8.3f s" % (label, time.perf_counter() - start))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--taxids', type=int, default=200000)
+    parser.add_argument('--gis', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dir_:
+        write_dumps(dir_, args.taxids, args.gis)
+        taxonomy = timed("build from dmp", lambda: Taxonomy.from_dmp(
+            os.path.join(dir_, 'nodes.dmp'), os.path.join(dir_, 'names.dmp'),
+            os.path.join(dir_, 'gi_taxid_nucl.dmp')))
+
+        tsv_fp = os.path.join(dir_, 'tax_id_data.yax')
+        bin_fp = os.path.join(dir_, 'tax_id_data.bin')
+        timed("write TSV", lambda: taxidtool.write_taxid_data(taxonomy,
+                                                              tsv_fp))
+        timed("write binary", lambda: taxonomy.write(bin_fp))
+
+        timed("load TSV", lambda: taxidtool.parse_taxid_data(tsv_fp))
+        loaded = timed("load binary", lambda: Taxonomy.load(bin_fp))
+        timed("first lookup (binary)", lambda: loaded[str(args.taxids)])
+
+
+if __name__ == '__main__':
+    main()
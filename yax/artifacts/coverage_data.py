@@ -10,16 +10,17 @@ class CoverageData(Artifact):
         Gets a list of already completed coverage files
         """
         completed_files = []
-        with open(os.path.join(self.data_dir, "/.files"), 'r') as files:
+        files_fp = os.path.join(self.data_dir, ".files")
+        if not os.path.isfile(files_fp):
+            return completed_files
+        with open(files_fp, 'r') as files:
             for file in files.readlines():
-                completed_files.append(file)
-            files.close()
+                completed_files.append(file.rstrip('\n'))
         return completed_files
 
     def append_completed_file(self, file):
-        with open(os.path.join(self.data_dir, "/.files", 'a')) as files:
+        with open(os.path.join(self.data_dir, ".files"), 'a') as files:
             files.write(file + '\n')
-            files.close()
 
     def build_coverage_data(self):
         """
@@ -1,16 +1,81 @@
 from yax.state.type import Artifact
+from yax.shared.utilities.file_chunks import iter_chunk_lines
+import os
 
 
 class IdentifiedTaxa(Artifact):
     def __init__(self, completed):
-        self.identified_taxa_file = None
+        self.identified_taxa_file = os.path.join(self.data_dir,
+                                                 "identified_taxa.txt")
 
-        if completed:
-            self.identified_taxa_file = None
-            self.read_identified_taxa()
+    def read_identified_taxa(self, start=0, end=None):
+        """Lazily reads the tax ids each read hit.
 
-    def read_identified_taxa():
-        pass
+        See `iter_identified_taxa`.
+        """
+        return iter_identified_taxa(self.identified_taxa_file, start, end)
 
     def __complete__(self):
         pass
+
+
+def iter_identified_taxa(identified_taxa_fp, start=0, end=None):
+    """Streams reads and the tax ids they hit out of mg_wrapper output.
+
+    Only one line of the file is held at a time. Reads which did not hit any
+    tax id are skipped.
+
+    Parameters
+    ----------
+    identified_taxa_fp : str
+        location of the mg_wrapper output
+    start : int, optional
+        offset of the first line to read
+    end : int, optional
+        offset just past the last line to read, defaults to the end of file
+
+    Yields
+    ------
+    (str, list)
+        read_id and the distinct tax_ids it hit, in order of edit distance
+
+    See Also
+    --------
+    parse_identified_taxa_line
+
+    """
+    if end is None:
+        end = os.path.getsize(identified_taxa_fp)
+    for line in iter_chunk_lines(identified_taxa_fp, start, end):
+        read_id, tax_ids = parse_identified_taxa_line(line)
+        if tax_ids:
+            yield read_id, tax_ids
+
+
+def parse_identified_taxa_line(line):
+    """Splits a line of mg_wrapper output into a read_id and its hits.
+
+    Lines look like ``read_id:tax_ids:tax_ids...`` where every ``:`` separated
+    field lists the comma separated tax ids hit at one edit distance, best
+    first.
+
+    Parameters
+    ----------
+    line : str
+        a line of mg_wrapper output
+
+    Returns
+    -------
+    (str, list)
+        read_id and the distinct tax_ids it hit, in order of edit distance
+
+    """
+    this_line = line.rstrip().split(":")
+    these_hits = []
+    seen = set()
+    for mm_distance in this_line[1:]:
+        for tax_id_hit in mm_distance.split(","):
+            if tax_id_hit and tax_id_hit not in seen:
+                seen.add(tax_id_hit)
+                these_hits.append(tax_id_hit)
+    return this_line[0], these_hits
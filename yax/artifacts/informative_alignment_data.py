@@ -1,5 +1,5 @@
 from yax.state.type.artifact import Artifact
-from yax.shared.utilities import taxidtool
+from yax.shared.utilities import fastatool, taxidtool
 
 
 class InformativeAlignmentData(Artifact):
@@ -9,13 +9,25 @@ class InformativeAlignmentData(Artifact):
         self.gis_to_taxids = None
         self.sequences_input_fp = None
         self.truncation_level = None
+        self.workers = 1
+        self.compression = None
 
         if completed:
             pass
 
     def __complete__(self):
-        taxidtool.output_tree(self.taxid_data, self.inclusion_tree,
-                              self.data_dir)
-        taxidtool.output_sequences(self.taxid_data, self.inclusion_tree,
-                                   self.gis_to_taxids, self.sequences_input_fp,
-                                   self.data_dir, self.truncation_level)
+        sequences_fp = self.sequences_input_fp
+        fasta_index = fastatool.load_fasta_index(
+            sequences_fp, sequences_fp + fastatool.INDEX_SUFFIX)
+        if fasta_index is None and self.workers <= 1:
+            # A single worker reads the whole file either way, so index it
+            # for later runs and read the selected records through the index.
+            # With more workers the file is filtered in parallel instead; its
+            # index can be built beforehand with `fastatool.open_fasta_index`
+            fasta_index = fastatool.open_fasta_index(sequences_fp)
+        taxid_counts = taxidtool.output_sequences(
+            self.tax_id_data, self.inclusion_tree, self.gis_to_taxids,
+            sequences_fp, self.data_dir, self.truncation_level,
+            fasta_index, self.workers, self.compression)
+        taxidtool.output_tree(self.tax_id_data, self.inclusion_tree,
+                              self.data_dir, taxid_counts)
@@ -1,16 +1,73 @@
 from yax.state.type.artifact import Artifact
 from yax.shared.utilities import taxidtool
+from yax.shared.utilities.taxonomy import Taxonomy
 import os
 
 
+# Taxonomies loaded by TaxIDData artifacts in this process, by the location
+# of the file they were loaded from, along with the size and mtime of the file
+# when it was loaded. Reloading a changed file replaces its entry.
+_loaded_tax_id_data = {}
+
+
 class TaxIDData(Artifact):
+    # Whether artifacts of the same file share one loaded taxonomy
+    share_loaded = True
+
     def __init__(self, completed):
         self.tax_id_data = None
-        self.tax_id_data_fp = os.path.join(self.data_dir, "tax_id_data.yax")
+        self.tax_id_data_fp = os.path.join(self.data_dir, "tax_id_data.bin")
+        # Artifacts completed before the binary format existed only have the
+        # TSV representation written by taxidtool.write_taxid_data
+        self.tsv_tax_id_data_fp = os.path.join(self.data_dir,
+                                               "tax_id_data.yax")
+
+    @property
+    def tax_id_data(self):
+        """The artifact's taxonomy.
+
+        A completed artifact's taxonomy is only loaded once this is first
+        used, so declaring artifacts to check on them stays cheap.
+        """
+        if self._tax_id_data is None and self.is_complete:
+            self._tax_id_data = self.load_tax_id_data()
+        return self._tax_id_data
+
+    @tax_id_data.setter
+    def tax_id_data(self, value):
+        self._tax_id_data = value
+
+    def load_tax_id_data(self):
+        """Loads the taxonomy of this completed artifact.
+
+        With `share_loaded`, a taxonomy already loaded from the same,
+        unchanged, file is reused.
+        """
+        if os.path.isfile(self.tax_id_data_fp):
+            input_fp, load = self.tax_id_data_fp, Taxonomy.load
+        else:
+            input_fp, load = self.tsv_tax_id_data_fp, self.import_tax_id_data
+        if not self.share_loaded:
+            return load(input_fp)
+
+        stat = os.stat(input_fp)
+        key = os.path.realpath(input_fp)
+        version = (stat.st_size, stat.st_mtime_ns)
+        loaded = _loaded_tax_id_data.get(key)
+        if loaded is None or loaded[0] != version:
+            loaded = _loaded_tax_id_data[key] = (version, load(input_fp))
+        return loaded[1]
+
+    def import_tax_id_data(self, input_fp):
+        """Reads a TSV taxid_data file written by `export_tax_id_data`."""
+        return Taxonomy.from_tsv(input_fp, workers=os.cpu_count() or 1)
 
-        if completed:
-            self.tax_id_data = taxidtool.\
-                parse_taxid_data(self.tax_id_data_fp)
+    def export_tax_id_data(self, output_fp):
+        """Writes the taxonomy as a TSV taxid_data file."""
+        taxidtool.write_taxid_data(self.tax_id_data, output_fp)
 
     def __complete__(self):
-        taxidtool.write_taxid_data(self.tax_id_data, self.tax_id_data_fp)
+        if not isinstance(self.tax_id_data, Taxonomy):
+            self.tax_id_data = Taxonomy.from_taxid_data(self.tax_id_data)
+        self.tax_id_data.build_indexes()
+        self.tax_id_data.write(self.tax_id_data_fp)
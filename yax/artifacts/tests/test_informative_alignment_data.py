@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from yax.artifacts.informative_alignment_data import InformativeAlignmentData
+from yax.shared.utilities import fastatool, taxidtool
+
+
+class TestInformativeAlignmentData(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.temp_dir = self._temp_dir.name
+        self.sequences_fp = os.path.join(self.temp_dir, 'sequences.fasta')
+        with open(self.sequences_fp, mode='w') as fh:
+            fh.write(">ACCESSION GI:20 Node2\nACGT\n")
+        self.index_fp = self.sequences_fp + fastatool.INDEX_SUFFIX
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def complete(self, workers):
+        data_dir = os.path.join(self.temp_dir, 'data_%d' % workers)
+        os.makedirs(data_dir)
+        artifact = InformativeAlignmentData.declare(data_dir, 'module')
+        artifact.sequences_input_fp = self.sequences_fp
+        artifact.workers = workers
+        with mock.patch.object(taxidtool, 'output_sequences') as output, \
+                mock.patch.object(taxidtool, 'output_tree'):
+            artifact.__complete__()
+        return output.call_args[0][6]
+
+    def test_parallel_scan_without_index(self):
+        self.assertIsNone(self.complete(workers=4))
+        self.assertFalse(os.path.exists(self.index_fp))
+
+    def test_index_built_for_single_worker(self):
+        self.assertIsNotNone(self.complete(workers=1))
+        self.assertTrue(os.path.isfile(self.index_fp))
+
+    def test_current_index_used(self):
+        fastatool.open_fasta_index(self.sequences_fp)
+        self.assertIsNotNone(self.complete(workers=4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from yax.artifacts import tax_id_data as tax_id_data_module
+from yax.artifacts.tax_id_data import TaxIDData
+from yax.shared.utilities.taxidtool import TaxIDDataRecord
+from yax.shared.utilities.taxonomy import Taxonomy
+
+
+class TestTaxIDData(unittest.TestCase):
+    def setUp(self):
+        self._data_dir = tempfile.TemporaryDirectory()
+        self.data_dir = self._data_dir.name
+        self.taxid_data = {
+            '1': TaxIDDataRecord('1', 'Node1', [], ['2'], [], 'no rank'),
+            '2': TaxIDDataRecord('2', 'Node2', ['20'], [], ['1'], 'species')}
+
+    def tearDown(self):
+        self._data_dir.cleanup()
+
+    def complete_artifact(self):
+        artifact = TaxIDData.declare(self.data_dir, 'builder')
+        artifact.tax_id_data = self.taxid_data
+        artifact.complete()
+
+    def test_loaded_lazily(self):
+        self.complete_artifact()
+        with mock.patch.object(Taxonomy, 'load',
+                               wraps=Taxonomy.load) as load:
+            artifact = TaxIDData.declare(self.data_dir, 'module')
+            self.assertTrue(artifact.is_complete)
+            load.assert_not_called()
+
+            self.assertEqual(dict(artifact.tax_id_data), self.taxid_data)
+            self.assertEqual(load.call_count, 1)
+
+    def test_shared_cache(self):
+        self.complete_artifact()
+        first = TaxIDData.declare(self.data_dir, 'module').tax_id_data
+        second = TaxIDData.declare(self.data_dir, 'module').tax_id_data
+        self.assertIs(first, second)
+
+        with mock.patch.object(TaxIDData, 'share_loaded', False):
+            third = TaxIDData.declare(self.data_dir, 'module').tax_id_data
+        self.assertIsNot(first, third)
+        self.assertEqual(dict(third), dict(first))
+
+    def test_shared_cache_replaces_changed(self):
+        self.complete_artifact()
+        with mock.patch.dict(tax_id_data_module._loaded_tax_id_data,
+                             clear=True):
+            artifact = TaxIDData.declare(self.data_dir, 'module')
+            first = artifact.tax_id_data
+            stat = os.stat(artifact.tax_id_data_fp)
+            os.utime(artifact.tax_id_data_fp,
+                     ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+            second = TaxIDData.declare(self.data_dir, 'module').tax_id_data
+            self.assertIsNot(first, second)
+            self.assertEqual(dict(second), dict(first))
+            # The taxonomy loaded before the change is no longer held
+            self.assertEqual(
+                list(tax_id_data_module._loaded_tax_id_data),
+                [os.path.realpath(artifact.tax_id_data_fp)])
+
+    def test_incomplete(self):
+        artifact = TaxIDData.declare(self.data_dir, 'module')
+        self.assertIsNone(artifact.tax_id_data)
+        self.assertFalse(os.path.exists(artifact.tax_id_data_fp))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,59 +4,230 @@ reduced set of gi references output by the aggregation module and
 generating a .sam file with the alignment data
 """
 
+import concurrent.futures
+import contextlib
 import os
-from yax.shared.utilities.bowtie2_utils import build_index, call_bt2_align
+import shutil
+import threading
+from yax.shared.utilities.bowtie2_utils import (build_index, bt2_threads,
+                                                cached_index, call_bt2_align)
+from yax.shared.utilities.file_chunks import iter_chunk_lines, split_file
 from yax.artifacts.coverage_data import CoverageData
 from yax.artifacts.reads import Reads
 from yax.artifacts.gi_references import GiReferences
-from yax.state.type import Str
+from yax.state.type import Int, Str
 
+# With several processes the reads of the samples are split into about this
+# many parts per process, so a process which is done with a small sample
+# takes over parts of the larger ones instead of leaving its cores idle
+PARTS_PER_PROCESS = 4
 
-def main(working_dir, output, reads: Reads, gi_references: GiReferences,
-         bowtie_options: Str) -> CoverageData:
+
+def main(working_dir, output, details, reads: Reads,
+         gi_references: GiReferences, bowtie_options: Str, cores: Int = 0,
+         index_shards: Int = 1, cache_dir=None) -> CoverageData:
     print("Running alignment.")
-    run_alignment(gi_references, reads, output, working_dir, bowtie_options)
+    coverage_data, = output
+    run_alignment(gi_references, reads, coverage_data, working_dir,
+                  bowtie_options, cache_dir, cores, index_shards)
+    return coverage_data
 
 
 def run_alignment(gi_references, reads_fp, output, working_dir,
-                  bowtie_args):
+                  bowtie_args, cache_dir=None, cores=0, index_shards=1):
     """
     :param gi_references: Location of gi references
     :param reads_fp: Location of reads trimmed by ReadPrep
     :param output: Artifact to fill out with sam file alignments
     :param working_dir: working directory
     :param bowtie_args: Optional bowtie parameters
+    :param cache_dir: Optional cache directory to keep bowtie2 indexes in
+        across samples and runs
+    :param cores: Number of cores to spread the bowtie2 processes of the
+        samples over, see `split_cores`; 0 aligns one sample at a time, with
+        the threads `bowtie_args` asks for
+    :param index_shards: Number of parts to split the references of a sample
+        into, indexed in parallel and aligned to separately, see
+        `bowtie2_utils.build_index`
     """
 
     # Get the list of already completed coverage files
-    completed_files = output.get_completed_coverage_files().sort()
+    completed_files = set(output.get_completed_coverage_files())
 
     num_samples = get_num_samples(reads_fp)
-    for sample_num in range(num_samples):
+    pending_samples = [sample_num for sample_num in range(num_samples)
+                       if coverage_file_name(sample_num)
+                       not in completed_files]
+
+    # Split the reads of the pending samples into a file per sample, kept
+    # with the artifact so an interrupted run does not have to split again
+    samples_dir = os.path.join(output.data_dir, "samples")
+    demultiplex_reads(reads_fp, samples_dir, pending_samples)
+
+    if cores:
+        processes, threads = split_cores(cores, len(pending_samples),
+                                         bt2_threads(bowtie_args))
+    else:
+        processes, threads = 1, None
+
+    # Queue the parts of the largest samples first, so a large sample is not
+    # left to run on its own at the end
+    sizes = {sample_num:
+             os.path.getsize(sample_reads_fp(samples_dir, sample_num))
+             for sample_num in pending_samples}
+    num_parts = split_reads(sizes, processes)
+    parts = []
+    for sample_num in sorted(pending_samples, key=sizes.get, reverse=True):
+        ranges = split_file(sample_reads_fp(samples_dir, sample_num),
+                            num_parts[sample_num], b">") or [(0, 0)]
+        num_parts[sample_num] = len(ranges)
+        parts.extend((sample_num, part, start, end)
+                     for part, (start, end) in enumerate(ranges))
+
+    # Build the indexes of all pending samples before aligning, sharing the
+    # threads of every process between the builds, so that no process sits
+    # waiting on the build of the sample its part belongs to
+    builders = max(1, min(processes, len(pending_samples)))
+    build_threads = max(1, processes * (threads or 1) // builders)
+
+    # Cached indexes are pinned until all samples are aligned, so that
+    # adding one to the cache does not evict another which is still in use
+    pins = contextlib.ExitStack()
 
-        # Check if file has already been completed
-        file = "sample_" + str(sample_num) + "_coverage.sam"
-        if file in completed_files:
-            continue
+    def build_sample_index(sample_num):
+        return build_current_index(sample_num, gi_references, working_dir,
+                                   cache_dir, build_threads, index_shards,
+                                   pins)
 
-        # Get the list of reads that appear in the current sample
-        reads = get_reads_in_sample(sample_num, reads_fp)
+    remaining_parts = dict(num_parts)
+    lock = threading.Lock()
 
-        # Build the index for the current sample
-        index = build_current_index(sample_num, gi_references, working_dir)
+    def align_part(sample_num, part, start, end):
+        index = indexes[sample_num]
+        coverage_fp = os.path.join(output.data_dir,
+                                   coverage_file_name(sample_num))
 
         # Call bowtie2 and create a coverage file for the current sample
-        call_bt2_align(reads, os.path.join(working_dir, index),
-                       os.path.join(output.data_dir, "sample_" +
-                                    str(sample_num) + "_coverage.sam"),
-                       bowtie_args)
-
-        # Add the coverage file to list of compelted files
-        output.append_completed_file("sample_" + str(sample_num) +
-                                     "_coverage.sam")
+        if num_parts[sample_num] == 1:
+            call_bt2_align(sample_reads_fp(samples_dir, sample_num), index,
+                           coverage_fp, bowtie_args, threads)
+        else:
+            part_fp = part_reads_fp(samples_dir, sample_num, part)
+            with open(part_fp, 'w') as part_file:
+                part_file.writelines(iter_chunk_lines(
+                    sample_reads_fp(samples_dir, sample_num), start, end))
+            call_bt2_align(part_fp, index, part_fp + ".sam", bowtie_args,
+                           threads)
+            os.remove(part_fp)
+            # The last part of the sample to finish joins the alignments
+            with lock:
+                remaining_parts[sample_num] -= 1
+                if remaining_parts[sample_num]:
+                    return
+            concatenate_alignments(
+                [part_reads_fp(samples_dir, sample_num, part) + ".sam"
+                 for part in range(num_parts[sample_num])], coverage_fp)
+
+        # Add the coverage file to list of compelted files as soon as it is
+        # done, so an interrupted run keeps every sample that finished
+        with lock:
+            output.append_completed_file(coverage_file_name(sample_num))
+
+    with pins:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=builders) \
+                as executor:
+            indexes = dict(zip(pending_samples, executor.map(
+                build_sample_index, pending_samples)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=processes) \
+                as executor:
+            futures = [executor.submit(align_part, *part) for part in parts]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+    shutil.rmtree(samples_dir, ignore_errors=True)
     # Build the object representation of the coverage data
     output.build_coverage_data()
-    output.complete()
+
+
+def split_cores(cores, num_samples, threads=None):
+    """
+    Splits a budget of cores between concurrent bowtie2 processes
+
+    Given the `threads` of each process, as many processes as fit in the
+    budget are run. Otherwise as many samples as there are cores, up to every
+    sample, are aligned at once, and the cores are shared evenly between
+    their processes as bowtie2 threads.
+
+    :param cores: Number of cores to use
+    :param num_samples: Number of samples to align
+    :param threads: Optional number of threads of each process, e.g. the -p
+        of the bowtie2 options
+    :return: The number of concurrent processes and of threads per process
+    """
+    if threads:
+        threads = max(1, min(threads, cores))
+        return max(1, cores // threads), threads
+    processes = max(1, min(cores, num_samples))
+    return processes, max(1, cores // processes)
+
+
+def split_reads(sizes, processes):
+    """
+    Chooses how many parts to split the reads of each sample into
+
+    With a single process samples are not split. Otherwise the number of
+    parts of a sample is proportional to its size, for `PARTS_PER_PROCESS`
+    parts per process in total.
+
+    :param sizes: The size of the reads of each sample, by sample number
+    :param processes: Number of concurrent bowtie2 processes
+    :return: The number of parts of each sample, by sample number
+    """
+    total = sum(sizes.values())
+    if processes <= 1 or not total:
+        return {sample_num: 1 for sample_num in sizes}
+    return {sample_num: max(1, round(size * processes * PARTS_PER_PROCESS /
+                                     total))
+            for sample_num, size in sizes.items()}
+
+
+def concatenate_alignments(part_fps, output_fp):
+    """
+    Joins the SAM files of the parts of a sample's reads into one, keeping
+    the header of the first part only, and removes the parts
+    """
+    with open(output_fp, 'w') as output:
+        for position, part_fp in enumerate(part_fps):
+            with open(part_fp) as part:
+                for line in part:
+                    if position == 0 or not line.startswith('@'):
+                        output.write(line)
+    for part_fp in part_fps:
+        os.remove(part_fp)
+
+
+def coverage_file_name(sample_num):
+    """
+    Returns the name of the coverage file of a sample
+    """
+    return "sample_" + str(sample_num) + "_coverage.sam"
+
+
+def sample_reads_fp(samples_dir, sample_num):
+    """
+    Returns the location of the reads of a sample split by
+    `demultiplex_reads`
+    """
+    return os.path.join(samples_dir, "sample_" + str(sample_num) + ".fasta")
+
+
+def part_reads_fp(samples_dir, sample_num, part):
+    """
+    Returns the location of a part of the reads of a sample
+    """
+    return os.path.join(samples_dir, "sample_" + str(sample_num) + ".part_" +
+                        str(part) + ".fasta")
 
 
 def get_num_samples(reads_fp):
@@ -68,29 +239,66 @@ def get_num_samples(reads_fp):
         return len(line.split('_')) - 1
 
 
-def get_reads_in_sample(sample_num, reads_fp):
+def demultiplex_reads(reads_fp, samples_dir, sample_nums):
     """
-    Returns a list of all reads in the specified sample
+    Splits the reads file into a FASTA file per sample in a single pass
+
+    Each read header carries, after its id, the '_' separated number of times
+    the read was seen in each sample; a read is written to the file of every
+    sample it was seen in. The files are written to a temporary directory
+    which is renamed to `samples_dir` once complete, so if `samples_dir`
+    exists the reads were already split and nothing is done.
+
+    :param reads_fp: Location of reads trimmed by ReadPrep
+    :param samples_dir: Directory to write the files of the samples to, see
+        `sample_reads_fp`
+    :param sample_nums: The samples to write the reads of
     """
-    reads = []
-    grab_read = False
-    with open(reads_fp) as reads_file:
-        lines = reads_file.readlines()
-    for line in lines:
-        if line.startswith('>'):
-            line_data = line.split('_')
-            if int(line_data[sample_num + 1]) > 0:
-                grab_read = True
-        else:
-            if grab_read:
-                reads.append(line)
-    return ','.join(reads)
+    if os.path.isdir(samples_dir):
+        return
+    temp_dir = samples_dir + ".tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    with contextlib.ExitStack() as stack:
+        sample_files = [(sample_num,
+                         stack.enter_context(
+                             open(sample_reads_fp(temp_dir, sample_num),
+                                  'w')))
+                        for sample_num in sample_nums]
+        targets = []
+        with open(reads_fp) as reads_file:
+            for line in reads_file:
+                if line.startswith('>'):
+                    counts = line.rstrip('\n').split('_')
+                    targets = [sample_file
+                               for sample_num, sample_file in sample_files
+                               if int(counts[sample_num + 1]) > 0]
+                for sample_file in targets:
+                    sample_file.write(line)
 
+    os.rename(temp_dir, samples_dir)
 
-def build_current_index(sample_num, gi_references, working_dir):
+
+def build_current_index(sample_num, gi_references, working_dir,
+                        cache_dir=None, threads=1, shards=1, pins=None):
     """
-    Still has to be finished
+    Builds the bowtie2 index of the references of a sample and returns its
+    location
+
+    With a `cache_dir` the index is taken from the cache, and only built (and
+    added to it) when no earlier sample or run indexed the same references.
+    Otherwise it is built in `working_dir`. The index is built with
+    `threads` threads, split into `shards` indexes. A cached index is
+    pinned on the `pins` ExitStack, see `bowtie2_utils.cached_index`.
+
+    Still has to be finished: the references of the sample are not selected
+    yet
     """
     file = ""
-    build_index(file, os.path.join(working_dir, "index_" + str(sample_num)))
-    return "index_" + str(sample_num)
+    if cache_dir is not None:
+        return cached_index(file, cache_dir, threads=threads, shards=shards,
+                            pins=pins)
+    index = os.path.join(working_dir, "index_" + str(sample_num))
+    build_index(file, index, threads=threads, shards=shards)
+    return index
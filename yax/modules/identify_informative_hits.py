@@ -1,12 +1,29 @@
+import array
+import collections
+import concurrent.futures
+import itertools
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from yax.shared.utilities import taxidtool
-from yax.artifacts import TaxIDData, InformativeAlignmentData, IdentifiedTaxa
-from yax.state.type.parameters import Int, File
+from yax.shared.utilities.file_chunks import split_file
+from yax.shared.utilities.taxonomy import Taxonomy
+from yax.artifacts.tax_id_data import TaxIDData
+from yax.artifacts.informative_alignment_data import InformativeAlignmentData
+from yax.artifacts.identified_taxa import (IdentifiedTaxa,
+                                           iter_identified_taxa,
+                                           parse_identified_taxa_line)
+from yax.state.type import Int, File
 
 
 def main(working_dir, output, details, identified_taxa_art: IdentifiedTaxa,
          tax_id_data_art: TaxIDData, lca_dist: Int, min_hits: Int,
-         min_relative_hits: Int, sequences_input_fp: File) \
-            -> InformativeAlignmentData:
+         min_relative_hits: Int, sequences_input_fp: File,
+         workers: Int = 1) -> InformativeAlignmentData:
     """Produces InformativeAlignmentData artifact type
 
     The InformativeAlignmentData artifact contains a FASTA formatted file and a
@@ -32,6 +49,10 @@ def main(working_dir, output, details, identified_taxa_art: IdentifiedTaxa,
             taxid must exhibit to be determined informative
         sequences_input_fp: File
             FASTA formatted file containing sequence data based on gi
+        workers: Int
+            number of processes to classify reads with; the identified taxa
+            are split into that many shards. Also used to filter the
+            sequences when they have no index
 
     Returns
     -------
@@ -43,16 +64,13 @@ def main(working_dir, output, details, identified_taxa_art: IdentifiedTaxa,
 
     hit_data.sequences_input_fp = sequences_input_fp
     hit_data.truncation_level = "species"
-    hit_data.tax_id_data = taxidtool.parse_taxid_data(tax_id_data_art)
-
-    with open(identified_taxa_art, mode='r') as fh:
-        hit_taxa_lines = fh.readlines()
+    hit_data.tax_id_data = tax_id_data_art.tax_id_data
+    hit_data.workers = workers
 
-    hit_taxa = get_hit_taxa(hit_taxa_lines)
-
-    hit_tax_ids, total_informative_hits = get_hit_taxids(hit_data,
-                                                         hit_taxa,
-                                                         lca_dist)
+    hit_tax_ids, total_informative_hits = count_informative_hits(
+        hit_data.tax_id_data, tax_id_data_art.tax_id_data_fp,
+        identified_taxa_art.identified_taxa_file, lca_dist, workers,
+        working_dir)
 
     informative_tax_ids = get_informative_tax_ids(min_hits,
                                                   min_relative_hits,
@@ -70,6 +88,109 @@ def main(working_dir, output, details, identified_taxa_art: IdentifiedTaxa,
     return hit_data
 
 
+def count_informative_hits(taxonomy, taxonomy_fp, identified_taxa_fp,
+                           lca_dist, workers, working_dir):
+    """Counts informative hits per tax id, optionally in parallel
+
+    With more than one worker, the identified taxa file is split into byte
+    ranges at line boundaries and each range is classified in a separate
+    process. Workers memory map the taxonomy, so it is shared read-only
+    between them rather than copied, and their counts are summed at the end.
+
+    Parameters
+    ----------
+        taxonomy : Taxonomy
+            the taxonomy the tax ids were hit in
+        taxonomy_fp : str
+            location of `taxonomy` in binary format, used by the workers
+        identified_taxa_fp : str
+            location of the mg_wrapper output
+        lca_dist : Int
+            number of edges to be traversed when determining lowest common
+            ancestor
+        workers : Int
+            number of processes to use
+        working_dir : str
+            directory for a binary copy of `taxonomy`, in case `taxonomy_fp`
+            does not exist or lacks an LCA index
+
+    Returns
+    -------
+        (dict, int)
+            tax_id key to number of hits to it value, and the total number
+            of informative hits
+
+    """
+    if workers <= 1:
+        shards = [(0, os.path.getsize(identified_taxa_fp))]
+        results = [_count_shard(taxonomy, identified_taxa_fp, start, end,
+                                lca_dist) for start, end in shards]
+    else:
+        if not os.path.isfile(taxonomy_fp) or taxonomy.jumps is None:
+            if taxonomy.jumps is None:
+                taxonomy.build_lca_index()
+            taxonomy_fp = os.path.join(working_dir, "tax_id_data.bin")
+            taxonomy.write(taxonomy_fp)
+
+        shards = split_file(identified_taxa_fp, workers)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers) as executor:
+            futures = [executor.submit(_count_worker_shard, taxonomy_fp,
+                                       identified_taxa_fp, start, end,
+                                       lca_dist)
+                       for start, end in shards]
+            results = [future.result() for future in futures]
+
+    hit_counts = collections.Counter()
+    total_informative_hits = 0
+    for shard_counts, shard_total in results:
+        hit_counts.update(shard_counts)
+        total_informative_hits += shard_total
+
+    taxids = taxonomy.taxids
+    hit_tax_ids = {str(taxids[index]): count
+                   for index, count in hit_counts.items()}
+    return hit_tax_ids, total_informative_hits
+
+
+# Path and taxonomy last memory mapped by this worker process
+_worker_taxonomy = (None, None)
+
+
+def _count_worker_shard(taxonomy_fp, identified_taxa_fp, start, end,
+                        lca_dist):
+    # The taxonomy is loaded by the first shard a worker is given rather than
+    # by a pool initializer, which needs Python 3.7
+    global _worker_taxonomy
+    if _worker_taxonomy[0] != taxonomy_fp:
+        _worker_taxonomy = (taxonomy_fp, Taxonomy.load(taxonomy_fp))
+    return _count_shard(_worker_taxonomy[1], identified_taxa_fp, start, end,
+                        lca_dist)
+
+
+def _count_shard(taxonomy, identified_taxa_fp, start, end, lca_dist):
+    """Counts informative hits in a byte range of the identified taxa
+
+    Reads are streamed and loaded `HIT_BATCH_SIZE` at a time, so memory use
+    does not grow with the number of reads. Returns the counts sparsely, as
+    taxonomy index to count, so that only the tax ids which were hit are
+    sent back from a worker.
+    """
+    identified_taxa = iter_identified_taxa(identified_taxa_fp, start, end)
+    hit_counts = array.array('q', bytes(8 * len(taxonomy)))
+    total_informative_hits = 0
+    while True:
+        read_offsets, hit_indices = load_hit_batch(
+            taxonomy, itertools.islice(identified_taxa, HIT_BATCH_SIZE))
+        if len(read_offsets) == 1:
+            break
+        _, batch_informative_hits = get_hit_counts(
+            taxonomy, read_offsets, hit_indices, lca_dist, hit_counts)
+        total_informative_hits += batch_informative_hits
+    return ({index: count for index, count in enumerate(hit_counts)
+             if count}, total_informative_hits)
+
+
 def get_informative_tax_ids(min_hits, min_relative_hits, hit_tax_ids,
                             total_informative_hits):
     """Based on min_hit thresholds taxids are determined to be informative
@@ -110,7 +231,7 @@ def get_informative_tax_ids(min_hits, min_relative_hits, hit_tax_ids,
 def get_hit_taxa(hit_taxa_lines):
     """Builds dictionary from read_ids and the tax_ids it hit
 
-    A set of all tax_ids it hit is constructed for each read_id.
+    A list of all distinct tax_ids it hit is constructed for each read_id.
 
     parameters
     ----------
@@ -127,18 +248,167 @@ def get_hit_taxa(hit_taxa_lines):
     hit_taxa = {}
 
     for line in hit_taxa_lines:
-        this_line = line.rstrip().split(":")
-        this_read_id = this_line[1]
-        these_hits = set()
-        for mm_distance in this_line[1:]:
-            for tax_id_hit in mm_distance:
-                these_hits.add(tax_id_hit)
-
-        hit_taxa[this_read_id] = list(these_hits)
+        this_read_id, these_hits = parse_identified_taxa_line(line)
+        if these_hits:
+            hit_taxa[this_read_id] = these_hits
 
     return hit_taxa
 
 
+# Number of reads loaded into arrays at a time while counting
+HIT_BATCH_SIZE = 100000
+# Most pairs of hits tested at a time when reads are classified with NumPy
+HIT_PAIR_BATCH_SIZE = 1 << 20
+
+
+def load_hit_batch(taxonomy, identified_taxa):
+    """Loads the hits of many reads into flat integer arrays
+
+    The hits of read ``r`` are
+    ``hit_indices[read_offsets[r]:read_offsets[r + 1]]``. Storing a batch
+    this way costs a few bytes per hit instead of a dict entry per read and
+    a list and string per hit.
+
+    parameters
+    ----------
+        taxonomy : Taxonomy
+            taxonomy the tax ids are looked up in
+        identified_taxa : iterable of (str, list)
+            read_id and the tax_ids it hit, as read from an IdentifiedTaxa
+            artifact
+
+    Returns
+    -------
+        (array, array)
+            read offsets into the hits, and the taxonomy indices of the hits
+
+    """
+    read_offsets = array.array('q', [0])
+    tax_id_hits = []
+    for _, these_hits in identified_taxa:
+        tax_id_hits.extend(these_hits)
+        read_offsets.append(len(tax_id_hits))
+
+    return read_offsets, taxonomy.bulk_index(tax_id_hits)
+
+
+def get_hit_counts(taxonomy, read_offsets, hit_indices, lca_dist,
+                   hit_counts=None):
+    """Counts informative hits for a batch loaded by `load_hit_batch`
+
+    Same counting as `get_hit_taxids`, but over flat arrays: reads with a
+    single hit are counted directly and only reads with multiple hits go
+    through `is_informative`. When NumPy is installed no read is visited
+    from Python; see `_informative_reads`.
+
+    Parameters
+    ----------
+        taxonomy : Taxonomy
+            taxonomy the hits were loaded against
+        read_offsets : array
+            offsets of the hits of each read
+        hit_indices : array
+            taxonomy indices of the hits
+        lca_dist : Int
+            number of edges to be traversed when determining lowest common
+            ancestor
+        hit_counts : array, optional
+            counts of a previous batch to add this batch's counts to
+
+    Returns
+    -------
+        (array, int)
+            number of informative hits per taxonomy index, and the total
+            number of informative hits in this batch
+
+    """
+    if hit_counts is None:
+        hit_counts = array.array('q', bytes(8 * len(taxonomy)))
+    if numpy is not None:
+        return _get_hit_counts_numpy(taxonomy, read_offsets, hit_indices,
+                                     lca_dist, hit_counts)
+    total_informative_hits = 0
+    start = read_offsets[0]
+    for end in read_offsets[1:]:
+        if end - start == 1 or is_informative(taxonomy,
+                                              hit_indices[start:end],
+                                              lca_dist):
+            hit_counts[hit_indices[start]] += 1
+            total_informative_hits += 1
+        start = end
+
+    return hit_counts, total_informative_hits
+
+
+def _get_hit_counts_numpy(taxonomy, read_offsets, hit_indices, lca_dist,
+                          hit_counts):
+    offsets = numpy.asarray(read_offsets)
+    hits = numpy.asarray(hit_indices)
+    lengths = numpy.diff(offsets)
+    read_pairs = numpy.cumsum(lengths * (lengths - 1) // 2)
+
+    informative = numpy.empty(len(lengths), bool)
+    first = 0
+    while first < len(lengths):
+        # Reads are classified as many at a time as have at most
+        # HIT_PAIR_BATCH_SIZE pairs of hits between them, and at least one
+        done = read_pairs[first - 1] if first else 0
+        last = numpy.searchsorted(read_pairs, done + HIT_PAIR_BATCH_SIZE,
+                                  'right')
+        last = max(int(last), first + 1)
+        informative[first:last] = _informative_reads(
+            taxonomy, offsets[first:last + 1], hits, lca_dist)
+        first = last
+
+    first_hits = hits[offsets[:-1][informative]]
+    numpy.add.at(numpy.asarray(hit_counts), first_hits, 1)
+    return hit_counts, len(first_hits)
+
+
+def _informative_reads(taxonomy, offsets, hits, lca_dist):
+    """Classifies the reads of `offsets` into `hits` with NumPy
+
+    Every hit is paired up with each hit before it in its read, all pairs
+    are tested at once with `ancestors_overlap`, and the results are reduced
+    with `reduceat`: a hit is accepted when it overlaps any earlier hit, and
+    a read is informative when all of its hits after the first are accepted.
+    """
+    starts = offsets[:-1]
+    lengths = numpy.diff(offsets)
+    informative = numpy.ones(len(lengths), bool)
+    multiple_hits = lengths > 1
+    if not multiple_hits.any():
+        return informative
+
+    # Position of each hit within its read, for the hits after the first
+    hit_reads = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    ranks = numpy.arange(offsets[0], offsets[-1]) - starts[hit_reads]
+    later = numpy.flatnonzero(ranks) + offsets[0]
+    ranks = ranks[ranks > 0]
+
+    # The pairs of each later hit with the hits before it, back to back
+    pair_offsets = numpy.cumsum(ranks) - ranks
+    pair_ranks = numpy.arange(ranks.sum()) - numpy.repeat(pair_offsets,
+                                                          ranks)
+    earlier = numpy.repeat(later - ranks, ranks) + pair_ranks
+    overlaps = ancestors_overlap(taxonomy, hits[numpy.repeat(later, ranks)],
+                                 hits[earlier], lca_dist)
+
+    accepted = numpy.logical_or.reduceat(overlaps, pair_offsets)
+    later_counts = lengths[multiple_hits] - 1
+    informative[multiple_hits] = numpy.logical_and.reduceat(
+        accepted, numpy.cumsum(later_counts) - later_counts)
+    return informative
+
+
+def hit_counts_to_tax_ids(taxonomy, hit_counts):
+    """Converts counts per taxonomy index to the dict `get_hit_taxids` returns
+    """
+    taxids = taxonomy.taxids
+    return {str(taxids[index]): count
+            for index, count in enumerate(hit_counts) if count}
+
+
 def get_hit_taxids(hit_data, hit_taxa, lca_dist):
     """Counts the numer of times each tax_id was hit in alignment
 
@@ -161,35 +431,141 @@ def get_hit_taxids(hit_data, hit_taxa, lca_dist):
             tax_id key to number of hits to it value
 
     """
+    taxonomy = hit_data.tax_id_data
     hit_tax_ids = {}
     total_informative_hits = 0
     for read_id in hit_taxa:
         these_tax_ids_hit = hit_taxa[read_id]
-        if len(these_tax_ids_hit) == 1:
+        if is_informative(taxonomy, taxonomy.bulk_index(these_tax_ids_hit),
+                          lca_dist):
             total_informative_hits += 1
             hit_tax_ids = increment_tax_id_hits(
                 hit_tax_ids, these_tax_ids_hit[0])
 
-        else:
-            informative = True
-            ancestor_pool = set(hit_data.tax_id_data[these_tax_ids_hit[0]].
-                                parents[-lca_dist:])
-            for tax_id_hit in these_tax_ids_hit[1:]:
-                this_ancestor_pool = set(hit_data.tax_id_data[tax_id_hit].
-                                         parents[-lca_dist:])
-                if this_ancestor_pool & ancestor_pool:
-                    ancestor_pool |= this_ancestor_pool
-                else:
-                    break
-                    informative = False
-            if informative:
-                total_informative_hits += 1
-                hit_tax_ids = increment_tax_id_hits(
-                    hit_tax_ids, these_tax_ids_hit[0])
-
     return hit_tax_ids, total_informative_hits
 
 
+def is_informative(taxonomy, hit_indices, lca_dist):
+    """Determines if a read that hit `hit_indices` is informative
+
+    Each tax id hit must share an ancestor within `lca_dist` edges with one of
+    the tax ids before it, i.e. the last `lca_dist` entries of its parents
+    must intersect those of a previous tax id. Every pair of a tax id and one
+    before it is tested at once with `ancestors_overlap`.
+
+    Parameters
+    ----------
+        taxonomy : Taxonomy
+            the taxonomy the tax ids were hit in
+        hit_indices : list of int
+            indices in `taxonomy` of the tax ids the read hit
+        lca_dist : Int
+            number of edges to be traversed when determining lowest common
+            ancestor
+
+    Returns
+    -------
+        bool
+            whether the read is informative
+
+    """
+    if numpy is None:
+        # One pair at a time, so that testing stops at the first tax id
+        # without an overlap
+        for position in range(1, len(hit_indices)):
+            index = hit_indices[position]
+            if not any(_ancestors_overlap(taxonomy, index, previous,
+                                          taxonomy.lca(index, previous),
+                                          lca_dist)
+                       for previous in hit_indices[:position]):
+                return False
+        return True
+
+    pairs = [(position, previous) for position in range(1, len(hit_indices))
+             for previous in range(position)]
+    overlaps = ancestors_overlap(
+        taxonomy, [hit_indices[position] for position, _ in pairs],
+        [hit_indices[previous] for _, previous in pairs], lca_dist)
+    # The pairs of the tax id at `position` start at position*(position-1)/2
+    return all(any(overlaps[position * (position - 1) // 2:
+                            position * (position + 1) // 2])
+               for position in range(1, len(hit_indices)))
+
+
+def ancestors_overlap(taxonomy, indices_a, indices_b, lca_dist):
+    """Whether parents[-lca_dist:] of pairs of tax ids share a tax id
+
+    The lowest common ancestors of all pairs are found with one
+    `Taxonomy.bulk_lca` query, and with NumPy the comparisons are made for
+    all pairs at once too.
+
+    Parameters
+    ----------
+        taxonomy : Taxonomy
+            the taxonomy the tax ids were hit in
+        indices_a, indices_b : sequence of int
+            indices in `taxonomy` of the tax ids, paired up by position
+        lca_dist : Int
+            number of edges to be traversed when determining lowest common
+            ancestor
+
+    Returns
+    -------
+        sequence of bool
+            whether each pair overlaps
+
+    """
+    commons = taxonomy.bulk_lca(indices_a, indices_b)
+    if numpy is None:
+        return list(map(_ancestors_overlap, itertools.repeat(taxonomy),
+                        indices_a, indices_b, commons,
+                        itertools.repeat(lca_dist)))
+
+    indices_a = numpy.asarray(indices_a)
+    indices_b = numpy.asarray(indices_b)
+    overlap = commons != -1
+    commons = numpy.where(overlap, commons, indices_a)
+    # Only proper ancestors are part of the parents
+    own = (commons == indices_a) | (commons == indices_b)
+    parents = taxonomy.bulk_parent(commons)
+    overlap &= ~(own & (parents == commons))
+    commons = numpy.where(own, parents, commons)
+
+    if lca_dist > 0:
+        shallowest = numpy.maximum(
+            numpy.maximum(taxonomy.bulk_depth(indices_a),
+                          taxonomy.bulk_depth(indices_b)) - lca_dist, 0)
+    else:
+        shallowest = _shallowest_ancestor(0, lca_dist)
+    overlap &= taxonomy.bulk_depth(commons) >= shallowest
+    return overlap
+
+
+def _ancestors_overlap(taxonomy, index_a, index_b, common, lca_dist):
+    """`ancestors_overlap` of one pair, given its lowest common ancestor"""
+    if common == index_a or common == index_b:
+        # Only proper ancestors are part of the parents
+        if taxonomy.parents[common] == common:
+            return False
+        common = taxonomy.parents[common]
+    elif common == -1:
+        return False
+
+    depths = taxonomy.depths
+    return depths[common] >= max(_shallowest_ancestor(depths[index_a],
+                                                      lca_dist),
+                                 _shallowest_ancestor(depths[index_b],
+                                                      lca_dist))
+
+
+def _shallowest_ancestor(depth, lca_dist):
+    """Depth of parents[-lca_dist:][0] for a tax id at `depth`"""
+    if lca_dist > 0:
+        return max(depth - lca_dist, 0)
+    # parents[-0:] is the whole lineage, parents[2:] skips two ancestors
+    return -lca_dist
+
+
 def increment_tax_id_hits(ids, id_to_increment):
     """Increments a counter in a dictionary of ids
 
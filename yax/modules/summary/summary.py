@@ -15,30 +15,27 @@ from yax.artifacts.summary_stats import SummaryStats
 from yax.artifacts.summary_table import SummaryTable
 from yax.artifacts.coverage_data import CoverageData
 from yax.state.type.parameter import Directory, Str, Int, File
-from yax.shared.utilities import taxidtool
+from yax.shared.utilities.taxonomy import Taxonomy
 
 
 def main(working_directory, output, summary_stats: SummaryStats,
          summary_table: SummaryTable, coverage_data: CoverageData,
          order_method: Str, total_results: Int, bin_size: Int,
          output_path: Directory, nodes_fp: File, names_fp: File,
-         gi_taxid_nucl_fp: File) -> Summary:
+         gi_taxid_nucl_fp: File, cache_dir=None) -> Summary:
 
-    tax_id_data = taxidtool.build_taxid_data(nodes_fp, names_fp,
-                                             gi_taxid_nucl_fp)
-    gis_to_taxids = taxidtool.build_gis_to_taxids(tax_id_data)
-    taxids_to_names = taxidtool.parse_names_dmp(names_fp)
+    tax_id_data = Taxonomy.from_dmp(nodes_fp, names_fp, gi_taxid_nucl_fp,
+                                    cache_dir=cache_dir)
 
     print('Running summary.')
     _run_summary(summary_stats, summary_table, coverage_data,
                  str(order_method), total_results, bin_size, str(output_path),
-                 output, str(working_directory), gis_to_taxids,
-                 taxids_to_names)
+                 output, str(working_directory), tax_id_data)
 
 
 def _run_summary(summary_stats, summary_table, coverage_data, order_method,
                  total_results, bin_size, output_path, output,
-                 working_directory, gis_to_taxids, taxids_to_names):
+                 working_directory, tax_id_data):
     """
     :param summary_stats:
     :param summary_table:
@@ -72,8 +69,7 @@ def _run_summary(summary_stats, summary_table, coverage_data, order_method,
 
         # Get dictionary containing coverage data for each gi, separated into
         # their respective tax ids
-        coverage, max_coverage = _parse_summary_data(sample, gis_to_taxids,
-                                                     taxids_to_names)
+        coverage, max_coverage = _parse_summary_data(sample, tax_id_data)
         keys = list(coverage.keys())
         keys.sort()
         for i, key in enumerate(keys):
@@ -129,7 +125,7 @@ def _run_summary(summary_stats, summary_table, coverage_data, order_method,
     # output.complete()
 
 
-def _parse_summary_data(coverage_data, gis_to_taxids, taxids_to_names):
+def _parse_summary_data(coverage_data, tax_id_data):
     """
     Builds a dictionary representing coverage data. Keys in the dictionary are
     tax ids and value are sub-dictionaries. Sub-dictionaries have gis as keys
@@ -155,12 +151,16 @@ def _parse_summary_data(coverage_data, gis_to_taxids, taxids_to_names):
     """
 
     coverage = {}
+    # Look up the tax id of every sequence at once; alignments to gis which
+    # are not one of the sequences are not counted anyway
+    gis = [sequence.gi for sequence in coverage_data.sequences]
+    gi_tax_ids = dict(zip(gis, get_taxids_and_names(gis, tax_id_data)))
+
     # For each sequence in the coverage data, add a record in the dictionary
     # representing the sequence and all it's initially empty coverage
     # statistics
     for sequence in coverage_data.sequences:
-        tax_id = '|'.join(get_taxid_and_name(sequence.gi, gis_to_taxids,
-                                             taxids_to_names))
+        tax_id = gi_tax_ids[sequence.gi]
         # if the tax id is not in the dictionary, add it
         if tax_id not in coverage:
             coverage[tax_id] = {}
@@ -179,8 +179,7 @@ def _parse_summary_data(coverage_data, gis_to_taxids, taxids_to_names):
     max_coverage = 0
     for alignment in coverage_data.alignments:
         gi = alignment.gi
-        tax_id = '|'.join(get_taxid_and_name(gi, gis_to_taxids,
-                                             taxids_to_names))
+        tax_id = gi_tax_ids.get(gi)
 
         if tax_id not in coverage:
             continue
@@ -372,10 +371,16 @@ def _bin_sequence(sequence, bin_size):
     return binned_data
 
 
-def get_taxid_and_name(gi, gis_to_taxids, taxids_to_names):
+def get_taxids_and_names(gis, tax_id_data):
     """
-    Returns the tax id and scientific name belonging to a gi
+    Returns the tax id and scientific name belonging to each of many gis,
+    joined as 'tax id|name'
     """
-    tax_id = gis_to_taxids[gi]
-    name = taxids_to_names[tax_id]
-    return tax_id, name
+    indices = tax_id_data.bulk_gi_index(gis)
+    missing = [gi for gi, index in zip(gis, indices) if index == -1]
+    if missing:
+        raise KeyError(missing[0])
+    tax_ids = tax_id_data.bulk_taxid(indices)
+    names = tax_id_data.bulk_name(indices)
+    return ['|'.join((str(tax_id), name))
+            for tax_id, name in zip(tax_ids, names)]
@@ -1,10 +1,10 @@
 from yax.artifacts.tax_id_data import TaxIDData
 from yax.state.type.parameter import File
-from yax.shared.utilities import taxidtool
+from yax.shared.utilities.taxonomy import Taxonomy
 
 
 def main(working_dir, output, details, nodes_dmp: File, names_dmp: File,
-         gi_taxid_nucl_fp: File) -> TaxIDData:
+         gi_taxid_nucl_fp: File, cache_dir=None) -> TaxIDData:
     """Description
 
     Detailed Description
@@ -20,8 +20,9 @@ def main(working_dir, output, details, nodes_dmp: File, names_dmp: File,
     """
     tax_id_data, = output
 
-    tax_id_data.tax_id_data = taxidtool.build_taxid_data(nodes_dmp,
-                                                         names_dmp,
-                                                         gi_taxid_nucl_fp)
+    tax_id_data.tax_id_data = Taxonomy.from_dmp(nodes_dmp,
+                                                names_dmp,
+                                                gi_taxid_nucl_fp,
+                                                cache_dir=cache_dir)
 
     return output
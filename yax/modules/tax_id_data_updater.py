@@ -0,0 +1,45 @@
+from yax.artifacts.tax_id_data import TaxIDData
+from yax.state.type.parameter import File
+from yax.shared.utilities import taxidtool
+
+
+def main(working_dir, output, details, tax_id_data_art: TaxIDData,
+         delnodes_dmp: File, merged_dmp: File, nodes_dmp: File,
+         names_dmp: File, gi_taxid_nucl_fp: File) -> TaxIDData:
+    """Updates a TaxIDData artifact from a diff of the NCBI dump files
+
+    Rather than rebuilding the taxonomy from the full dump files, the
+    existing taxonomy is carried over and only the changes are applied.
+
+    Parameters
+    ----------
+        tax_id_data_art : TaxIDData
+            the taxonomy to update
+        delnodes_dmp : File
+            delnodes.dmp listing the deleted taxids
+        merged_dmp : File
+            merged.dmp listing the taxids merged into other taxids
+        nodes_dmp : File
+            nodes.dmp entries of the added nodes and of the nodes whose
+            parent or rank changed
+        names_dmp : File
+            names.dmp entries of the added and renamed nodes
+        gi_taxid_nucl_fp : File
+            gi_taxid_nucl.dmp entries of the added or moved gis
+
+    Returns
+    -------
+        output
+            the updated TaxIDData artifact
+
+    """
+    tax_id_data, = output
+
+    tax_id_data.tax_id_data = tax_id_data_art.tax_id_data.update(
+        deleted=taxidtool.iter_delnodes_dmp(delnodes_dmp),
+        merged=taxidtool.iter_merged_dmp(merged_dmp),
+        nodes=taxidtool.iter_nodes_dmp(nodes_dmp),
+        names=taxidtool.iter_names_dmp(names_dmp),
+        gis=taxidtool.iter_gi_taxid_dmp(gi_taxid_nucl_fp))
+
+    return output
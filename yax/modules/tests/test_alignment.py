@@ -0,0 +1,178 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from yax.artifacts.coverage_data import CoverageData
+from yax.modules.alignment import alignment
+
+
+READS = """>read1_2_0_1
+ACGT
+>read2_0_3_0
+GGCC
+TTAA
+>read3_1_1_0
+CCCC
+"""
+
+
+class TestAlignment(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.temp_dir = self._temp_dir.name
+        self.reads_fp = os.path.join(self.temp_dir, 'reads.fasta')
+        with open(self.reads_fp, mode='w') as fh:
+            fh.write(READS)
+        self.samples_dir = os.path.join(self.temp_dir, 'samples')
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def read_sample(self, sample_num):
+        with open(alignment.sample_reads_fp(self.samples_dir,
+                                            sample_num)) as fh:
+            return fh.read()
+
+    def test_get_num_samples(self):
+        self.assertEqual(alignment.get_num_samples(self.reads_fp), 3)
+
+    def test_demultiplex_reads(self):
+        alignment.demultiplex_reads(self.reads_fp, self.samples_dir,
+                                    [0, 1, 2])
+
+        self.assertEqual(self.read_sample(0),
+                         ">read1_2_0_1\nACGT\n>read3_1_1_0\nCCCC\n")
+        self.assertEqual(self.read_sample(1),
+                         ">read2_0_3_0\nGGCC\nTTAA\n>read3_1_1_0\nCCCC\n")
+        self.assertEqual(self.read_sample(2), ">read1_2_0_1\nACGT\n")
+        self.assertFalse(os.path.exists(self.samples_dir + ".tmp"))
+
+    def test_demultiplex_reads_pending_samples(self):
+        alignment.demultiplex_reads(self.reads_fp, self.samples_dir, [1])
+        self.assertEqual(os.listdir(self.samples_dir),
+                         [os.path.basename(alignment.sample_reads_fp(
+                             self.samples_dir, 1))])
+
+    def test_demultiplex_reads_restart(self):
+        # A split interrupted part way is redone
+        os.makedirs(self.samples_dir + ".tmp")
+        with open(os.path.join(self.samples_dir + ".tmp", 'partial'),
+                  mode='w') as fh:
+            fh.write('partial')
+        alignment.demultiplex_reads(self.reads_fp, self.samples_dir, [0])
+        self.assertEqual(len(os.listdir(self.samples_dir)), 1)
+
+        # A completed split is reused
+        os.remove(self.reads_fp)
+        alignment.demultiplex_reads(self.reads_fp, self.samples_dir, [0])
+        self.assertEqual(self.read_sample(0),
+                         ">read1_2_0_1\nACGT\n>read3_1_1_0\nCCCC\n")
+
+    def test_main(self):
+        output = CoverageData.declare(self.temp_dir, 'alignment')
+        with mock.patch.object(alignment, 'run_alignment') as run:
+            result = alignment.main(self.temp_dir, (output,),
+                                    {'run_key': 'key'}, self.reads_fp,
+                                    'references', '-p 4')
+        self.assertIs(result, output)
+        run.assert_called_once_with('references', self.reads_fp, output,
+                                    self.temp_dir, '-p 4', None, 0, 1)
+
+    def test_split_cores(self):
+        self.assertEqual(alignment.split_cores(16, 3), (3, 5))
+        self.assertEqual(alignment.split_cores(4, 10), (4, 1))
+        self.assertEqual(alignment.split_cores(1, 3), (1, 1))
+        self.assertEqual(alignment.split_cores(8, 0), (1, 8))
+        # The threads of the bowtie2 options are kept
+        self.assertEqual(alignment.split_cores(16, 2, 4), (4, 4))
+        self.assertEqual(alignment.split_cores(2, 5, 8), (1, 2))
+
+    def test_split_reads(self):
+        self.assertEqual(alignment.split_reads({0: 90, 1: 10}, 2),
+                         {0: 7, 1: 1})
+        self.assertEqual(alignment.split_reads({0: 90, 1: 10}, 1),
+                         {0: 1, 1: 1})
+        self.assertEqual(alignment.split_reads({0: 0}, 4), {0: 1})
+
+    def run_alignment(self, bowtie_args='', **kwargs):
+        """Runs the alignment with bowtie2 replaced by a function writing a
+        SAM header and a line per read, returning its calls"""
+        data_dir = os.path.join(self.temp_dir, 'coverage')
+        os.makedirs(data_dir)
+        output = CoverageData.declare(data_dir, 'alignment')
+        output.append_completed_file(alignment.coverage_file_name(2))
+        calls = []
+
+        def align(reads_fp, index_fp, output_fp, bowtie_args, threads):
+            calls.append((os.path.basename(reads_fp), threads))
+            self.assertTrue(os.path.basename(reads_fp).startswith(
+                index_fp.replace('index', 'sample')))
+            with open(reads_fp) as reads, open(output_fp, mode='w') as sam:
+                sam.write('@HD\tVN:1.0\n')
+                sam.writelines(line[1:] for line in reads
+                               if line.startswith('>'))
+
+        with mock.patch.object(alignment, 'call_bt2_align', align), \
+                mock.patch.object(alignment, 'build_current_index',
+                                  side_effect=lambda n, *_: 'index_%d' % n) \
+                as build, \
+                mock.patch.object(CoverageData, 'build_coverage_data'):
+            alignment.run_alignment(None, self.reads_fp, output,
+                                    self.temp_dir, bowtie_args, **kwargs)
+        self.builds = sorted((args[0], args[4])
+                             for args, _ in build.call_args_list)
+
+        self.assertEqual(sorted(output.get_completed_coverage_files()),
+                         [alignment.coverage_file_name(n)
+                          for n in range(3)])
+        self.assertFalse(os.path.exists(os.path.join(data_dir, 'samples')))
+        for sample_num, reads in ((0, 'read1_2_0_1\nread3_1_1_0\n'),
+                                  (1, 'read2_0_3_0\nread3_1_1_0\n')):
+            with open(os.path.join(data_dir, alignment.coverage_file_name(
+                    sample_num))) as fh:
+                self.assertEqual(fh.read(), '@HD\tVN:1.0\n' + reads)
+        return calls
+
+    def test_run_alignment_default_threads(self):
+        # Without a core budget the threads of the bowtie2 options are kept
+        calls = self.run_alignment('-p 16')
+        self.assertEqual(calls, [('sample_1.fasta', None),
+                                 ('sample_0.fasta', None)])
+        self.assertEqual(self.builds, [(0, 1), (1, 1)])
+
+    def test_run_alignment_largest_first(self):
+        calls = self.run_alignment(cores=1)
+        self.assertEqual(calls, [('sample_1.fasta', 1),
+                                 ('sample_0.fasta', 1)])
+
+    def test_run_alignment_parts(self):
+        # Two processes of three threads share the parts of both samples
+        calls = self.run_alignment(cores=6)
+        self.assertEqual(sorted(calls),
+                         [('sample_0.part_0.fasta', 3),
+                          ('sample_0.part_1.fasta', 3),
+                          ('sample_1.part_0.fasta', 3),
+                          ('sample_1.part_1.fasta', 3)])
+        # The indexes are built first, each with the threads of a process
+        self.assertEqual(self.builds, [(0, 3), (1, 3)])
+
+    def test_run_alignment_build_threads(self):
+        # One sample left to build takes the threads of both processes
+        with open(self.reads_fp, mode='w') as fh:
+            fh.write(">read1_2\nACGT\n>read2_1\nACGT\n")
+        data_dir = os.path.join(self.temp_dir, 'coverage')
+        os.makedirs(data_dir)
+        output = CoverageData.declare(data_dir, 'alignment')
+        with mock.patch.object(alignment, 'call_bt2_align'), \
+                mock.patch.object(alignment, 'concatenate_alignments'), \
+                mock.patch.object(alignment, 'build_current_index') as build, \
+                mock.patch.object(CoverageData, 'build_coverage_data'):
+            alignment.run_alignment(None, self.reads_fp, output,
+                                    self.temp_dir, '-p 2', cores=4)
+        build.assert_called_once_with(0, None, self.temp_dir, None, 4, 1,
+                                      mock.ANY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import itertools
+import os
+import random
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from yax.util import get_data_path
+from yax.shared.utilities import taxonomy as taxonomy_module
+from yax.shared.utilities.taxonomy import Taxonomy
+from yax.artifacts.identified_taxa import (IdentifiedTaxa,
+                                           parse_identified_taxa_line)
+from yax.modules import identify_informative_hits
+
+
+def informative_by_ancestor_sets(taxid_data, tax_ids_hit, lca_dist):
+    # The definition: each tax id's parents[-lca_dist:] must intersect the
+    # pool of ancestors of the tax ids accepted before it.
+    ancestor_pool = set(taxid_data[tax_ids_hit[0]].parents[-lca_dist:])
+    for tax_id_hit in tax_ids_hit[1:]:
+        this_ancestor_pool = set(taxid_data[tax_id_hit].parents[-lca_dist:])
+        if this_ancestor_pool & ancestor_pool:
+            ancestor_pool |= this_ancestor_pool
+        else:
+            return False
+    return True
+
+
+def numpy_or_not():
+    # Runs the body of a loop with NumPy and again as if it was missing
+    for numpy in (identify_informative_hits.numpy, None):
+        with mock.patch.object(identify_informative_hits, 'numpy', numpy), \
+                mock.patch.object(taxonomy_module, 'numpy', numpy):
+            yield
+
+
+class TestIdentifyInformativeHits(unittest.TestCase):
+    def setUp(self):
+        self.taxonomy = Taxonomy.from_dmp(get_data_path('nodes.dmp'),
+                                          get_data_path('names.dmp'),
+                                          get_data_path('gi_taxid_nucl.dmp'))
+        self.hit_data = types.SimpleNamespace(tax_id_data=self.taxonomy)
+
+    def test_is_informative_matches_ancestor_sets(self):
+        taxonomy = self.taxonomy
+        hits = list(itertools.permutations(taxonomy, 2)) + \
+            list(itertools.permutations(['1', '4', '8', '10', '13', '21'], 3))
+        for _ in numpy_or_not():
+            for lca_dist, tax_ids_hit in itertools.product(range(-2, 5),
+                                                           hits):
+                self.assertEqual(
+                    identify_informative_hits.is_informative(
+                        taxonomy, [taxonomy.index(t) for t in tax_ids_hit],
+                        lca_dist),
+                    informative_by_ancestor_sets(taxonomy, tax_ids_hit,
+                                                 lca_dist),
+                    (tax_ids_hit, lca_dist))
+
+    def test_get_hit_taxids(self):
+        hit_taxa = {'read1': ['8'],
+                    'read2': ['8', '10'],
+                    'read3': ['10', '13'],
+                    'read4': ['12']}
+
+        hit_tax_ids, total = identify_informative_hits.get_hit_taxids(
+            self.hit_data, hit_taxa, 1)
+
+        self.assertEqual(hit_tax_ids, {'8': 2, '12': 1})
+        self.assertEqual(total, 3)
+
+    def test_get_hit_taxa(self):
+        lines = ["read1:8\n",
+                 "read2:8,10:10,12\n",
+                 "read3::13\n",
+                 "read4:\n"]
+
+        self.assertEqual(identify_informative_hits.get_hit_taxa(lines),
+                         {'read1': ['8'],
+                          'read2': ['8', '10', '12'],
+                          'read3': ['13']})
+
+    def test_batch_matches_get_hit_taxids(self):
+        lines = ["read1:8\n",
+                 "read2:8,10\n",
+                 "read3:10:13\n",
+                 "read4:12\n",
+                 "read5:\n",
+                 "read6:21,23:19\n",
+                 "read7:16,4\n"]
+
+        for lca_dist in range(0, 4):
+            expected = identify_informative_hits.get_hit_taxids(
+                self.hit_data, identify_informative_hits.get_hit_taxa(lines),
+                lca_dist)
+
+            read_offsets, hit_indices = \
+                identify_informative_hits.load_hit_batch(
+                    self.taxonomy,
+                    [read for read in map(parse_identified_taxa_line, lines)
+                     if read[1]])
+            self.assertEqual(list(read_offsets), [0, 1, 3, 5, 6, 9, 11])
+            for _ in numpy_or_not():
+                hit_counts, total = identify_informative_hits.get_hit_counts(
+                    self.taxonomy, read_offsets, hit_indices, lca_dist)
+                observed = (identify_informative_hits.hit_counts_to_tax_ids(
+                    self.taxonomy, hit_counts), total)
+
+                self.assertEqual(observed, expected)
+
+    def test_batch_pairs_in_chunks(self):
+        taxids = list(self.taxonomy)
+        rng = random.Random(0)
+        reads = [("read%d" % read,
+                  rng.sample(taxids, rng.choice([1, 1, 2, 3, 5])))
+                 for read in range(200)]
+        read_offsets, hit_indices = identify_informative_hits.load_hit_batch(
+            self.taxonomy, reads)
+
+        for lca_dist in range(-1, 4):
+            expected = identify_informative_hits.get_hit_taxids(
+                self.hit_data, dict(reads), lca_dist)
+            for pair_batch_size in (1, 7, 1 << 20):
+                with mock.patch.object(identify_informative_hits,
+                                       'HIT_PAIR_BATCH_SIZE',
+                                       pair_batch_size):
+                    hit_counts, total = \
+                        identify_informative_hits.get_hit_counts(
+                            self.taxonomy, read_offsets, hit_indices,
+                            lca_dist)
+                self.assertEqual(
+                    (identify_informative_hits.hit_counts_to_tax_ids(
+                        self.taxonomy, hit_counts), total), expected)
+
+    def test_count_informative_hits_in_parallel(self):
+        lines = ["read%d:%s\n" % (read, hits) for read, hits in enumerate(
+            ["8", "8,10", "10:13", "12", "", "21,23:19", "16,4"] * 5)]
+        expected = identify_informative_hits.get_hit_taxids(
+            self.hit_data, identify_informative_hits.get_hit_taxa(lines), 1)
+
+        with tempfile.TemporaryDirectory() as dir_:
+            identified_taxa_fp = os.path.join(dir_, 'identified_taxa.txt')
+            with open(identified_taxa_fp, mode='w') as fh:
+                fh.write("".join(lines))
+            taxonomy_fp = os.path.join(dir_, 'missing.bin')
+
+            for workers in (1, 3):
+                observed = identify_informative_hits.count_informative_hits(
+                    self.taxonomy, taxonomy_fp, identified_taxa_fp, 1,
+                    workers, dir_)
+                self.assertEqual(observed, expected)
+
+            # Reads are counted a batch at a time
+            hit_batch_size = identify_informative_hits.HIT_BATCH_SIZE
+            identify_informative_hits.HIT_BATCH_SIZE = 4
+            try:
+                observed = identify_informative_hits.count_informative_hits(
+                    self.taxonomy, taxonomy_fp, identified_taxa_fp, 1, 1,
+                    dir_)
+            finally:
+                identify_informative_hits.HIT_BATCH_SIZE = hit_batch_size
+            self.assertEqual(observed, expected)
+
+    def test_worker_loads_taxonomy_once(self):
+        with tempfile.TemporaryDirectory() as dir_:
+            identified_taxa_fp = os.path.join(dir_, 'identified_taxa.txt')
+            with open(identified_taxa_fp, mode='w') as fh:
+                fh.write("read1:8\nread2:8,10\nread3:12\n")
+            size = os.path.getsize(identified_taxa_fp)
+            expected = identify_informative_hits._count_shard(
+                self.taxonomy, identified_taxa_fp, 0, size, 1)
+
+            with mock.patch.object(identify_informative_hits,
+                                   '_worker_taxonomy', (None, None)), \
+                    mock.patch.object(Taxonomy, 'load',
+                                      return_value=self.taxonomy) as load:
+                for _ in range(2):
+                    self.assertEqual(
+                        identify_informative_hits._count_worker_shard(
+                            'taxonomy.bin', identified_taxa_fp, 0, size, 1),
+                        expected)
+            load.assert_called_once_with('taxonomy.bin')
+
+    def test_read_identified_taxa(self):
+        with tempfile.TemporaryDirectory() as dir_:
+            identified_taxa = IdentifiedTaxa.declare(dir_, None)
+            with open(identified_taxa.identified_taxa_file, mode='w') as fh:
+                fh.write("read1:8\nread2:\nread3:10,13:13,8\n")
+
+            reads = identified_taxa.read_identified_taxa()
+            self.assertEqual(next(reads), ('read1', ['8']))
+            self.assertEqual(list(reads), [('read3', ['10', '13', '8'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,45 @@
+import concurrent.futures
+import contextlib
+import itertools
+import operator
+import os
+import shlex
 import subprocess
+import tempfile
+import threading
 
+from yax.shared.utilities.file_cache import FileCache
+from yax.shared.utilities.file_chunks import split_file
 
-def build_index(fasta_fp, index_fp):
+# Executables run by this module
+BOWTIE2 = "bowtie2"
+BOWTIE2_BUILD = "bowtie2-build"
+
+# Prefix of the files of a cached index, inside its cache entry
+CACHED_INDEX_NAME = "index"
+
+# A sharded index is made of the indexes index_fp + SHARD_SUFFIX % n, listed
+# in index_fp + SHARDS_MANIFEST_SUFFIX
+SHARD_SUFFIX = ".shard%d"
+SHARDS_MANIFEST_SUFFIX = ".shards"
+
+# SAM flags
+SAM_UNMAPPED = 0x4
+SAM_SECONDARY = 0x100
+
+
+def build_index(fasta_fp, index_fp, build_args="", threads=1, shards=1):
     """Builds bowtie2 index file set
 
     Requiring a fasta file to build from and index_fp as a destination for the
     created index file set `build_index` creates a bowtie2 index file set
 
+    With several `shards` the references are split, at record boundaries,
+    into that many parts which are indexed separately and at the same time.
+    The shards are listed in a manifest at `index_fp` + ``.shards``, which
+    `index_shards` reads and `call_bt2_align` uses to align against every
+    shard and merge the results.
+
     Parameters
     ----------
     fasta_fp : str
@@ -15,15 +48,139 @@ def build_index(fasta_fp, index_fp):
     index_fp : str
         absolute path to the location where the index file set should exist
 
+    build_args : str, optional
+        additional bowtie2-build options, split like a shell would
+
+    threads : int, optional
+        number of threads to build with, shared between the shards; with
+        fewer threads than shards, that many shards are built at a time
+
+    shards : int, optional
+        number of indexes to split the references into; small files may
+        give fewer
+
     Returns
     -------
     None
         Only the bowtie2 index file set is genenerated
 
+    Raises
+    ------
+    subprocess.CalledProcessError
+        Raised when bowtie2-build fails.
+
+    """
+    ranges = split_file(fasta_fp, shards, b">") if shards > 1 else []
+    if len(ranges) <= 1:
+        _run(_build_command(fasta_fp, index_fp, build_args, threads))
+        return
+
+    shard_fps = [index_fp + SHARD_SUFFIX % shard
+                 for shard in range(len(ranges))]
+    # At most `threads` shards are built at once, so the build stays within
+    # its thread budget
+    concurrency = max(1, min(len(ranges), threads))
+    shard_threads = max(1, threads // concurrency)
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(index_fp))) as temp_dir, \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=concurrency) as executor:
+        futures = []
+        for shard, (start, end) in enumerate(ranges):
+            shard_fasta_fp = os.path.join(temp_dir, "%d.fasta" % shard)
+            _copy_range(fasta_fp, start, end, shard_fasta_fp)
+            futures.append(executor.submit(
+                _run, _build_command(shard_fasta_fp, shard_fps[shard],
+                                     build_args, shard_threads)))
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    # The manifest is written last, so an index with a manifest is complete
+    with open(index_fp + SHARDS_MANIFEST_SUFFIX + ".tmp", mode='w') as fh:
+        for shard_fp in shard_fps:
+            fh.write(os.path.basename(shard_fp) + "\n")
+    os.replace(index_fp + SHARDS_MANIFEST_SUFFIX + ".tmp",
+               index_fp + SHARDS_MANIFEST_SUFFIX)
+
+
+def index_shards(index_fp):
+    """Lists the indexes making up an index built by `build_index`.
+
+    Returns
+    -------
+    list of str
+        the index of every shard, or just `index_fp` if it is not sharded
+
+    """
+    try:
+        with open(index_fp + SHARDS_MANIFEST_SUFFIX) as fh:
+            names = [line.rstrip("\n") for line in fh if line.strip()]
+    except FileNotFoundError:
+        return [index_fp]
+    directory = os.path.dirname(index_fp)
+    return [os.path.join(directory, name) for name in names]
+
+
+def _build_command(fasta_fp, index_fp, build_args, threads):
+    command = [BOWTIE2_BUILD] + shlex.split(build_args or "")
+    if threads > 1:
+        command += ["--threads", str(threads)]
+    return command + [fasta_fp, index_fp]
+
+
+def _copy_range(input_fp, start, end, output_fp):
+    with open(input_fp, mode='rb') as fh, open(output_fp, mode='wb') as out:
+        fh.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = fh.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            out.write(block)
+            remaining -= len(block)
+
+
+def cached_index(fasta_fp, cache_dir, build_args="", threads=1, shards=1,
+                 pins=None):
+    """Returns a bowtie2 index of a FASTA file, building it only if needed.
+
+    Indexes are kept in a `file_cache.FileCache`, keyed by the contents of
+    `fasta_fp`, `build_args` and `shards`, so an index is shared by every
+    sample and run aligning to the same references.
+
+    Parameters
+    ----------
+    fasta_fp : str
+        FASTA file of the references to index
+    cache_dir : str
+        the cache directory
+    build_args : str, optional
+        additional bowtie2-build options, split like a shell would
+    threads : int, optional
+        number of threads to build with
+    shards : int, optional
+        number of indexes to split the references into, see `build_index`
+    pins : contextlib.ExitStack, optional
+        keeps the index from being evicted from the cache, by this or another
+        run, until the stack is closed; see `FileCache.pin`
+
+    Returns
+    -------
+    str
+        the index, as given to `call_bt2_align`
 
     """
-    subprocess.call([" ".join(["bowtie2-build", fasta_fp, index_fp])],
-                    shell=True)
+    cache = FileCache(cache_dir)
+    key = cache.content_key("bowtie2-index", [fasta_fp],
+                            " ".join(shlex.split(build_args or "")), shards)
+
+    def write(index_dir):
+        build_index(fasta_fp, os.path.join(index_dir, CACHED_INDEX_NAME),
+                    build_args, threads, shards)
+
+    return os.path.join(cache.get_or_create(key, write, directory=True,
+                                            pins=pins),
+                        CACHED_INDEX_NAME)
 
 
 def call_bt2_wrapper(allowed_edits,
@@ -58,44 +215,343 @@ def call_bt2_wrapper(allowed_edits,
     None
         Produces an output file containing that results of bowtie2 alignment
 
+    Raises
+    ------
+    subprocess.CalledProcessError
+        Raised when the wrapper fails.
+
     """
-    subprocess.call([" ".join(["srun /common/contrib/bin/"
-                               "bowtie2_mg_aligner "
-                               "-e", allowed_edits,
-                               "-q", reads_fp,
-                               "-i", index_fp,
-                               "-o", output_fp,
-                               "-p", allowed_threads])],
-                    shell=True)
+    _run(["srun", "/common/contrib/bin/bowtie2_mg_aligner",
+          "-e", str(allowed_edits),
+          "-q", reads_fp,
+          "-i", index_fp,
+          "-o", output_fp,
+          "-p", str(allowed_threads)])
 
 
-def call_bt2_align(read_seqs,
+def call_bt2_align(reads_fp,
                    index_fp,
                    output_fp,
-                   bowtie_args):
-    """Uses the metagenomic wrapper to run bowtie2 alignment.
-
-    The metagenomic wrapper is used to catch the output of bowtie2 and present
-    a format that matches each read to the taxids it aligned to in order of
-    edit distance.
+                   bowtie_args,
+                   threads=None):
+    """Runs bowtie2 alignment of a FASTA file of reads to a SAM file.
 
-    Please note that this code is designed specifcally to operate with a SLURM
-    task management tool.
+    The reads of a sharded index (see `build_index`) are aligned against
+    every shard and the outputs are merged by `merge_sam`. `threads` is the
+    budget of the whole alignment: when it covers every shard, they are
+    aligned at once with an even share of it and their outputs merged as
+    they stream in. Otherwise `threads` shards (one without `threads`) are
+    aligned at a time, single threaded, to temporary SAM files which are
+    merged at the end.
 
     Parameters
     ----------
-    reads_seqs : str
-        comma separated list of sequences
+    reads_fp : str
+        absolute path to the FASTA file containing the reads to align
     index_fp : str
         absolute path to the index file set previously computed
     output_fp : str
         absolute path to location and file name where output will be written
+    bowtie_args : str
+        additional bowtie2 options, split like a shell would
+    threads : int, optional
+        number of alignment threads, overriding any ``-p`` of `bowtie_args`
+
     Returns
     -------
     None
         Produces an output file containing that results of bowtie2 alignment
 
+    Raises
+    ------
+    subprocess.CalledProcessError
+        Raised when bowtie2 fails.
+
     """
-    subprocess.call([" ".join(["bowtie2", bowtie_args, index_fp, "-c",
-                               read_seqs, "-S", output_fp])],
-                    shell=True)
+    shard_fps = index_shards(index_fp)
+    if len(shard_fps) == 1:
+        _run(bt2_align_command(index_fp, reads_fp, output_fp, bowtie_args,
+                               threads))
+        return
+
+    # Every shard must report the reads in the same order to be merged
+    shard_args = (bowtie_args or "") + " --reorder"
+    if threads is not None and threads >= len(shard_fps):
+        with contextlib.ExitStack() as stack:
+            streams = [stack.enter_context(contextlib.closing(
+                           iter_bt2_align(shard_fp, reads_fp, shard_args,
+                                          threads // len(shard_fps))))
+                       for shard_fp in shard_fps]
+            with open(output_fp, mode='w') as output:
+                output.writelines(merge_sam(streams))
+        return
+
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(output_fp))) as temp_dir, \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=threads or 1) as executor:
+        shard_sam_fps = [os.path.join(temp_dir, "%d.sam" % shard)
+                         for shard in range(len(shard_fps))]
+        futures = [executor.submit(
+                       _run, bt2_align_command(
+                           shard_fp, reads_fp, shard_sam_fp, shard_args,
+                           None if threads is None else 1))
+                   for shard_fp, shard_sam_fp in zip(shard_fps,
+                                                     shard_sam_fps)]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+        with contextlib.ExitStack() as stack:
+            streams = [stack.enter_context(open(shard_sam_fp))
+                       for shard_sam_fp in shard_sam_fps]
+            with open(output_fp, mode='w') as output:
+                output.writelines(merge_sam(streams))
+
+
+def merge_sam(streams):
+    """Merges the SAM output of aligning the same reads to several indexes.
+
+    Each stream must hold the records of the same reads in the same order,
+    as bowtie2 writes them with ``--reorder``. For each read, the alignments
+    with the best ``AS:i`` score over all streams are kept, as many as the
+    most any one stream reported for it, preferring earlier streams on ties.
+    The first kept is the primary alignment, the others are flagged
+    secondary. A read aligned by no stream keeps its unaligned record from
+    the first stream.
+
+    Each stream only scored its own references, so the primary's ``XS:i`` is
+    raised to the best score of the other streams, and when that ties its
+    ``AS:i`` the read is not unique and its ``MAPQ`` is lowered to at most 1,
+    as bowtie2 reports equally good alignments. ``MAPQ`` and ``XS:i`` are
+    otherwise left as reported by the stream each alignment came from.
+
+    The header is the ``@HD`` line of the first stream, the ``@SQ`` lines of
+    every stream, then the remaining header lines of the first stream.
+
+    Parameters
+    ----------
+    streams : list of iterable of str
+        the SAM lines of each alignment
+
+    Yields
+    ------
+    str
+        the merged SAM lines
+
+    Raises
+    ------
+    ValueError
+        Raised when the streams do not hold the same reads.
+
+    """
+    headers, records = zip(*(_split_sam_header(iter(stream))
+                             for stream in streams))
+    yield from (line for line in headers[0] if line.startswith("@HD"))
+    for header in headers:
+        yield from (line for line in header if line.startswith("@SQ"))
+    yield from (line for line in headers[0]
+                if not line.startswith(("@HD", "@SQ")))
+
+    reads = [itertools.groupby(stream, key=_sam_qname) for stream in records]
+    for groups in itertools.zip_longest(*reads):
+        if None in groups or len({name for name, _ in groups}) != 1:
+            raise ValueError("The alignments do not hold the same reads.")
+        groups = [list(group) for _, group in groups]
+        yield from _best_alignments(groups)
+
+
+def _split_sam_header(stream):
+    header = []
+    for line in stream:
+        if not line.startswith("@"):
+            return header, itertools.chain([line], stream)
+        header.append(line)
+    return header, iter(())
+
+
+def _sam_qname(line):
+    return line.split("\t", 1)[0]
+
+
+def _best_alignments(groups):
+    mapped = [(_alignment_score(record), stream, record)
+              for stream, records in enumerate(groups) for record in records
+              if not int(record.split("\t", 2)[1]) & SAM_UNMAPPED]
+    if not mapped:
+        return groups[0][:1]
+    # sorted is stable, so ties keep the earliest stream first
+    mapped.sort(key=operator.itemgetter(0), reverse=True)
+    best = [_set_secondary(record, position > 0)
+            for position, (_, __, record) in enumerate(
+                mapped[:max(len(records) for records in groups)])]
+
+    score, primary_stream, _ = mapped[0]
+    other_scores = [other_score for other_score, stream, _ in mapped
+                    if stream != primary_stream]
+    if other_scores:
+        best[0] = _set_second_best(best[0], score, max(other_scores))
+    return best
+
+
+def _alignment_score(record):
+    for field in record.rstrip("\n").split("\t")[11:]:
+        if field.startswith("AS:i:"):
+            return int(field[5:])
+    return float("-inf")
+
+
+def _set_second_best(record, score, second_score):
+    fields = record.rstrip("\n").split("\t")
+    for position, field in enumerate(fields[11:], 11):
+        if field.startswith("XS:i:"):
+            second_score = max(second_score, int(field[5:]))
+            del fields[position]
+            break
+    fields.append("XS:i:%d" % second_score)
+    if second_score >= score:
+        fields[4] = str(min(int(fields[4]), 1))
+    return "\t".join(fields) + "\n"
+
+
+def _set_secondary(record, secondary):
+    fields = record.split("\t")
+    flag = int(fields[1]) & ~SAM_SECONDARY
+    fields[1] = str(flag | SAM_SECONDARY if secondary else flag)
+    return "\t".join(fields)
+
+
+def bt2_threads(bowtie_args):
+    """Finds the number of threads bowtie2 options ask for.
+
+    Parameters
+    ----------
+    bowtie_args : str
+        bowtie2 options, split like a shell would
+
+    Returns
+    -------
+    int or None
+        the value of the last ``-p``/``--threads`` option, None if there is
+        none
+
+    """
+    threads = None
+    args = shlex.split(bowtie_args or "")
+    for position, arg in enumerate(args):
+        if arg in ("-p", "--threads") and position + 1 < len(args):
+            threads = int(args[position + 1])
+        elif arg.startswith("--threads="):
+            threads = int(arg[len("--threads="):])
+        elif arg.startswith("-p") and arg[2:].isdigit():
+            threads = int(arg[2:])
+    return threads
+
+
+def bt2_align_command(index_fp, reads_fp="-", output_fp=None, bowtie_args="",
+                      threads=None):
+    """Builds the argument list of a bowtie2 alignment of FASTA reads.
+
+    Parameters
+    ----------
+    index_fp : str
+        the bowtie2 index to align against
+    reads_fp : str, optional
+        FASTA file of the reads, ``-`` (the default) to read them from stdin
+    output_fp : str, optional
+        SAM file to write, None to write the alignments to stdout
+    bowtie_args : str, optional
+        additional bowtie2 options, split like a shell would
+    threads : int, optional
+        number of alignment threads, passed as ``-p``
+
+    Returns
+    -------
+    list of str
+
+    """
+    command = [BOWTIE2] + shlex.split(bowtie_args or "")
+    if threads is not None:
+        command += ["-p", str(threads)]
+    command += ["-x", index_fp, "-f", "-U", reads_fp]
+    if output_fp is not None:
+        command += ["-S", output_fp]
+    return command
+
+
+def iter_bt2_align(index_fp, reads, bowtie_args="", threads=None):
+    """Streams the SAM output of a bowtie2 alignment.
+
+    Lines are yielded as bowtie2 writes them, so they can be processed while
+    the alignment is still running.
+
+    Parameters
+    ----------
+    index_fp : str
+        the bowtie2 index to align against
+    reads : str or iterable of str
+        a FASTA file of reads, or FASTA lines which are piped to bowtie2
+    bowtie_args : str, optional
+        additional bowtie2 options, split like a shell would
+    threads : int, optional
+        number of alignment threads, passed as ``-p``
+
+    Yields
+    ------
+    str
+        each SAM line, header lines included
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        Raised once the output is exhausted if bowtie2 failed.
+
+    """
+    pipe_reads = not isinstance(reads, str)
+    command = bt2_align_command(index_fp, "-" if pipe_reads else reads,
+                                None, bowtie_args, threads)
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            command, stdin=subprocess.PIPE if pipe_reads else None,
+            stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
+        writer = None
+        if pipe_reads:
+            # Feed the reads from another thread, so bowtie2 never blocks on
+            # a full stdout pipe while we block on a full stdin pipe
+            writer = threading.Thread(target=_write_lines,
+                                      args=(process.stdin, reads))
+            writer.start()
+        try:
+            yield from process.stdout
+        finally:
+            process.stdout.close()
+            if writer is not None:
+                writer.join()
+            returncode = process.wait()
+        if returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(
+                returncode, command, stderr=stderr.read().decode())
+
+
+def _write_lines(fh, lines):
+    try:
+        for line in lines:
+            fh.write(line)
+    except BrokenPipeError:
+        # bowtie2 exited early; its exit status tells why
+        pass
+    finally:
+        try:
+            fh.close()
+        except BrokenPipeError:
+            pass
+
+
+def _run(command):
+    """Runs a command, raising CalledProcessError with its stderr if it
+    fails."""
+    result = subprocess.run(command, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, command,
+                                            output=result.stdout,
+                                            stderr=result.stderr)
@@ -0,0 +1,406 @@
+import array
+import bisect
+import gzip
+import heapq
+import itertools
+import mmap
+import operator
+import os
+import struct
+import zlib
+
+# On-disk layout of a FASTA index: a header recording the size and mtime of
+# the indexed FASTA file, followed by three native arrays of `count` entries:
+# the gis in ascending order, the byte offset of each record and its length
+# in bytes (header line included).
+INDEX_MAGIC = b"YAXFAIDX"
+INDEX_VERSION = 1
+# Suffix of the default location of the index of a FASTA file
+INDEX_SUFFIX = ".gidx"
+_INDEX_HEADER = struct.Struct("=8sIxxxxQqQ")
+# build_fasta_index sorts the gis of a FASTA file not in gi order this many
+# at a time.
+INDEX_SORT_CHUNK = 1 << 18
+
+# FastaWriter buffers output and writes it in blocks of this many bytes.
+WRITE_BLOCK_SIZE = 1 << 20
+
+# BGZF (blocked gzip, as written by bgzip and htslib) is a series of gzip
+# members of at most 64 KiB each, carrying their compressed size in a "BC"
+# extra field, and terminated by an empty member.
+BGZF_BLOCK_SIZE = 0xff00
+_BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+_BGZF_FOOTER = struct.Struct("<II")
+_BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b00"
+                          "03000000000000000000")
+COMPRESSIONS = (None, "gzip", "bgzip")
+
+
+def get_header_gi(header):
+    """Extracts the gi from an NCBI FASTA header line.
+
+    Parameters
+    ----------
+    header : str or bytes
+        a header line such as ``>ACCESSION GI:40 Node4``
+
+    Returns
+    -------
+    str or bytes
+        the gi, of the same type as `header`
+
+    """
+    separator, colon = (" ", ":") if isinstance(header, str) else (b" ", b":")
+    return header.split(separator)[1].split(colon)[1]
+
+
+class FastaIndex:
+    """Byte offset and length of every record of a FASTA file, by gi.
+
+    Attributes
+    ----------
+    gis, offsets, lengths : array or memoryview
+        parallel arrays sorted by gi
+
+    """
+    def __init__(self, gis, offsets, lengths):
+        self.gis = gis
+        self.offsets = offsets
+        self.lengths = lengths
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.gis)
+
+    def __contains__(self, gi):
+        return self.locate(gi) is not None
+
+    def locate(self, gi):
+        """Finds the record of a gi.
+
+        Parameters
+        ----------
+        gi : str or int
+            the gi to look up
+
+        Returns
+        -------
+        (int, int) or None
+            byte offset and length of the record, None if `gi` has no record
+
+        """
+        try:
+            value = int(gi)
+        except (TypeError, ValueError):
+            return None
+        position = bisect.bisect_left(self.gis, value)
+        if position == len(self.gis) or self.gis[position] != value:
+            return None
+        return self.offsets[position], self.lengths[position]
+
+
+def build_fasta_index(sequences_fp):
+    """Scans a FASTA file for the location of each record.
+
+    The gi, offset and length of each record are collected in arrays. Unless
+    the file is already in gi order, the gis are then sorted
+    `INDEX_SORT_CHUNK` at a time into runs, which are merged, so only one
+    chunk at a time exists as Python integers. Each gi is packed with the
+    record's position in the file into one integer, ordered like the pair, so
+    sorting and merging need no key function and records sharing a gi keep
+    their order in the file.
+
+    Parameters
+    ----------
+    sequences_fp : str
+        location of an NCBI FASTA formatted file
+
+    Returns
+    -------
+    FastaIndex
+
+    """
+    gis = array.array('q')
+    offsets = array.array('q')
+    lengths = array.array('q')
+    offset = 0
+    start = None
+    with open(sequences_fp, mode='rb') as fh:
+        for line in fh:
+            if line[:1] == b">":
+                if start is not None:
+                    lengths.append(offset - start)
+                gis.append(int(get_header_gi(line)))
+                offsets.append(offset)
+                start = offset
+            offset += len(line)
+    if start is not None:
+        lengths.append(offset - start)
+
+    if _is_sorted(gis):
+        return FastaIndex(gis, offsets, lengths)
+
+    runs = []
+    for start in range(0, len(gis), INDEX_SORT_CHUNK):
+        end = start + INDEX_SORT_CHUNK
+        runs.append(_unpack_records(sorted(_pack_records(
+            gis[start:end], range(start, min(end, len(gis)))))))
+    del gis
+
+    sorted_gis = array.array('q')
+    sorted_offsets = array.array('q')
+    sorted_lengths = array.array('q')
+    merged = heapq.merge(*(_pack_records(*run) for run in runs))
+    while True:
+        block = list(itertools.islice(merged, INDEX_SORT_CHUNK))
+        if not block:
+            break
+        block_gis, positions = _unpack_records(block)
+        sorted_gis.extend(block_gis)
+        sorted_offsets.extend(map(offsets.__getitem__, positions))
+        sorted_lengths.extend(map(lengths.__getitem__, positions))
+    return FastaIndex(sorted_gis, sorted_offsets, sorted_lengths)
+
+
+def _is_sorted(values):
+    return all(map(operator.le, values, itertools.islice(values, 1, None)))
+
+
+def _pack_records(gis, positions):
+    """Packs each gi with its record's position into one integer which sorts
+    like the pair; positions fit in 32 bits."""
+    return map(operator.or_, map(operator.lshift, gis, itertools.repeat(32)),
+               positions)
+
+
+def _unpack_records(packed):
+    """Splits integers packed by `_pack_records` back into arrays of gis and
+    record positions."""
+    return (array.array('q', map(operator.rshift, packed,
+                                 itertools.repeat(32))),
+            array.array('I', map(operator.and_, packed,
+                                 itertools.repeat(0xffffffff))))
+
+
+def write_fasta_index(fasta_index, sequences_fp, index_fp):
+    """Writes a FastaIndex of `sequences_fp`, stamped with its size and mtime.
+
+    The index is written next to `index_fp` and moved into place once
+    complete.
+    """
+    stat = os.stat(sequences_fp)
+    temp_fp = index_fp + ".tmp"
+    with open(temp_fp, mode='wb') as fh:
+        fh.write(_INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, stat.st_size,
+                                    stat.st_mtime_ns, len(fasta_index)))
+        for values in (fasta_index.gis, fasta_index.offsets,
+                       fasta_index.lengths):
+            fh.write(memoryview(values).cast('B'))
+    os.replace(temp_fp, index_fp)
+
+
+def load_fasta_index(sequences_fp, index_fp):
+    """Memory maps the FastaIndex of `sequences_fp` if it is still current.
+
+    Returns
+    -------
+    FastaIndex or None
+        None if there is no index at `index_fp`, or it was built from a
+        different version (size or mtime) of `sequences_fp`
+
+    """
+    if not os.path.isfile(index_fp):
+        return None
+    with open(index_fp, mode='rb') as fh:
+        header = fh.read(_INDEX_HEADER.size)
+        if len(header) < _INDEX_HEADER.size:
+            return None
+        magic, version, size, mtime_ns, count = \
+            _INDEX_HEADER.unpack(header)
+        stat = os.stat(sequences_fp)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or \
+                size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+            return None
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    buffer = memoryview(mapped)
+    arrays = []
+    offset = _INDEX_HEADER.size
+    for _ in range(3):
+        arrays.append(buffer[offset:offset + 8 * count].cast('q'))
+        offset += 8 * count
+    fasta_index = FastaIndex(*arrays)
+    fasta_index._mmap = mapped
+    return fasta_index
+
+
+def open_fasta_index(sequences_fp, index_fp=None):
+    """Returns the FastaIndex of a FASTA file, building it when needed.
+
+    The index is cached in a file, by default next to the FASTA file, and
+    rebuilt whenever the size or mtime of the FASTA file changes. If the
+    index cannot be written there, e.g. in a read-only reference directory,
+    the index just built is still returned.
+
+    Parameters
+    ----------
+    sequences_fp : str
+        location of an NCBI FASTA formatted file
+    index_fp : str, optional
+        where to cache the index, defaults to `sequences_fp` + INDEX_SUFFIX
+
+    Returns
+    -------
+    FastaIndex
+
+    """
+    if index_fp is None:
+        index_fp = sequences_fp + INDEX_SUFFIX
+    fasta_index = load_fasta_index(sequences_fp, index_fp)
+    if fasta_index is None:
+        fasta_index = build_fasta_index(sequences_fp)
+        try:
+            write_fasta_index(fasta_index, sequences_fp, index_fp)
+        except OSError:
+            if os.path.exists(index_fp + ".tmp"):
+                os.remove(index_fp + ".tmp")
+    return fasta_index
+
+
+def iter_indexed_records(sequences_fp, fasta_index, gis):
+    """Reads the records of `gis` from a FASTA file by seeking to them.
+
+    Records are read in the order they appear in the file; gis without a
+    record are skipped.
+
+    Parameters
+    ----------
+    sequences_fp : str
+        location of the indexed FASTA file
+    fasta_index : FastaIndex
+        index of `sequences_fp`
+    gis : iterable of str or bytes
+        gis of the records to read
+
+    Yields
+    ------
+    (str or bytes, bytes)
+        gi, as given in `gis`, and the bytes of its record, header line
+        included
+
+    """
+    locations = []
+    for gi in gis:
+        location = fasta_index.locate(gi)
+        if location is not None:
+            locations.append((location, gi))
+    locations.sort()
+
+    with open(sequences_fp, mode='rb') as fh:
+        for (offset, length), gi in locations:
+            fh.seek(offset)
+            yield gi, fh.read(length)
+
+
+class FastaWriter:
+    """Buffered binary FASTA writer.
+
+    Records are appended to an in-memory buffer as byte strings and written
+    out in blocks of `block_size` bytes, so writing a record costs no system
+    call, and record bodies can be copied from the input as a single slice.
+    The output may be gzip or BGZF compressed.
+
+    Parameters
+    ----------
+    output_fp : str
+        location of the FASTA file to write
+    compression : {None, "gzip", "bgzip"}, optional
+        how to compress the output
+    block_size : int, optional
+        number of bytes to buffer between writes
+
+    """
+    def __init__(self, output_fp, compression=None,
+                 block_size=WRITE_BLOCK_SIZE):
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression %r, expected one of %r."
+                             % (compression, COMPRESSIONS))
+        if compression == "bgzip":
+            block_size = max(block_size // BGZF_BLOCK_SIZE, 1) * \
+                BGZF_BLOCK_SIZE
+        self.compression = compression
+        self.block_size = block_size
+        self._buffer = bytearray()
+        if compression == "gzip":
+            self._fh = gzip.open(output_fp, mode='wb')
+        else:
+            self._fh = open(output_fp, mode='wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        """Appends raw bytes, e.g. sequence lines, to the output."""
+        self._buffer += data
+        if len(self._buffer) >= self.block_size:
+            self._flush(len(self._buffer) - len(self._buffer) %
+                        self.block_size)
+
+    def write_record(self, header, body):
+        """Appends a record.
+
+        Parameters
+        ----------
+        header : bytes
+            the header line, including the leading ``>`` and trailing newline
+        body : bytes
+            the sequence lines of the record, as they should be written
+
+        """
+        self.write(header)
+        self.write(body)
+
+    def copy_from(self, fh):
+        """Appends the remaining contents of a binary file object."""
+        while True:
+            data = fh.read(self.block_size)
+            if not data:
+                break
+            self.write(data)
+
+    def close(self):
+        if self._fh is None:
+            return
+        self._flush(len(self._buffer))
+        if self.compression == "bgzip":
+            self._fh.write(_BGZF_EOF)
+        self._fh.close()
+        self._fh = None
+
+    def _flush(self, size):
+        data = memoryview(self._buffer)[:size]
+        if self.compression == "bgzip":
+            for start in range(0, size, BGZF_BLOCK_SIZE):
+                self._fh.write(_bgzf_block(data[start:start +
+                                                BGZF_BLOCK_SIZE]))
+        else:
+            self._fh.write(data)
+        data.release()
+        del self._buffer[:size]
+
+
+def _bgzf_block(data):
+    """Compresses at most BGZF_BLOCK_SIZE bytes into one BGZF block."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    # The block size field holds the total size of the block minus one
+    block_size = (_BGZF_HEADER.size + len(compressed) +
+                  _BGZF_FOOTER.size - 1)
+    header = _BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"),
+                               ord("C"), 2, block_size)
+    footer = _BGZF_FOOTER.pack(zlib.crc32(data), len(data))
+    return header + compressed + footer
@@ -0,0 +1,245 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Total size the entries of a FileCache may take before the least recently
+# used ones are evicted.
+DEFAULT_MAX_SIZE = 16 << 30
+
+
+class FileCache:
+    """Directory of files derived from other files, shared between runs.
+
+    Entries are keyed by the identity of the files they were derived from
+    (their real path, size and modification time) so an entry is reused for
+    as long as its inputs are unchanged, whichever run or module asks for it.
+    Entries are published atomically, so concurrent runs never observe a
+    partially written entry; at worst both derive it. An entry is either a
+    file or a directory of files. Once the entries take more than `max_size`
+    bytes in total, the least recently used are removed, except for entries
+    pinned with `pin` by this or another run.
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory holding the entries, created if needed
+    max_size : int, optional
+        total size of the entries, in bytes, to evict down to
+
+    """
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, kind, input_fps, *extra):
+        """Builds the key of an entry.
+
+        Parameters
+        ----------
+        kind : str
+            what the entry holds, e.g. "taxonomy"; entries of different kinds
+            derived from the same files do not collide
+        input_fps : list of str
+            the files the entry is derived from
+        extra : str
+            anything else the entry depends on, such as options
+
+        Returns
+        -------
+        str
+            `kind` followed by a digest of the inputs
+
+        """
+        digest = hashlib.sha256()
+        for fp in input_fps:
+            stat = os.stat(fp)
+            digest.update(("%s\0%d\0%d\0" % (os.path.realpath(fp),
+                                             stat.st_size,
+                                             stat.st_mtime_ns)).encode())
+        for value in extra:
+            digest.update(("%s\0" % value).encode())
+        return "%s-%s" % (kind, digest.hexdigest())
+
+    def content_key(self, kind, input_fps, *extra):
+        """Builds the key of an entry from the contents of its inputs.
+
+        Unlike `key`, copies of the same input, or an input rewritten with the
+        same contents, map to the same entry, at the cost of reading the
+        inputs. Arguments are as for `key`.
+        """
+        digest = hashlib.sha256()
+        for fp in input_fps:
+            file_digest = hashlib.sha256()
+            with open(fp, mode='rb') as fh:
+                for block in iter(lambda: fh.read(1 << 20), b''):
+                    file_digest.update(block)
+            digest.update(file_digest.digest())
+        for value in extra:
+            digest.update(("%s\0" % value).encode())
+        return "%s-%s" % (kind, digest.hexdigest())
+
+    def path(self, key):
+        """Location of the entry `key`, whether it exists or not."""
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """Returns the location of the entry `key`, None if it is missing.
+
+        The entry is marked as just used.
+        """
+        fp = self.path(key)
+        try:
+            os.utime(fp)
+        except FileNotFoundError:
+            return None
+        return fp
+
+    def pin(self, key):
+        """Keeps the entry `key` from being evicted until the returned lock
+        is closed.
+
+        The pin is a shared `flock` on a lock file next to the entry, which
+        `evict` must lock exclusively to remove the entry and its lock file,
+        so it holds against other runs as well. The entry need not exist
+        yet: pin it before `get` so it cannot be evicted in between.
+
+        Returns
+        -------
+        file
+            the locked lock file; closing it, or leaving its ``with`` block,
+            unpins the entry
+
+        """
+        while True:
+            lock = open(self._lock_path(key), mode='a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                if _is_current(lock):
+                    return lock
+            except BaseException:
+                lock.close()
+                raise
+            # The entry was evicted while waiting for the lock
+            lock.close()
+
+    def put(self, key, write, directory=False):
+        """Creates the entry `key`.
+
+        Parameters
+        ----------
+        key : str
+            as returned by `key`
+        write : callable
+            called with a temporary location to write the entry to
+        directory : bool, optional
+            whether the entry is a directory, which `write` is given empty,
+            rather than a file
+
+        Returns
+        -------
+        str
+            location of the entry
+
+        """
+        if directory:
+            temp_fp = tempfile.mkdtemp(dir=self.cache_dir, prefix=".",
+                                       suffix=".tmp")
+        else:
+            fd, temp_fp = tempfile.mkstemp(dir=self.cache_dir, prefix=".",
+                                           suffix=".tmp")
+            os.close(fd)
+        try:
+            write(temp_fp)
+            try:
+                os.replace(temp_fp, self.path(key))
+            except OSError:
+                # A directory cannot replace a non-empty one: another run
+                # published the same entry first, so use theirs
+                if not directory or not os.path.isdir(self.path(key)):
+                    raise
+                _remove(temp_fp)
+        except BaseException:
+            if os.path.lexists(temp_fp):
+                _remove(temp_fp)
+            raise
+        self.evict(keep=key)
+        return self.path(key)
+
+    def get_or_create(self, key, write, directory=False, pins=None):
+        """Returns the location of the entry `key`, creating it with `write`
+        if it is missing.
+
+        With `pins`, a `contextlib.ExitStack`, the entry is pinned until the
+        stack is closed.
+        """
+        if pins is not None:
+            pins.enter_context(self.pin(key))
+        fp = self.get(key)
+        if fp is None:
+            fp = self.put(key, write, directory)
+        return fp
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until the cache fits in
+        `max_size`, never removing the entry `keep` or pinned entries."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("."):
+                continue
+            try:
+                stat = os.stat(self.path(name))
+                size = _entry_size(self.path(name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, size, name))
+
+        total = sum(size for _, size, __ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            with open(self._lock_path(name), mode='a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Pinned by a run which is using it
+                    continue
+                # Unless another run evicted it in the meantime
+                if _is_current(lock):
+                    try:
+                        _remove(self.path(name))
+                    except FileNotFoundError:
+                        pass
+                    os.remove(lock.name)
+            total -= size
+
+    def _lock_path(self, key):
+        # Hidden, like partially written entries, so it is not an entry
+        return os.path.join(self.cache_dir, "." + key + ".lock")
+
+
+def _is_current(lock):
+    # Whether `lock` is still the file at its path, rather than one removed
+    # by `evict` after it was opened
+    try:
+        return os.stat(lock.name).st_ino == os.fstat(lock.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _entry_size(fp):
+    if not os.path.isdir(fp):
+        return os.stat(fp).st_size
+    return sum(os.stat(os.path.join(root, name)).st_size
+               for root, _, names in os.walk(fp) for name in names)
+
+
+def _remove(fp):
+    if os.path.isdir(fp):
+        shutil.rmtree(fp)
+    else:
+        os.remove(fp)
@@ -0,0 +1,93 @@
+import os
+
+# Number of bytes scanned at a time while looking for a chunk boundary.
+SCAN_BLOCK_SIZE = 1 << 16
+
+
+def split_file(fp, num_chunks, record_start=b""):
+    """Splits a file into byte ranges which begin at the start of a record.
+
+    Records are assumed to start at the beginning of a line which begins with
+    `record_start`, e.g. every line for line based formats and lines starting
+    with ``>`` for FASTA. Each range can then be processed independently, by
+    a different process for instance, without any record being split.
+
+    Parameters
+    ----------
+    fp : str
+        location of the file to split
+    num_chunks : int
+        number of ranges to aim for; fewer are returned for small files
+    record_start : bytes, optional
+        prefix of the lines which start a record
+
+    Returns
+    -------
+    list of (int, int)
+        start (inclusive) and end (exclusive) offsets of each range, in file
+        order and covering the whole file
+
+    """
+    size = os.path.getsize(fp)
+    boundaries = [0]
+    with open(fp, mode='rb') as fh:
+        for chunk in range(1, num_chunks):
+            offset = max(size * chunk // num_chunks, boundaries[-1])
+            boundaries.append(_find_record_start(fh, offset, record_start,
+                                                 size))
+    boundaries.append(size)
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:])
+            if start < end]
+
+
+def _find_record_start(fh, offset, record_start, size):
+    """Finds the first record starting at or after `offset`."""
+    if offset == 0:
+        return 0
+    pattern = b"\n" + record_start
+    # Start one byte early so a record starting exactly at offset is found
+    position = offset - 1
+    fh.seek(position)
+    buffer = b""
+    while True:
+        block = fh.read(SCAN_BLOCK_SIZE)
+        if not block:
+            return size
+        buffer += block
+        found = buffer.find(pattern)
+        if found != -1:
+            return position + found + 1
+        # Keep enough of the buffer to match a pattern spanning two blocks
+        keep = len(pattern) - 1
+        position += len(buffer) - keep
+        buffer = buffer[len(buffer) - keep:]
+
+
+def iter_chunk_lines(fp, start, end):
+    """Yields the lines of the byte range `start`:`end` of a file.
+
+    Parameters
+    ----------
+    fp : str
+        location of the file
+    start : int
+        offset of the first line, as returned by `split_file`
+    end : int
+        offset just past the last line
+
+    Yields
+    ------
+    str
+        each line, including its line terminator
+
+    """
+    with open(fp, mode='rb') as fh:
+        fh.seek(start)
+        position = start
+        while position < end:
+            line = fh.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode()
@@ -1,29 +1,88 @@
 import collections
+import concurrent.futures
 import json
 import os
+import pickle
 
+from yax.shared.utilities import fastatool
+from yax.shared.utilities.file_chunks import split_file
 
-def parse_names_dmp(names_fp):
-    results = {}
-    with open(names_fp, mode='r') as fh:
-        lines = fh.readlines()
 
-    for line in lines:
+# Number of characters read from a dump file per chunk. Only one chunk of
+# lines is held in memory at a time, regardless of the size of the file.
+DMP_CHUNK_SIZE = 1 << 20
+
+
+def _iter_lines(fp, chunk_size=DMP_CHUNK_SIZE):
+    """Yields the lines of a file, reading `chunk_size` characters at a time.
+    """
+    with open(fp, mode='r') as fh:
+        while True:
+            lines = fh.readlines(chunk_size)
+            if not lines:
+                break
+            yield from lines
+
+
+def iter_names_dmp(names_fp, chunk_size=DMP_CHUNK_SIZE):
+    """Streams the scientific names out of a names.dmp file.
+
+    Parameters
+    ----------
+    names_fp : str
+        location of names.dmp file
+    chunk_size : int, optional
+        number of characters to read from the file at a time
+
+    Yields
+    ------
+    (str, str)
+        taxid and its scientific name
+
+    See Also
+    --------
+    parse_names_dmp
+
+    """
+    for line in _iter_lines(names_fp, chunk_size):
         line = line.rstrip('\t|\n')
         taxid, scientific_name, _, name_type = line.split("\t|\t", 4)
         if name_type == "scientific name":
-            results[taxid] = scientific_name
+            yield taxid, scientific_name
 
-    return results
 
+def parse_names_dmp(names_fp):
+    return dict(iter_names_dmp(names_fp))
 
-def parse_gi_taxid_dmp(gi_taxid_nucl_fp):
-    results = {}
-    with open(gi_taxid_nucl_fp, mode='r') as fh:
-        lines = fh.readlines()
 
-    for line in lines:
+def iter_gi_taxid_dmp(gi_taxid_nucl_fp, chunk_size=DMP_CHUNK_SIZE):
+    """Streams the gi to taxid associations out of a gi_taxid_nucl.dmp file.
+
+    Parameters
+    ----------
+    gi_taxid_nucl_fp : str
+        location of gi_taxid_nucl.dmp file
+    chunk_size : int, optional
+        number of characters to read from the file at a time
+
+    Yields
+    ------
+    (str, str)
+        gi and the taxid it belongs to
+
+    See Also
+    --------
+    parse_gi_taxid_dmp
+
+    """
+    for line in _iter_lines(gi_taxid_nucl_fp, chunk_size):
         gi, taxid = line.strip().split("\t")
+        yield gi, taxid
+
+
+def parse_gi_taxid_dmp(gi_taxid_nucl_fp):
+    results = {}
+    for gi, taxid in iter_gi_taxid_dmp(gi_taxid_nucl_fp):
         if taxid in results:
             results[taxid].append(gi)
         else:
@@ -39,17 +98,75 @@ NodeRecord = collections.namedtuple(
         "rank"))
 
 
-def parse_nodes_dmp(nodes_fp):
-    results = {}
-    with open(nodes_fp, mode='r') as fh:
-        lines = fh.readlines()
+def iter_nodes_dmp(nodes_fp, chunk_size=DMP_CHUNK_SIZE):
+    """Streams the records out of a nodes.dmp file.
+
+    Parameters
+    ----------
+    nodes_fp : str
+        location of nodes.dmp file
+    chunk_size : int, optional
+        number of characters to read from the file at a time
+
+    Yields
+    ------
+    NodeRecord
+        taxid, parent taxid and rank of each node in file order
 
-    for line in lines:
+    See Also
+    --------
+    parse_nodes_dmp
+
+    """
+    for line in _iter_lines(nodes_fp, chunk_size):
         taxid, parent_taxid, rank, _ = \
             line.split("\t|\t", 3)
-        results[taxid] = NodeRecord(taxid, parent_taxid, rank)
+        yield NodeRecord(taxid, parent_taxid, rank)
 
-    return results
+
+def parse_nodes_dmp(nodes_fp):
+    return {record.taxid: record for record in iter_nodes_dmp(nodes_fp)}
+
+
+def iter_delnodes_dmp(delnodes_fp, chunk_size=DMP_CHUNK_SIZE):
+    """Streams the deleted taxids out of a delnodes.dmp file.
+
+    Parameters
+    ----------
+    delnodes_fp : str
+        location of delnodes.dmp file
+    chunk_size : int, optional
+        number of characters to read from the file at a time
+
+    Yields
+    ------
+    str
+        each deleted taxid
+
+    """
+    for line in _iter_lines(delnodes_fp, chunk_size):
+        yield line.rstrip('\t|\n')
+
+
+def iter_merged_dmp(merged_fp, chunk_size=DMP_CHUNK_SIZE):
+    """Streams the merged taxids out of a merged.dmp file.
+
+    Parameters
+    ----------
+    merged_fp : str
+        location of merged.dmp file
+    chunk_size : int, optional
+        number of characters to read from the file at a time
+
+    Yields
+    ------
+    (str, str)
+        old taxid and the taxid it was merged into
+
+    """
+    for line in _iter_lines(merged_fp, chunk_size):
+        old_taxid, new_taxid = line.rstrip('\t|\n').split("\t|\t")
+        yield old_taxid, new_taxid
 
 
 TaxIDDataRecord = collections.namedtuple(
@@ -85,16 +202,13 @@ def parse_taxid_data(input_taxid_data_fp):
 
     """
     results = {}
-    with open(input_taxid_data_fp, mode='r') as fh:
-        lines = fh.readlines()
-
-    for line in lines:
+    for line in _iter_lines(input_taxid_data_fp):
         taxid, sci_name, assoc_gis, children, ancestors, rank = \
             line.rstrip().split("\t")
 
-        assoc_gis = json.loads(assoc_gis)
-        children = json.loads(children)
-        ancestors = json.loads(ancestors)
+        assoc_gis = decode_id_list(assoc_gis)
+        children = decode_id_list(children)
+        ancestors = decode_id_list(ancestors)
 
         results[taxid] = TaxIDDataRecord(taxid, sci_name, assoc_gis,
                                          children, ancestors, rank)
@@ -102,6 +216,27 @@ def parse_taxid_data(input_taxid_data_fp):
     return results
 
 
+def decode_id_list(field):
+    """Decodes a list of ids written by `write_taxid_data`.
+
+    The lists are JSON arrays of digit strings, e.g. ``["1", "2"]``, so they
+    are split directly instead of going through a JSON parser.
+
+    Parameters
+    ----------
+    field : str
+        the encoded list
+
+    Returns
+    -------
+    list of str
+
+    """
+    if field == "[]":
+        return []
+    return field[1:-1].replace('"', '').replace(' ', '').split(',')
+
+
 def build_taxid_data(nodes_fp, names_fp, gi_taxid_nucl_fp):
     """Builds taxid_data.
 
@@ -141,31 +276,65 @@ def build_taxid_data(nodes_fp, names_fp, gi_taxid_nucl_fp):
     if not (len(nodes) == len(names) >= len(taxid_gi)):
         raise ValueError("NCBI dump files do not make sense")
 
+    children = {taxid: [] for taxid in nodes}
+    for node_record in nodes.values():
+        if node_record.taxid == '1':
+            continue
+        children[node_record.parent_taxid].append(node_record.taxid)
+
+    lineages = build_lineages(nodes, children)
+    if len(lineages) != len(nodes):
+        raise ValueError("NCBI dump files do not make sense")
+
     taxid_data = {}
     for taxid in nodes:
-        children = []
-        parents = []
         taxid_data[taxid] = TaxIDDataRecord(taxid,
                                             names[taxid],
                                             taxid_gi.get(taxid, []),
-                                            children,
-                                            parents,
+                                            children[taxid],
+                                            lineages[taxid],
                                             nodes[taxid].rank)
 
-        current_taxid = taxid
+    return taxid_data
+
+
+def build_lineages(nodes, children):
+    """Builds the list of ancestors of every taxid.
+
+    The tree is traversed once from its root(s) down, and each lineage is
+    extended from the lineage of its parent, so the work done is linear in
+    the total size of the lineages rather than quadratic in their depth.
+
+    Parameters
+    ----------
+    nodes : dict of tax_id to NodeRecord
+        as returned by `parse_nodes_dmp`
+    children : dict of tax_id to list
+        the child taxids of each taxid
 
-        while nodes[current_taxid].taxid != \
-                nodes[current_taxid].parent_taxid:
-            parents.insert(0, nodes[current_taxid].parent_taxid)
-            current_taxid = nodes[current_taxid].parent_taxid
+    Returns
+    -------
+    dict of tax_id to list
+        the ancestors of each taxid, root first and excluding the taxid
+        itself
 
+    """
+    lineages = {}
+    to_visit = []
     for node_record in nodes.values():
-        if node_record.taxid == '1':
-            continue
-        taxid_data[node_record.parent_taxid].children.\
-            append(node_record.taxid)
+        if node_record.taxid == node_record.parent_taxid:
+            lineages[node_record.taxid] = []
+            to_visit.append(node_record.taxid)
 
-    return taxid_data
+    while to_visit:
+        taxid = to_visit.pop()
+        lineage = lineages[taxid] + [taxid]
+        for child_taxid in children[taxid]:
+            if child_taxid != taxid:
+                lineages[child_taxid] = lineage[:]
+                to_visit.append(child_taxid)
+
+    return lineages
 
 
 def write_taxid_data(taxid_data, output_fp):
@@ -225,9 +394,15 @@ def build_tree(taxid_data, sequences_input_fp, inclusion_roots,
     Returns
     -------
     inclusion_tree : dict
-        similar to taxid_data but only representing the taxids of interest
+        similar to taxid_data but only representing the taxids of interest;
+        a SubtreeView when `taxid_data` is a Taxonomy
 
     """
+    # Imported here as the taxonomy module builds on this one
+    from yax.shared.utilities.taxonomy import Taxonomy
+    if isinstance(taxid_data, Taxonomy):
+        return taxid_data.subtree(inclusion_roots, exclusion_roots)
+
     exclusion_tree = build_branch(taxid_data, exclusion_roots)
 
     for index, root in enumerate(inclusion_roots):
@@ -263,9 +438,15 @@ def build_branch(taxid_data, inclusion_roots):
     Returns
     -------
     this_branch : dict
-        representation of branches built from roots
+        representation of branches built from roots; a SubtreeView when
+        `taxid_data` is a Taxonomy
 
     """
+    # Imported here as the taxonomy module builds on this one
+    from yax.shared.utilities.taxonomy import Taxonomy
+    if isinstance(taxid_data, Taxonomy):
+        return taxid_data.subtree(inclusion_roots)
+
     this_branch = {}
     taxids_to_add = set(inclusion_roots)
 
@@ -293,9 +474,17 @@ def build_gis_to_taxids(tree):
     Returns
     -------
     gis_to_taxids : dict
-        gi keys with taxids values
+        gi keys with taxids values; a GiLookup when `tree` is a Taxonomy or a
+        SubtreeView of one
 
     """
+    # Imported here as the taxonomy module builds on this one
+    from yax.shared.utilities.taxonomy import Taxonomy, SubtreeView, GiLookup
+    if isinstance(tree, Taxonomy):
+        return GiLookup(tree)
+    if isinstance(tree, SubtreeView):
+        return GiLookup(tree.taxonomy, tree)
+
     results = {}
     for taxid, record in tree.items():
         for gi in record.assoc_gis:
@@ -305,7 +494,8 @@ def build_gis_to_taxids(tree):
 
 
 def output_sequences(taxid_data, inclusion_tree, gis_to_taxids,
-                     sequences_input_fp, output_fp, truncation_level):
+                     sequences_input_fp, output_fp, truncation_level,
+                     fasta_index=None, workers=1, compression=None):
     """Outputs branch sequences
 
     Filters through provided NCBI FASTA formatted file and outputs the
@@ -322,65 +512,186 @@ def output_sequences(taxid_data, inclusion_tree, gis_to_taxids,
         association
     sequences_input_fp : str
         absolute file path to the fasta file containing sequences to search
-    output_location : str
+    output_fp : str
         directory destination of desired output
-    project_name : str
-        name used for identifying this run
     truncation_level : str
         level at which leaf nodes will be rolled up in sequence association
         only
+    fasta_index : fastatool.FastaIndex, optional
+        index of `sequences_input_fp`; when provided only the records of the
+        gis in `gis_to_taxids` are read, instead of the whole file
+    workers : int, optional
+        number of processes to scan `sequences_input_fp` with when there is
+        no `fasta_index`; the file is split into that many ranges of whole
+        records, which are filtered separately and concatenated in order
+    compression : {None, "gzip", "bgzip"}, optional
+        how to compress the sequences; compressed output is written to
+        ``_seqs.fasta.gz``
 
     Returns
     -------
-    None
+    dict of str to int
+        number of sequences written for each taxid.
         Writes sequence data to indicated FASTA formatted file.
     """
-    print_line = False
+    selected = _select_sequences(taxid_data, gis_to_taxids, truncation_level)
+    seqs_fp = os.path.join(output_fp, "_seqs.fasta")
+    if compression is not None:
+        seqs_fp += ".gz"
+
+    if fasta_index is not None:
+        taxid_counts = {}
+        records = fastatool.iter_indexed_records(sequences_input_fp,
+                                                 fasta_index, selected)
+        with fastatool.FastaWriter(seqs_fp, compression) as writer:
+            for gi, record in records:
+                taxid, header = selected[gi]
+                taxid_counts[taxid] = taxid_counts.get(taxid, 0) + 1
+                writer.write_record(header, record[record.index(b"\n") + 1:])
+        return taxid_counts
+
+    if workers <= 1:
+        return _filter_sequences(sequences_input_fp, 0,
+                                 os.path.getsize(sequences_input_fp),
+                                 selected, seqs_fp, compression)
+
+    ranges = split_file(sequences_input_fp, workers, record_start=b">")
+    part_fps = ["%s.%d" % (seqs_fp, part) for part in range(len(ranges))]
+    # The selection is pickled once, to a file each worker loads, rather
+    # than into every task
+    selected_fp = seqs_fp + ".selected"
+    try:
+        with open(selected_fp, mode='wb') as selected_fh:
+            pickle.dump(selected, selected_fh, pickle.HIGHEST_PROTOCOL)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) \
+                as executor:
+            futures = [executor.submit(_filter_selected_sequences,
+                                       sequences_input_fp, start, end,
+                                       selected_fp, part_fp)
+                       for (start, end), part_fp in zip(ranges, part_fps)]
+            results = [future.result() for future in futures]
+
+        taxid_counts = collections.Counter()
+        with fastatool.FastaWriter(seqs_fp, compression) as writer:
+            for part_fp, part_counts in zip(part_fps, results):
+                with open(part_fp, mode='rb') as part_fh:
+                    writer.copy_from(part_fh)
+                taxid_counts.update(part_counts)
+    finally:
+        # Parts are left behind by a failed worker as well
+        for fp in part_fps + [selected_fp]:
+            if os.path.exists(fp):
+                os.remove(fp)
+    return dict(taxid_counts)
+
+
+def _select_sequences(taxid_data, gis_to_taxids, truncation_level):
+    """Maps each gi to output, as bytes, to its taxid and output header."""
+    # Imported here as the taxonomy module builds on this one
+    from yax.shared.utilities.taxonomy import GiLookup
+    if isinstance(gis_to_taxids, GiLookup) and \
+            gis_to_taxids.taxonomy is taxid_data:
+        return _select_taxonomy_sequences(gis_to_taxids, truncation_level)
+
+    header_taxids = {}
+    selected = {}
+    for gi, taxid in gis_to_taxids.items():
+        taxid = str(taxid)
+        if taxid not in header_taxids:
+            header_taxids[taxid] = _truncate_taxid(taxid_data, taxid,
+                                                   truncation_level)
+        header = "".join([">", gi, "-", header_taxids[taxid], "\n"])
+        selected[gi.encode()] = (taxid, header.encode())
+    return selected
+
+
+def _select_taxonomy_sequences(gi_lookup, truncation_level):
+    """`_select_sequences` for a GiLookup, resolving each taxid of its tree
+    and its header taxid in bulk rather than gi by gi."""
+    taxonomy = gi_lookup.taxonomy
+    if gi_lookup.tree is None:
+        indices = range(len(taxonomy))
+    else:
+        indices = list(gi_lookup.tree.indices())
+    if truncation_level:
+        header_indices = taxonomy.bulk_rank_ancestor(indices,
+                                                     truncation_level)
+    else:
+        header_indices = indices
+    taxids = taxonomy.bulk_taxid(indices)
+    header_taxids = taxonomy.bulk_taxid(header_indices)
+
+    selected = {}
+    for index, taxid, header_taxid in zip(indices, taxids, header_taxids):
+        taxid = str(taxid)
+        header_taxid = str(header_taxid)
+        for gi in taxonomy.assoc_gis(index):
+            gi = str(gi)
+            header = "".join([">", gi, "-", header_taxid, "\n"])
+            selected[gi.encode()] = (taxid, header.encode())
+    return selected
+
+
+def _filter_selected_sequences(sequences_input_fp, start, end, selected_fp,
+                               output_fp):
+    """`_filter_sequences` with the selection pickled to `selected_fp`."""
+    with open(selected_fp, mode='rb') as selected_fh:
+        selected = pickle.load(selected_fh)
+    return _filter_sequences(sequences_input_fp, start, end, selected,
+                             output_fp)
+
+
+def _filter_sequences(sequences_input_fp, start, end, selected, output_fp,
+                      compression=None):
+    """Writes the records of the `selected` gis found in the byte range
+    `start`:`end` of a FASTA file, returning the count per taxid."""
     taxid_counts = {}
-    with open(sequences_input_fp, 'r') as seqs_fh:
-        with open(os.path.join(output_fp, "_seqs.fasta"), mode='w')\
-                as output_fh:
-            for line in seqs_fh:
-                if (line[0] != ">" and print_line):
-                    output_fh.write(line)
-                elif line[0] == ">":
-                    gi = line.split(" ")[1].split(":")[1]
-                    if gi in gis_to_taxids:
-                        taxid = str(gis_to_taxids[gi])
-                        taxid_to_increment = taxid
-                        if truncation_level and\
-                                taxid_data[taxid].rank != truncation_level:
-                            for this_taxid in taxid_data[taxid].parents:
-                                if taxid_data[this_taxid].rank ==\
-                                        truncation_level:
-                                    taxid = this_taxid
-                        if taxid_to_increment in taxid_counts:
-                            taxid_counts[taxid_to_increment] += 1
-                        else:
-                            taxid_counts[taxid_to_increment] = 1
-                        print_line = True
-                        output_fh.write("".join([">", gi, "-", taxid, "\n"]))
-                    else:
-                        print_line = False
-                else:
-                    continue
-
-    # Updating gi counts in tree
-    for taxid in taxid_counts:
-        count = taxid_counts[taxid]
-        taxid_data[taxid].num_gis_assoc += count
-        for this_taxid in inclusion_tree[taxid].parents:
-            try:
-                taxid_data[this_taxid].num_gis_assoc += count
-            except IndexError:
-                raise ValueError("this_taxid not in taxid_data : %s" %
-                                 this_taxid)
-
-
-def output_tree(taxid_data, inclusion_tree, output_fp):
+    print_line = False
+    with open(sequences_input_fp, mode='rb') as seqs_fh, \
+            fastatool.FastaWriter(output_fp, compression) as writer:
+        seqs_fh.seek(start)
+        position = start
+        for line in seqs_fh:
+            if position >= end:
+                break
+            position += len(line)
+            if line[:1] == b">":
+                match = selected.get(fastatool.get_header_gi(line))
+                print_line = match is not None
+                if print_line:
+                    taxid, header = match
+                    taxid_counts[taxid] = taxid_counts.get(taxid, 0) + 1
+                    writer.write(header)
+            elif print_line:
+                writer.write(line)
+    return taxid_counts
+
+
+def _truncate_taxid(taxid_data, taxid, truncation_level):
+    """Returns the deepest ancestor of `taxid` at `truncation_level`.
+
+    `taxid` itself is returned when it is at `truncation_level`, or when none
+    of its ancestors are.
+    """
+    # Imported here as the taxonomy module builds on this one
+    from yax.shared.utilities.taxonomy import Taxonomy
+    if truncation_level and isinstance(taxid_data, Taxonomy):
+        index = taxid_data.rank_ancestor(taxid_data.index(taxid),
+                                         truncation_level)
+        return str(taxid_data.taxids[index])
+    if truncation_level and taxid_data[taxid].rank != truncation_level:
+        for this_taxid in taxid_data[taxid].parents:
+            if taxid_data[this_taxid].rank == truncation_level:
+                taxid = this_taxid
+    return taxid
+
+
+def output_tree(taxid_data, inclusion_tree, output_fp, taxid_counts):
     """Writes dsv(|) file of taxonomy trees
 
-    Description
+    Writes a line per leaf of `inclusion_tree` which sequences were output
+    for, listing the leaf's lineage with the number of sequences output under
+    each of its ancestors, then the leaf with its number of associated gis.
 
     Parameters
     ----------
@@ -388,10 +699,11 @@ def output_tree(taxid_data, inclusion_tree, output_fp):
         read in from taxid_data; representation of the entire tree
     inclusion_tree : dict
         built using provided taxid roots; the specific tree of interest
-    output_location : str
+    output_fp : str
         directory destination of desired output
-    project_name : str
-        name used for identifying this run
+    taxid_counts : dict of str to int
+        number of sequences output for each taxid, as returned by
+        `output_sequences`
 
     Returns
     -------
@@ -400,28 +712,108 @@ def output_tree(taxid_data, inclusion_tree, output_fp):
 
 
     """
-    num_gis_assoc = {}
-
-    for record in taxid_data:
-        num_gis_assoc[record.taxid] = 0
-
-    for record in taxid_data:
-        num_gis = len(record.assoc_gis)
-        num_gis_assoc[record.taxid] += num_gis
-        for taxid in record.parents:
-            num_gis_assoc[taxid] += num_gis
+    # Imported here as the taxonomy module builds on this one
+    from yax.shared.utilities.taxonomy import SubtreeView, Taxonomy
+    if isinstance(taxid_data, Taxonomy) and (
+            inclusion_tree is taxid_data or
+            isinstance(inclusion_tree, SubtreeView) and
+            inclusion_tree.taxonomy is taxid_data):
+        with open(os.path.join(output_fp, ".tree"), mode='w') as output_fh:
+            _output_taxonomy_tree(taxid_data, inclusion_tree, output_fh,
+                                  taxid_counts)
+        return
+
+    num_seqs = collections.Counter()
+    for taxid, count in taxid_counts.items():
+        num_seqs[taxid] += count
+        for this_taxid in taxid_data[taxid].parents:
+            num_seqs[this_taxid] += count
+
+    num_gis_assoc = _subtree_gi_counts(taxid_data)
 
     with open(os.path.join(output_fp, ".tree"), mode='w') as output_fh:
         for taxid in inclusion_tree:
             if inclusion_tree[taxid].children == [] and\
-                    inclusion_tree[taxid].num_gis_assoc != 0:
+                    num_seqs[taxid] != 0:
                 output_string = ""
-                for this_taxid in taxid_data[taxid][3]:
+                for this_taxid in taxid_data[taxid].parents:
                     output_string = "".join([output_string, this_taxid, "\t",
                                              taxid_data[this_taxid].sci_name,
-                                             "\t", str(taxid_data[this_taxid].
-                                                       num_gis_assoc), "\t"])
+                                             "\t", str(num_seqs[this_taxid]),
+                                             "\t"])
                 output_string = "".join([output_string, taxid, "\t",
                                          taxid_data[taxid].sci_name, "\t",
                                          str(num_gis_assoc[taxid])])
                 output_fh.write("".join([output_string, "\n"]))
+
+
+def _output_taxonomy_tree(taxonomy, inclusion_tree, output_fh,
+                          taxid_counts):
+    """`output_tree` for a Taxonomy and a view of it, working on taxonomy
+    indices rather than building a record per node.
+
+    Only leaves sequences were output for are written, and a leaf only has
+    sequences if it is in `taxid_counts`, so the rest of the tree is never
+    visited. Leaves are written in the order `inclusion_tree` iterates in.
+    """
+    num_seqs = collections.Counter()
+    leaves = []
+    child_offsets = taxonomy.child_offsets
+    for taxid, count in taxid_counts.items():
+        index = taxonomy.index(taxid)
+        num_seqs[index] += count
+        for ancestor in taxonomy.ancestors(index):
+            num_seqs[ancestor] += count
+        if child_offsets[index] == child_offsets[index + 1] and count:
+            leaves.append(index)
+
+    if inclusion_tree is taxonomy:
+        leaves.sort()
+    else:
+        leaves = sorted((index for index in leaves
+                         if inclusion_tree.contains_index(index)),
+                        key=taxonomy.enter.__getitem__)
+
+    taxids = taxonomy.taxids
+    names = {}
+    for index in leaves:
+        fields = []
+        for ancestor in taxonomy.ancestors(index):
+            if ancestor not in names:
+                names[ancestor] = taxonomy.name(ancestor)
+            fields.extend([str(taxids[ancestor]), names[ancestor],
+                           str(num_seqs[ancestor])])
+        fields.extend([str(taxids[index]), taxonomy.name(index),
+                       str(taxonomy.subtree_gi_count(index))])
+        output_fh.write("\t".join(fields) + "\n")
+
+
+def _subtree_gi_counts(taxid_data):
+    """Returns a lookup of taxid to number of gis in its subtree.
+
+    A Taxonomy's counts are precomputed; for dicts, records are visited
+    deepest first so every subtree is complete before it is added to its
+    parent's count.
+    """
+    # Imported here as the taxonomy module builds on this one
+    from yax.shared.utilities.taxonomy import Taxonomy
+    if isinstance(taxid_data, Taxonomy):
+        return _TaxonomyGiCounts(taxid_data)
+
+    num_gis_assoc = {taxid: len(record.assoc_gis)
+                     for taxid, record in taxid_data.items()}
+    for record in sorted(taxid_data.values(), key=lambda r: len(r.parents),
+                         reverse=True):
+        if record.parents:
+            num_gis_assoc[record.parents[-1]] += num_gis_assoc[record.taxid]
+    return num_gis_assoc
+
+
+class _TaxonomyGiCounts:
+    """Lookup of taxid to the precomputed gi count of its subtree."""
+    def __init__(self, taxonomy):
+        self.taxonomy = taxonomy
+
+    def __getitem__(self, taxid):
+        taxonomy = self.taxonomy
+        return taxonomy.subtree_gi_count(taxonomy.index(taxid))
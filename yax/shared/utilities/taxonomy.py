@@ -0,0 +1,1474 @@
+import array
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import heapq
+import itertools
+import mmap
+import operator
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from yax.shared.utilities.file_cache import FileCache
+from yax.shared.utilities.file_chunks import split_file, iter_chunk_lines
+from yax.shared.utilities.taxidtool import (TaxIDDataRecord, iter_nodes_dmp,
+                                            iter_names_dmp, iter_gi_taxid_dmp)
+
+
+# On-disk layout written by Taxonomy.write:
+#
+#   header   magic, format version, byte order mark, number of sections
+#   table    one entry per section: name, array typecode, offset, length
+#   data     each section as a raw native array, aligned to 8 bytes
+#
+# Arrays are stored in native byte order so they can be used straight out of
+# the memory map; the byte order mark rejects files from a foreign machine.
+FORMAT_MAGIC = b"YAXTAXON"
+FORMAT_VERSION = 1
+_BYTE_ORDER_MARK = 0x01020304
+_HEADER = struct.Struct("=8sIII")
+_SECTION = struct.Struct("=16s1s7xQQ")
+_ALIGNMENT = 8
+
+# Smallest part of a TSV taxid_data file worth decoding in its own process.
+TSV_CHUNK_SIZE = 1 << 24
+
+# Ranks whose rollups `Taxonomy.build_indexes` precomputes.
+ROLLUP_RANKS = ("species",)
+
+# Number of gis `Taxonomy.build_gi_index` sorts at a time before merging.
+GI_SORT_CHUNK = 1 << 18
+
+
+class Taxonomy(collections.abc.Mapping):
+    """Compact, array-backed representation of the tree of life.
+
+    A `Taxonomy` behaves like the dict of taxid to TaxIDDataRecord returned by
+    `taxidtool.build_taxid_data`, but stores the tree as flat integer arrays
+    instead of a Python object per taxid. Every node is addressed by an index
+    into the sorted array of integer taxids:
+
+    - `parents[i]` is the index of the parent of node `i` (roots point at
+      themselves), so lineages are materialized on demand.
+    - the children and gis of node `i` are the slices
+      `children[child_offsets[i]:child_offsets[i + 1]]` and
+      `gis[gi_offsets[i]:gi_offsets[i + 1]]`.
+    - scientific names are stored back to back in one UTF-8 encoded buffer
+      delimited by `name_offsets`, and ranks are indices into an interned
+      table of rank names.
+
+    Records are built as TaxIDDataRecord on lookup, with taxids and gis as
+    strings, so code written against the dict representation keeps working.
+
+    The arrays can be saved with `write` and memory mapped back with `load`,
+    in which case they are read-only views of the file and nothing is parsed.
+
+    """
+    _SECTIONS = (("taxids", 'i'),
+                 ("parents", 'i'),
+                 ("ranks", 'B'),
+                 ("rank_names", 'B'),
+                 ("names", 'B'),
+                 ("name_offsets", 'q'),
+                 ("children", 'i'),
+                 ("child_offsets", 'q'),
+                 ("gis", 'q'),
+                 ("gi_offsets", 'q'))
+    # Precomputed indexes; written when built and optional when loading.
+    _INDEX_SECTIONS = (("depths", 'i'),
+                       ("jumps", 'i'),
+                       ("preorder", 'i'),
+                       ("enter", 'i'),
+                       ("subtree_sizes", 'i'),
+                       ("subtree_gis", 'q'),
+                       ("sorted_gis", 'q'),
+                       ("sorted_gi_taxa", 'i'),
+                       ("rollup_ranks", 'B'),
+                       ("rollups", 'i'))
+
+    def __init__(self, taxids, parents, ranks, rank_names, names,
+                 name_offsets, children, child_offsets, gis, gi_offsets):
+        self.taxids = taxids
+        self.parents = parents
+        self.ranks = ranks
+        self.rank_names = rank_names
+        self.names = names
+        self.name_offsets = name_offsets
+        self.children = children
+        self.child_offsets = child_offsets
+        self.gis = gis
+        self.gi_offsets = gi_offsets
+        self.depths = None
+        self.jumps = None
+        self.preorder = None
+        self.enter = None
+        self.subtree_sizes = None
+        self.subtree_gis = None
+        self.sorted_gis = None
+        self.sorted_gi_taxa = None
+        self.rollups = {}
+        self._mmap = None
+
+    @classmethod
+    def from_dmp(cls, nodes_fp, names_fp, gi_taxid_nucl_fp, cache_dir=None):
+        """Builds a Taxonomy from NCBI taxonomy dump files.
+
+        The dump files are streamed, so only the compact arrays (and not a
+        Python object per line) are held in memory while building.
+
+        Parameters
+        ----------
+        nodes_fp : str
+            location of nodes.dmp file
+        names_fp : str
+            location of names.dmp file
+        gi_taxid_nucl_fp : str
+            location of gi_taxid_nucl.dmp file
+        cache_dir : str, optional
+            a `file_cache.FileCache` directory; the taxonomy is then built
+            (with all its indexes) only once per version of the dump files
+            and memory mapped from the cache afterwards
+
+        Returns
+        -------
+        Taxonomy
+            the same tree `taxidtool.build_taxid_data` would build
+
+        Raises
+        ------
+        ValueError
+            Raised when the dump files do not describe the same taxids.
+
+        """
+        if cache_dir is not None:
+            cache = FileCache(cache_dir)
+            key = cache.key("taxonomy", [nodes_fp, names_fp,
+                                         gi_taxid_nucl_fp], FORMAT_VERSION)
+
+            def write(output_fp):
+                taxonomy = cls.from_dmp(nodes_fp, names_fp, gi_taxid_nucl_fp)
+                taxonomy.build_indexes()
+                taxonomy.write(output_fp)
+
+            return cls.load(cache.get_or_create(key, write))
+
+        builder = _TaxonomyBuilder()
+        for record in iter_nodes_dmp(nodes_fp):
+            builder.add_node(record.taxid, record.parent_taxid, record.rank)
+        builder.finish_nodes()
+
+        for taxid, sci_name in iter_names_dmp(names_fp):
+            builder.add_name(taxid, sci_name)
+
+        for gi, taxid in iter_gi_taxid_dmp(gi_taxid_nucl_fp):
+            builder.add_gi(gi, taxid)
+
+        return builder.build()
+
+    @classmethod
+    def from_taxid_data(cls, taxid_data):
+        """Builds a Taxonomy from a dict of taxid to TaxIDDataRecord.
+
+        Parameters
+        ----------
+        taxid_data : dict of tax_id to TaxIDDataRecord
+            as returned by `taxidtool.parse_taxid_data`
+
+        Returns
+        -------
+        Taxonomy
+
+        """
+        builder = _TaxonomyBuilder()
+        for taxid, record in taxid_data.items():
+            parent_taxid = record.parents[-1] if record.parents else taxid
+            builder.add_node(taxid, parent_taxid, record.rank)
+        builder.finish_nodes()
+
+        for taxid, record in taxid_data.items():
+            builder.add_name(taxid, record.sci_name)
+            for gi in record.assoc_gis:
+                builder.add_gi(gi, taxid)
+
+        return builder.build()
+
+    @classmethod
+    def from_tsv(cls, input_fp, workers=1):
+        """Builds a Taxonomy from a file written by
+        `taxidtool.write_taxid_data`.
+
+        Lines are decoded straight into integer arrays, without building a
+        TaxIDDataRecord per line. Large files are split into ranges of whole
+        lines which are decoded in up to `workers` processes.
+
+        Parameters
+        ----------
+        input_fp : str
+            location of the TSV taxid_data file
+        workers : int, optional
+            number of processes to decode the file with
+
+        Returns
+        -------
+        Taxonomy
+            the same taxonomy as `from_taxid_data` of
+            `taxidtool.parse_taxid_data`
+
+        Raises
+        ------
+        ValueError
+            Raised when a parent taxid is not described in the file.
+
+        """
+        num_chunks = min(workers,
+                         os.path.getsize(input_fp) // TSV_CHUNK_SIZE + 1)
+        ranges = split_file(input_fp, num_chunks)
+        if len(ranges) <= 1:
+            chunks = [_decode_tsv_range(input_fp, start, end)
+                      for start, end in ranges]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=len(ranges)) as executor:
+                chunks = list(executor.map(_decode_tsv_range,
+                                           *zip(*((input_fp, start, end)
+                                                  for start, end in ranges))))
+
+        builder = _TaxonomyBuilder()
+        for chunk in chunks:
+            for taxid, parent_taxid, rank in zip(chunk.taxids,
+                                                 chunk.parent_taxids,
+                                                 chunk.ranks):
+                builder.add_node(taxid, parent_taxid, rank)
+        builder.finish_nodes()
+
+        # Where the gis of each node are, by taxonomy index
+        gi_slices = [None] * len(builder.taxids)
+        for chunk in chunks:
+            for taxid, sci_name, start, end in zip(
+                    chunk.taxids, chunk.sci_names, chunk.gi_offsets,
+                    chunk.gi_offsets[1:]):
+                builder.add_name(taxid, sci_name)
+                gi_slices[builder._index(taxid)] = (chunk.gis, start, end)
+
+        gis = array.array('q')
+        gi_offsets = array.array('q', [0])
+        for chunk_gis, start, end in gi_slices:
+            gis.extend(chunk_gis[start:end])
+            gi_offsets.append(len(gis))
+
+        return builder.build(gis, gi_offsets)
+
+    def update(self, deleted=(), merged=(), nodes=(), names=(), gis=()):
+        """Applies a diff of the NCBI taxonomy dump files.
+
+        Only the nodes and gis named in the diff are looked at one by one;
+        everything else is carried over from the arrays of this taxonomy, so
+        none of the full dump files have to be parsed again.
+
+        Parameters
+        ----------
+        deleted : iterable of str
+            deleted taxids, as streamed by `taxidtool.iter_delnodes_dmp`
+        merged : iterable of (str, str)
+            old taxids and the taxid each was merged into, as streamed by
+            `taxidtool.iter_merged_dmp`; the gis and children of an old
+            taxid move to the taxid it was merged into
+        nodes : iterable of NodeRecord
+            added nodes and nodes whose parent or rank changed
+        names : iterable of (str, str)
+            taxid and scientific name of added and renamed nodes
+        gis : iterable of (str, str)
+            added gi to taxid associations; a gi which was already associated
+            with a taxid is moved
+
+        Returns
+        -------
+        Taxonomy
+            the updated taxonomy, without any precomputed index
+
+        Raises
+        ------
+        ValueError
+            Raised when the diff does not apply to this taxonomy, e.g. when
+            a node is left with a deleted parent or a new node has no name.
+
+        """
+        deleted = {int(taxid) for taxid in deleted}
+        merged = {int(old_taxid): int(new_taxid)
+                  for old_taxid, new_taxid in merged}
+        changed = {int(record.taxid): record for record in nodes}
+        removed = deleted | set(merged)
+
+        def resolve(taxid):
+            # merged.dmp can merge a taxid into one that was merged later on
+            seen = set()
+            while taxid in merged and taxid not in seen:
+                seen.add(taxid)
+                taxid = merged[taxid]
+            return taxid
+
+        builder = _TaxonomyBuilder()
+        taxids, parents = self.taxids, self.parents
+        for index in range(len(taxids)):
+            taxid = taxids[index]
+            if taxid not in removed and taxid not in changed:
+                builder.add_node(taxid, resolve(taxids[parents[index]]),
+                                 self.rank(index))
+        for taxid, record in changed.items():
+            if taxid not in removed:
+                builder.add_node(taxid, resolve(int(record.parent_taxid)),
+                                 record.rank)
+        builder.finish_nodes()
+
+        # index of each node in this taxonomy, -1 for added nodes
+        old_indices = array.array('i', map(self._index_or_missing,
+                                           builder.taxids))
+        for index, old_index in enumerate(old_indices):
+            if old_index != -1:
+                builder.add_name(builder.taxids[index], self.name(old_index))
+        for taxid, sci_name in names:
+            if int(taxid) not in removed:
+                builder.add_name(taxid, sci_name)
+
+        # Added gis, and the gis they move out of their previous taxid
+        if self.sorted_gis is None:
+            self.build_gi_index()
+        moved = collections.defaultdict(set)
+        added = []
+        for gi, taxid in gis:
+            gi = int(gi)
+            previous = self._gi_index_or_missing(gi)
+            if previous != -1:
+                moved[previous].add(gi)
+            try:
+                added.append((builder._index(resolve(int(taxid))), gi))
+            except ValueError:
+                # Dropped like the unplaced gis of gi_taxid_nucl.dmp
+                continue
+
+        extra_gis = collections.defaultdict(list)
+        for old_taxid in merged:
+            old_index = self._index_or_missing(old_taxid)
+            if old_index != -1:
+                index = builder._index(resolve(old_taxid))
+                extra_gis[index].extend(
+                    gi for gi in self.assoc_gis(old_index)
+                    if gi not in moved.get(old_index, ()))
+        for index, gi in added:
+            extra_gis[index].append(gi)
+
+        new_gis = array.array('q')
+        gi_offsets = array.array('q', [0])
+        for index, old_index in enumerate(old_indices):
+            if old_index != -1:
+                if old_index in moved:
+                    new_gis.extend(gi for gi in self.assoc_gis(old_index)
+                                   if gi not in moved[old_index])
+                else:
+                    new_gis.frombytes(
+                        memoryview(self.assoc_gis(old_index)).cast('B'))
+            if index in extra_gis:
+                new_gis.extend(extra_gis[index])
+            gi_offsets.append(len(new_gis))
+
+        return builder.build(new_gis, gi_offsets)
+
+    @classmethod
+    def load(cls, input_fp):
+        """Memory maps a Taxonomy written by `write`.
+
+        Parameters
+        ----------
+        input_fp : str
+            location of the binary taxonomy file
+
+        Returns
+        -------
+        Taxonomy
+            backed by read-only views of the mapped file
+
+        Raises
+        ------
+        ValueError
+            Raised when `input_fp` is not a taxonomy file this version of yax
+            can read.
+
+        """
+        with open(input_fp, mode='rb') as fh:
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(mapped)
+
+        if len(buffer) < _HEADER.size:
+            raise ValueError("%r is not a taxonomy file." % input_fp)
+        magic, version, byte_order, num_sections = \
+            _HEADER.unpack_from(buffer)
+        if magic != FORMAT_MAGIC:
+            raise ValueError("%r is not a taxonomy file." % input_fp)
+        if version != FORMAT_VERSION:
+            raise ValueError("Taxonomy file %r has format version %d, only"
+                             " version %d is supported."
+                             % (input_fp, version, FORMAT_VERSION))
+        if byte_order != _BYTE_ORDER_MARK:
+            raise ValueError("Taxonomy file %r was written on a machine with"
+                             " a different byte order." % input_fp)
+
+        sections = {}
+        for position in range(num_sections):
+            name, typecode, offset, length = _SECTION.unpack_from(
+                buffer, _HEADER.size + position * _SECTION.size)
+            typecode = typecode.decode()
+            itemsize = array.array(typecode).itemsize
+            sections[name.rstrip(b"\0").decode()] = \
+                buffer[offset:offset + length * itemsize].cast(typecode)
+
+        missing = [name for name, _ in cls._SECTIONS if name not in sections]
+        if missing:
+            raise ValueError("Taxonomy file %r is missing sections %r."
+                             % (input_fp, missing))
+
+        rank_names = bytes(sections["rank_names"]).decode().split("\0")
+        taxonomy = cls(sections["taxids"], sections["parents"],
+                       sections["ranks"], rank_names, sections["names"],
+                       sections["name_offsets"], sections["children"],
+                       sections["child_offsets"], sections["gis"],
+                       sections["gi_offsets"])
+        for name, _ in cls._INDEX_SECTIONS:
+            if name not in ("rollup_ranks", "rollups"):
+                setattr(taxonomy, name, sections.get(name))
+        if "rollup_ranks" in sections:
+            num_nodes = len(taxonomy.taxids)
+            for row, rank in enumerate(sections["rollup_ranks"]):
+                taxonomy.rollups[rank_names[rank]] = \
+                    sections["rollups"][row * num_nodes:
+                                        (row + 1) * num_nodes]
+        taxonomy._mmap = mapped
+        return taxonomy
+
+    def write(self, output_fp):
+        """Writes this Taxonomy in the binary format read by `load`.
+
+        The file is written next to `output_fp` and moved into place once
+        complete, so a partially written taxonomy is never observed.
+
+        Parameters
+        ----------
+        output_fp : str
+            The filepath to write the taxonomy to.
+
+        Returns
+        -------
+        None
+
+        """
+        arrays = []
+        for name, typecode in self._SECTIONS:
+            if name == "rank_names":
+                values = "\0".join(self.rank_names).encode()
+            else:
+                values = getattr(self, name)
+            arrays.append((name, typecode, memoryview(values).cast('B')))
+        for name, typecode in self._INDEX_SECTIONS:
+            if name == "rollup_ranks":
+                values = bytes(self.rank_names.index(rank)
+                               for rank in self.rollups) or None
+            elif name == "rollups":
+                values = b"".join(memoryview(row).cast('B')
+                                  for row in self.rollups.values()) or None
+            else:
+                values = getattr(self, name)
+            if values is not None:
+                arrays.append((name, typecode,
+                               memoryview(values).cast('B')))
+
+        offset = _HEADER.size + len(arrays) * _SECTION.size
+        table = []
+        for name, typecode, data in arrays:
+            offset += -offset % _ALIGNMENT
+            table.append(_SECTION.pack(name.encode(), typecode.encode(),
+                                       offset,
+                                       len(data) // array.array(
+                                           typecode).itemsize))
+            offset += len(data)
+
+        temp_fp = output_fp + ".tmp"
+        with open(temp_fp, mode='wb') as fh:
+            fh.write(_HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION,
+                                  _BYTE_ORDER_MARK, len(arrays)))
+            fh.write(b"".join(table))
+            for _, __, data in arrays:
+                fh.write(bytes(-fh.tell() % _ALIGNMENT))
+                fh.write(data)
+        os.replace(temp_fp, output_fp)
+
+    def __len__(self):
+        return len(self.taxids)
+
+    def __iter__(self):
+        for taxid in self.taxids:
+            yield str(taxid)
+
+    def __contains__(self, taxid):
+        try:
+            self.index(taxid)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, taxid):
+        return self.record(self.index(taxid))
+
+    def index(self, taxid):
+        """Finds the index of a taxid.
+
+        Parameters
+        ----------
+        taxid : str or int
+            the taxid to look up
+
+        Returns
+        -------
+        int
+            position of `taxid` in the arrays of this taxonomy
+
+        Raises
+        ------
+        KeyError
+            Raised when `taxid` is not part of this taxonomy.
+
+        """
+        try:
+            value = int(taxid)
+        except (TypeError, ValueError):
+            raise KeyError(taxid)
+        index = bisect.bisect_left(self.taxids, value)
+        if index == len(self.taxids) or self.taxids[index] != value:
+            raise KeyError(taxid)
+        return index
+
+    def name(self, index):
+        """Returns the scientific name of the node at `index`."""
+        return bytes(self.names[self.name_offsets[index]:
+                                self.name_offsets[index + 1]]).decode()
+
+    def rank(self, index):
+        """Returns the rank of the node at `index`."""
+        return self.rank_names[self.ranks[index]]
+
+    def ancestors(self, index):
+        """Returns the indices of the lineage of `index`, root first.
+
+        The node itself is not part of its lineage.
+        """
+        lineage = []
+        parents = self.parents
+        while parents[index] != index:
+            index = parents[index]
+            lineage.append(index)
+        lineage.reverse()
+        return lineage
+
+    def child_indices(self, index):
+        """Returns the indices of the children of `index`."""
+        return self.children[self.child_offsets[index]:
+                             self.child_offsets[index + 1]]
+
+    def assoc_gis(self, index):
+        """Returns the integer gis associated with `index`."""
+        return self.gis[self.gi_offsets[index]:self.gi_offsets[index + 1]]
+
+    def build_indexes(self):
+        """Builds every precomputed index which has not been built yet."""
+        if self.jumps is None:
+            self.build_lca_index()
+        if self.preorder is None:
+            self.build_subtree_index()
+        if self.subtree_gis is None:
+            self.build_subtree_gi_index()
+        if self.sorted_gis is None:
+            self.build_gi_index()
+        for rank in ROLLUP_RANKS:
+            if rank in self.rank_names and rank not in self.rollups:
+                self.build_rollup(rank)
+
+    def build_lca_index(self):
+        """Precomputes the depth of every node and a binary lifting table.
+
+        Row `k` of the table holds the ancestor `2 ** k` edges above every
+        node (clamped at the root), so any ancestor can be reached in a
+        number of jumps logarithmic in the depth of the tree.
+
+        Returns
+        -------
+        None
+            Sets `depths` and `jumps`, which are saved by `write`.
+
+        """
+        num_nodes = len(self.taxids)
+        depths = array.array('i', bytes(4 * num_nodes))
+        to_visit = [index for index in range(num_nodes)
+                    if self.parents[index] == index]
+        while to_visit:
+            index = to_visit.pop()
+            depth = depths[index] + 1
+            for child in self.child_indices(index):
+                depths[child] = depth
+                to_visit.append(child)
+
+        jumps = array.array('i', self.parents)
+        for level in range(1, max(max(depths, default=0).bit_length(), 1)):
+            previous = jumps[(level - 1) * num_nodes:level * num_nodes]
+            jumps.extend(previous[ancestor] for ancestor in previous)
+
+        self.depths = depths
+        self.jumps = jumps
+
+    def level_ancestor(self, index, depth):
+        """Returns the ancestor of `index` found at `depth`.
+
+        `index` itself is returned if it is at `depth` already.
+        """
+        if self.jumps is None:
+            self.build_lca_index()
+        num_nodes = len(self.taxids)
+        distance = self.depths[index] - depth
+        if distance < 0:
+            raise ValueError("Node %d is above depth %d." % (index, depth))
+        level = 0
+        while distance:
+            if distance & 1:
+                index = self.jumps[level * num_nodes + index]
+            distance >>= 1
+            level += 1
+        return index
+
+    def lca(self, index_a, index_b):
+        """Finds the lowest common ancestor of two nodes.
+
+        A node counts as its own ancestor, so the lowest common ancestor of a
+        node and one of its descendants is the node itself.
+
+        Parameters
+        ----------
+        index_a, index_b : int
+            indices of the nodes
+
+        Returns
+        -------
+        int
+            index of the lowest common ancestor, or -1 if the nodes are in
+            disconnected trees
+
+        """
+        if self.jumps is None:
+            self.build_lca_index()
+        depths, jumps = self.depths, self.jumps
+        num_nodes = len(self.taxids)
+
+        if depths[index_a] < depths[index_b]:
+            index_a, index_b = index_b, index_a
+        index_a = self.level_ancestor(index_a, depths[index_b])
+        if index_a == index_b:
+            return index_a
+
+        for level in reversed(range(len(jumps) // num_nodes)):
+            jump_a = jumps[level * num_nodes + index_a]
+            jump_b = jumps[level * num_nodes + index_b]
+            if jump_a != jump_b:
+                index_a, index_b = jump_a, jump_b
+        index_a, index_b = self.parents[index_a], self.parents[index_b]
+        return index_a if index_a == index_b else -1
+
+    def build_subtree_index(self):
+        """Labels every node with its interval in a pre-order traversal.
+
+        In pre-order, the descendants of a node directly follow it, so the
+        subtree of node `i` is exactly the positions
+        `enter[i]:enter[i] + subtree_sizes[i]` of `preorder`. Subtree
+        membership, size and differences become integer range operations.
+
+        Returns
+        -------
+        None
+            Sets `preorder`, `enter` and `subtree_sizes`, which are saved by
+            `write`.
+
+        """
+        num_nodes = len(self.taxids)
+        preorder = array.array('i')
+        enter = array.array('i', bytes(4 * num_nodes))
+        subtree_sizes = array.array('i', bytes(4 * num_nodes))
+
+        to_visit = [index for index in reversed(range(num_nodes))
+                    if self.parents[index] == index]
+        while to_visit:
+            index = to_visit.pop()
+            enter[index] = len(preorder)
+            preorder.append(index)
+            to_visit.extend(reversed(self.child_indices(index)))
+
+        # Children follow their parents in pre-order, so walking it backwards
+        # completes every subtree before its root is reached.
+        for position in reversed(range(num_nodes)):
+            index = preorder[position]
+            subtree_sizes[index] += 1
+            parent = self.parents[index]
+            if parent != index:
+                subtree_sizes[parent] += subtree_sizes[index]
+
+        self.preorder = preorder
+        self.enter = enter
+        self.subtree_sizes = subtree_sizes
+
+    def build_subtree_gi_index(self):
+        """Counts the gis associated with every subtree.
+
+        Walks the pre-order backwards once, so every subtree is complete
+        before its count is added to its parent's.
+
+        Returns
+        -------
+        None
+            Sets `subtree_gis`, which is saved by `write`.
+
+        """
+        if self.preorder is None:
+            self.build_subtree_index()
+        gi_offsets, parents = self.gi_offsets, self.parents
+        subtree_gis = array.array('q', bytes(8 * len(self.taxids)))
+        for position in reversed(range(len(self.preorder))):
+            index = self.preorder[position]
+            subtree_gis[index] += gi_offsets[index + 1] - gi_offsets[index]
+            parent = parents[index]
+            if parent != index:
+                subtree_gis[parent] += subtree_gis[index]
+        self.subtree_gis = subtree_gis
+
+    def subtree_gi_count(self, index):
+        """Returns the number of gis associated with the subtree of
+        `index`."""
+        if self.subtree_gis is None:
+            self.build_subtree_gi_index()
+        return self.subtree_gis[index]
+
+    def subtree_range(self, index):
+        """Returns the pre-order interval (start, end) of a subtree."""
+        if self.preorder is None:
+            self.build_subtree_index()
+        start = self.enter[index]
+        return start, start + self.subtree_sizes[index]
+
+    def in_subtree(self, index, root):
+        """Whether the node at `index` is `root` or one of its descendants."""
+        start, end = self.subtree_range(root)
+        return start <= self.enter[index] < end
+
+    def subtree(self, inclusion_roots, exclusion_roots=()):
+        """Selects the subtrees of `inclusion_roots` minus `exclusion_roots`.
+
+        Parameters
+        ----------
+        inclusion_roots : list
+            taxids whose subtrees to include
+        exclusion_roots : list, optional
+            taxids whose subtrees to leave out
+
+        Returns
+        -------
+        SubtreeView
+            a view of the selected part of this taxonomy; nothing is copied
+
+        Raises
+        ------
+        ValueError
+            Raised when an inclusion root is inside an excluded subtree.
+
+        """
+        if self.preorder is None:
+            self.build_subtree_index()
+        exclusion = _merge_ranges(self.subtree_range(self.index(taxid))
+                                  for taxid in exclusion_roots)
+        for taxid in inclusion_roots:
+            if _in_ranges(exclusion, self.enter[self.index(taxid)]):
+                raise ValueError("TaxID %s found inside exclusion tree"
+                                 % taxid)
+        inclusion = _merge_ranges(self.subtree_range(self.index(taxid))
+                                  for taxid in inclusion_roots)
+        return SubtreeView(self, _subtract_ranges(inclusion, exclusion))
+
+    def build_rollup(self, rank):
+        """Precomputes which node every node rolls up to at `rank`.
+
+        A node rolls up to itself when it is at `rank`, otherwise to its
+        deepest ancestor at `rank`, and to itself when it has none.
+
+        Parameters
+        ----------
+        rank : str
+            the rank to roll up to, e.g. "species"
+
+        Returns
+        -------
+        array
+            the index each node rolls up to, also stored in `rollups` and
+            saved by `write`
+
+        """
+        if self.preorder is None:
+            self.build_subtree_index()
+        code = self.rank_names.index(rank)
+        ranks, parents = self.ranks, self.parents
+        # Closest node at `rank` on the path to the root, -1 when none is;
+        # parents precede their children in pre-order.
+        nearest = array.array('i', bytes(4 * len(self.taxids)))
+        for index in self.preorder:
+            if ranks[index] == code:
+                nearest[index] = index
+            elif parents[index] == index:
+                nearest[index] = -1
+            else:
+                nearest[index] = nearest[parents[index]]
+
+        rollup = array.array('i', (index if ancestor == -1 else ancestor
+                                   for index, ancestor in enumerate(nearest)))
+        self.rollups[rank] = rollup
+        return rollup
+
+    def rollup(self, rank):
+        """Returns the index every node rolls up to at `rank`.
+
+        See `build_rollup`, which is only run the first time a rank is asked
+        for. Every node rolls up to itself for a rank no node has.
+        """
+        if rank not in self.rollups:
+            if rank not in self.rank_names:
+                return range(len(self.taxids))
+            self.build_rollup(rank)
+        return self.rollups[rank]
+
+    def rank_ancestor(self, index, rank):
+        """Returns the index the node at `index` rolls up to at `rank`."""
+        return self.rollup(rank)[index]
+
+    def build_gi_index(self):
+        """Builds the reverse lookup from gi to taxonomy index.
+
+        All gis are sorted into `sorted_gis`, with the index of the taxid
+        each belongs to at the same position of `sorted_gi_taxa`, so a gi is
+        found by binary search instead of through a dict entry per gi.
+
+        The gis are sorted `GI_SORT_CHUNK` at a time into runs held as
+        arrays, which are then merged, so only one chunk at a time exists as
+        Python integers. Each gi and its taxon index are packed into one
+        integer, ordered like the pair, so sorting and merging need no key
+        function and run in C. When NumPy is installed the gis are instead
+        sorted in one stable argsort and gathered straight into the arrays.
+
+        Returns
+        -------
+        None
+            Sets `sorted_gis` and `sorted_gi_taxa`, which are saved by
+            `write`.
+
+        """
+        if numpy is not None:
+            gis = numpy.asarray(self.gis)
+            order = numpy.argsort(gis, kind='stable')
+            self.sorted_gis = array.array('q', [0]) * len(order)
+            numpy.take(gis, order, out=numpy.asarray(self.sorted_gis))
+            del gis
+            gi_taxa = numpy.repeat(
+                numpy.arange(len(self.taxids), dtype=numpy.intc),
+                numpy.diff(numpy.asarray(self.gi_offsets)))
+            self.sorted_gi_taxa = array.array('i', [0]) * len(order)
+            numpy.take(gi_taxa, order, out=numpy.asarray(self.sorted_gi_taxa))
+            return
+
+        gi_taxa = array.array('i')
+        for index in range(len(self.taxids)):
+            gi_taxa.extend([index] * (self.gi_offsets[index + 1] -
+                                      self.gi_offsets[index]))
+
+        runs = []
+        for start in range(0, len(self.gis), GI_SORT_CHUNK):
+            end = start + GI_SORT_CHUNK
+            runs.append(_unpack_gi_taxa(sorted(_pack_gi_taxa(
+                self.gis[start:end], gi_taxa[start:end]))))
+        del gi_taxa
+
+        if len(runs) == 1:
+            self.sorted_gis, self.sorted_gi_taxa = runs[0]
+            return
+        self.sorted_gis = array.array('q')
+        self.sorted_gi_taxa = array.array('i')
+        merged = heapq.merge(*(_pack_gi_taxa(*run) for run in runs))
+        while True:
+            block = list(itertools.islice(merged, GI_SORT_CHUNK))
+            if not block:
+                break
+            gis, gi_taxa = _unpack_gi_taxa(block)
+            self.sorted_gis.extend(gis)
+            self.sorted_gi_taxa.extend(gi_taxa)
+
+    def gi_index(self, gi):
+        """Finds the index of the taxid a gi belongs to.
+
+        Parameters
+        ----------
+        gi : str or int
+            the gi to look up
+
+        Returns
+        -------
+        int
+            index of the taxid `gi` is associated with
+
+        Raises
+        ------
+        KeyError
+            Raised when `gi` is not associated with any taxid.
+
+        """
+        if self.sorted_gis is None:
+            self.build_gi_index()
+        try:
+            value = int(gi)
+        except (TypeError, ValueError):
+            raise KeyError(gi)
+        position = bisect.bisect_left(self.sorted_gis, value)
+        if position == len(self.sorted_gis) or \
+                self.sorted_gis[position] != value:
+            raise KeyError(gi)
+        return self.sorted_gi_taxa[position]
+
+    # Bulk queries take and return arrays of node indices. When NumPy is
+    # installed they return NumPy arrays and run as NumPy operations:
+    # `searchsorted` on the sorted arrays, fancy indexing, and binary lifting
+    # over whole arrays of nodes at once. Without it, lookups which are a
+    # single array access are a `map` over the underlying arrays, and the
+    # others answer each distinct query once and spread the answers back
+    # over the batch with a `map`.
+
+    def bulk_index(self, taxids):
+        """Finds the indices of many taxids.
+
+        Parameters
+        ----------
+        taxids : iterable of str or int
+            the taxids to look up
+
+        Returns
+        -------
+        array
+            index of each taxid, in order
+
+        Raises
+        ------
+        KeyError
+            Raised when a taxid is not part of this taxonomy.
+
+        """
+        taxids = list(taxids)
+        if numpy is not None:
+            found = _search_sorted(self.taxids, taxids)
+            if found is not None and found[1].all():
+                return found[0].astype(numpy.int32)
+        positions = _bulk_search(self.taxids, taxids)
+        return array.array('i', map(positions.__getitem__, taxids))
+
+    def bulk_gi_index(self, gis):
+        """Finds the indices of the taxids many gis belong to.
+
+        Parameters
+        ----------
+        gis : iterable of str or int
+            the gis to look up
+
+        Returns
+        -------
+        array
+            index of the taxid of each gi, in order; -1 for gis which are
+            not associated with any taxid
+
+        """
+        if self.sorted_gis is None:
+            self.build_gi_index()
+        gis = list(gis)
+        if numpy is not None:
+            found = _search_sorted(self.sorted_gis, gis)
+            if found is not None:
+                positions, found = found
+                indices = numpy.full(len(gis), -1, numpy.int32)
+                indices[found] = numpy.asarray(
+                    self.sorted_gi_taxa)[positions[found]]
+                return indices
+        gi_taxa = self.sorted_gi_taxa
+        indices = {gi: gi_taxa[position] for gi, position
+                   in _bulk_search(self.sorted_gis, gis).items()}
+        return array.array('i', map(indices.get, gis, itertools.repeat(-1)))
+
+    def bulk_taxid(self, indices):
+        """Returns the integer taxids of many indices."""
+        return _take(self.taxids, indices)
+
+    def bulk_name(self, indices):
+        """Returns the scientific names of many indices, as a list."""
+        names = {index: self.name(index) for index in set(indices)}
+        return list(map(names.__getitem__, indices))
+
+    def bulk_depth(self, indices):
+        """Returns the depths of many indices, the roots being at depth 0."""
+        if self.depths is None:
+            self.build_lca_index()
+        return _take(self.depths, indices)
+
+    def bulk_parent(self, indices):
+        """Returns the parents of many indices; a root is its own parent."""
+        return _take(self.parents, indices)
+
+    def bulk_rank_ancestor(self, indices, rank):
+        """Returns the indices many nodes roll up to at `rank`.
+
+        See `build_rollup`.
+        """
+        return _take(self.rollup(rank), indices)
+
+    def bulk_lca(self, indices_a, indices_b):
+        """Finds the lowest common ancestors of pairs of nodes.
+
+        With NumPy, all pairs are lifted through the binary lifting table
+        together, one level at a time, as `lca` does for a single pair.
+
+        Parameters
+        ----------
+        indices_a, indices_b : sequence of int
+            indices of the nodes, paired up by position
+
+        Returns
+        -------
+        array
+            index of the lowest common ancestor of each pair, -1 for pairs
+            in disconnected trees
+
+        """
+        if len(indices_a) != len(indices_b):
+            raise ValueError("Expected as many nodes in each sequence, got %d"
+                             " and %d." % (len(indices_a), len(indices_b)))
+        if self.jumps is None:
+            self.build_lca_index()
+        if numpy is None:
+            lcas = {pair: self.lca(*pair) for pair in set(zip(indices_a,
+                                                              indices_b))}
+            return array.array('i', map(lcas.__getitem__,
+                                        zip(indices_a, indices_b)))
+
+        num_nodes = len(self.taxids)
+        depths = numpy.asarray(self.depths)
+        parents = numpy.asarray(self.parents)
+        jumps = numpy.asarray(self.jumps).reshape(-1, num_nodes)
+        index_a = numpy.asarray(indices_a, dtype=numpy.intp)
+        index_b = numpy.asarray(indices_b, dtype=numpy.intp)
+
+        # Make index_a the deeper node, then lift it to index_b's depth
+        swap = depths[index_a] < depths[index_b]
+        index_a, index_b = (numpy.where(swap, index_b, index_a),
+                            numpy.where(swap, index_a, index_b))
+        distance = depths[index_a] - depths[index_b]
+        for level, level_jumps in enumerate(jumps):
+            lift = (distance >> level) & 1 == 1
+            index_a[lift] = level_jumps[index_a[lift]]
+
+        for level_jumps in jumps[::-1]:
+            jump_a = level_jumps[index_a]
+            jump_b = level_jumps[index_b]
+            differ = jump_a != jump_b
+            index_a[differ] = jump_a[differ]
+            index_b[differ] = jump_b[differ]
+
+        parent_a = parents[index_a]
+        lcas = numpy.where(parent_a == parents[index_b], parent_a, -1)
+        same = index_a == index_b
+        lcas[same] = index_a[same]
+        return lcas.astype(numpy.int32)
+
+    def _index_or_missing(self, taxid):
+        try:
+            return self.index(taxid)
+        except KeyError:
+            return -1
+
+    def _gi_index_or_missing(self, gi):
+        try:
+            return self.gi_index(gi)
+        except KeyError:
+            return -1
+
+    def record(self, index):
+        """Builds the TaxIDDataRecord of the node at `index`."""
+        taxids = self.taxids
+        return TaxIDDataRecord(
+            str(taxids[index]),
+            self.name(index),
+            [str(gi) for gi in self.assoc_gis(index)],
+            [str(taxids[child]) for child in self.child_indices(index)],
+            [str(taxids[parent]) for parent in self.ancestors(index)],
+            self.rank(index))
+
+
+class SubtreeView(collections.abc.Mapping):
+    """Read-only view of part of a Taxonomy.
+
+    The view is a list of disjoint intervals of the taxonomy's pre-order, so
+    creating one and testing membership cost nothing per node. It behaves
+    like the dict `taxidtool.build_branch` and `taxidtool.build_tree` return.
+
+    """
+    def __init__(self, taxonomy, ranges):
+        self.taxonomy = taxonomy
+        self.ranges = ranges
+        self._starts = [start for start, _ in ranges]
+
+    def __len__(self):
+        return sum(end - start for start, end in self.ranges)
+
+    def __iter__(self):
+        taxids = self.taxonomy.taxids
+        for index in self.indices():
+            yield str(taxids[index])
+
+    def __contains__(self, taxid):
+        try:
+            index = self.taxonomy.index(taxid)
+        except KeyError:
+            return False
+        return self.contains_index(index)
+
+    def __getitem__(self, taxid):
+        index = self.taxonomy.index(taxid)
+        if not self.contains_index(index):
+            raise KeyError(taxid)
+        return self.taxonomy.record(index)
+
+    def contains_index(self, index):
+        """Whether the node at `index` of the taxonomy is in this view."""
+        position = self.taxonomy.enter[index]
+        slot = bisect.bisect_right(self._starts, position) - 1
+        return slot >= 0 and position < self.ranges[slot][1]
+
+    def indices(self):
+        """Yields the taxonomy indices of the nodes in this view, in
+        pre-order."""
+        preorder = self.taxonomy.preorder
+        for start, end in self.ranges:
+            yield from preorder[start:end]
+
+
+def _is_sorted(values):
+    return all(map(operator.le, values, itertools.islice(values, 1, None)))
+
+
+def _take(values, indices):
+    """Looks up many `indices` of `values`, with NumPy fancy indexing when
+    it is installed."""
+    if numpy is None:
+        return array.array('i', map(values.__getitem__, indices))
+    return numpy.asarray(values)[numpy.asarray(indices, dtype=numpy.intp)]
+
+
+def _search_sorted(keys, queries):
+    """Finds many integer queries in the sorted array `keys` with NumPy.
+
+    Returns the position of each query in `keys` and a mask of the queries
+    found there, or None if a query is not an integer.
+    """
+    try:
+        values = numpy.fromiter(map(int, queries), numpy.int64, len(queries))
+    except (TypeError, ValueError, OverflowError):
+        return None
+    keys = numpy.asarray(keys)
+    # Searching for values of the keys' own type saves a converted copy of
+    # the keys on every search
+    limits = numpy.iinfo(keys.dtype)
+    found = (values >= limits.min) & (values <= limits.max)
+    values = values.clip(limits.min, limits.max).astype(keys.dtype)
+    # Searching in sorted order walks `keys` from front to back instead of
+    # jumping around it, which is several times faster on large arrays
+    order = numpy.argsort(values)
+    positions = numpy.empty(len(values), numpy.intp)
+    positions[order] = numpy.searchsorted(keys, values[order])
+    found &= positions < len(keys)
+    found[found] = keys[positions[found]] == values[found]
+    return positions, found
+
+
+def _bulk_search(keys, queries):
+    """Finds many integer queries in the sorted array `keys`.
+
+    Each distinct query is searched for once. Returns a dict of each query
+    found to its position in `keys`; queries which are missing or not
+    integers are left out.
+    """
+    positions = {}
+    for query in set(queries):
+        try:
+            value = int(query)
+        except (TypeError, ValueError):
+            continue
+        position = bisect.bisect_left(keys, value)
+        if position != len(keys) and keys[position] == value:
+            positions[query] = position
+    return positions
+
+
+def _pack_gi_taxa(gis, gi_taxa):
+    """Packs each gi with its taxon index into one integer which sorts like
+    the pair; taxon indices fit in 32 bits."""
+    return map(operator.or_, map(operator.lshift, gis, itertools.repeat(32)),
+               gi_taxa)
+
+
+def _unpack_gi_taxa(packed):
+    """Splits integers packed by `_pack_gi_taxa` back into arrays of gis and
+    taxon indices."""
+    return (array.array('q', map(operator.rshift, packed,
+                                 itertools.repeat(32))),
+            array.array('i', map(operator.and_, packed,
+                                 itertools.repeat(0xffffffff))))
+
+
+class GiLookup(collections.abc.Mapping):
+    """Read-only mapping of gi to taxid backed by a Taxonomy's gi index.
+
+    Behaves like the dict `taxidtool.build_gis_to_taxids` returns, with gis
+    and taxids as strings, optionally restricted to the gis of a
+    SubtreeView.
+
+    """
+    def __init__(self, taxonomy, tree=None):
+        self.taxonomy = taxonomy
+        self.tree = tree
+        if taxonomy.sorted_gis is None:
+            taxonomy.build_gi_index()
+
+    def __len__(self):
+        if self.tree is None:
+            return len(self.taxonomy.gis)
+        gi_offsets = self.taxonomy.gi_offsets
+        return sum(gi_offsets[index + 1] - gi_offsets[index]
+                   for index in self.tree.indices())
+
+    def __iter__(self):
+        taxonomy = self.taxonomy
+        if self.tree is None:
+            for gi in taxonomy.sorted_gis:
+                yield str(gi)
+            return
+        # Only walk the gis of the tree, which is usually a small part of the
+        # taxonomy
+        gis, gi_offsets = taxonomy.gis, taxonomy.gi_offsets
+        for index in self.tree.indices():
+            for position in range(gi_offsets[index], gi_offsets[index + 1]):
+                yield str(gis[position])
+
+    def __getitem__(self, gi):
+        index = self.taxonomy.gi_index(gi)
+        if self.tree is not None and not self.tree.contains_index(index):
+            raise KeyError(gi)
+        return str(self.taxonomy.taxids[index])
+
+
+def _merge_ranges(ranges):
+    """Sorts ranges and merges the overlapping ones."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _in_ranges(ranges, position):
+    return any(start <= position < end for start, end in ranges)
+
+
+def _subtract_ranges(ranges, removed):
+    """Removes the merged ranges `removed` from the merged ranges `ranges`."""
+    results = []
+    for start, end in ranges:
+        for removed_start, removed_end in removed:
+            if removed_end <= start or removed_start >= end:
+                continue
+            if removed_start > start:
+                results.append((start, removed_start))
+            start = max(start, removed_end)
+        if start < end:
+            results.append((start, end))
+    return results
+
+
+_TSVChunk = collections.namedtuple(
+    "_TSVChunk", ("taxids", "parent_taxids", "ranks", "sci_names", "gis",
+                  "gi_offsets"))
+
+
+def _decode_tsv_range(input_fp, start, end):
+    """Decodes the lines of a TSV taxid_data file in the byte range
+    `start`:`end` into a _TSVChunk of flat arrays."""
+    taxids = array.array('i')
+    parent_taxids = array.array('i')
+    ranks = []
+    sci_names = []
+    gis = array.array('q')
+    gi_offsets = array.array('q', [0])
+    for line in iter_chunk_lines(input_fp, start, end):
+        taxid, sci_name, assoc_gis, _, ancestors, rank = \
+            line.rstrip().split("\t")
+        taxid = int(taxid)
+        taxids.append(taxid)
+        # The last ancestor is the parent; roots have none
+        if ancestors == "[]":
+            parent_taxids.append(taxid)
+        else:
+            parent_taxids.append(
+                int(ancestors[1:-1].rsplit(",", 1)[-1].strip(' "')))
+        ranks.append(rank)
+        sci_names.append(sci_name)
+        if assoc_gis != "[]":
+            gis.extend(map(int, assoc_gis[1:-1].replace('"', '').split(',')))
+        gi_offsets.append(len(gis))
+    return _TSVChunk(taxids, parent_taxids, ranks, sci_names, gis, gi_offsets)
+
+
+class _TaxonomyBuilder:
+    """Accumulates nodes, names and gis into the arrays of a Taxonomy.
+
+    Nodes must all be added (and `finish_nodes` called) before any names or
+    gis, since those are placed by the index of their taxid.
+
+    """
+    def __init__(self):
+        self._node_taxids = array.array('i')
+        self._node_parents = array.array('i')
+        self._node_ranks = array.array('B')
+        self._rank_names = []
+        self._rank_codes = {}
+        self._sci_names = None
+        self._gi_values = array.array('q')
+        self._gi_indices = array.array('i')
+
+    def add_node(self, taxid, parent_taxid, rank):
+        if rank not in self._rank_codes:
+            self._rank_codes[rank] = len(self._rank_names)
+            self._rank_names.append(rank)
+        self._node_taxids.append(int(taxid))
+        self._node_parents.append(int(parent_taxid))
+        self._node_ranks.append(self._rank_codes[rank])
+
+    def finish_nodes(self):
+        node_taxids = self._node_taxids
+        num_nodes = len(node_taxids)
+        order = sorted(range(num_nodes), key=node_taxids.__getitem__)
+
+        self.taxids = array.array('i', (node_taxids[i] for i in order))
+        self.ranks = array.array('B', (self._node_ranks[i] for i in order))
+
+        # file position of a node -> index of the node
+        node_index = array.array('i', bytes(4 * num_nodes))
+        for index, node in enumerate(order):
+            node_index[node] = index
+
+        self.parents = array.array('i', bytes(4 * num_nodes))
+        for node in range(num_nodes):
+            self.parents[node_index[node]] = \
+                self._index(self._node_parents[node])
+
+        # Children are kept in the order they appeared in, like
+        # build_taxid_data does.
+        self.child_offsets = self._count_offsets(
+            self.parents[node_index[node]] for node in range(num_nodes)
+            if self.parents[node_index[node]] != node_index[node])
+        self.children = array.array('i', bytes(4 * self.child_offsets[-1]))
+        fill = array.array('q', self.child_offsets[:-1])
+        for node in range(num_nodes):
+            index = node_index[node]
+            parent = self.parents[index]
+            if parent != index:
+                self.children[fill[parent]] = index
+                fill[parent] += 1
+
+        self._sci_names = [None] * num_nodes
+        self._node_taxids = self._node_parents = self._node_ranks = None
+
+    def add_name(self, taxid, sci_name):
+        self._sci_names[self._index(taxid)] = sci_name
+
+    def add_gi(self, gi, taxid):
+        # gi_taxid_nucl.dmp maps unplaced gis to taxids which are not in
+        # nodes.dmp (e.g. 0); build_taxid_data drops them as well.
+        try:
+            index = self._index(taxid)
+        except ValueError:
+            return
+        self._gi_indices.append(index)
+        self._gi_values.append(int(gi))
+
+    def build(self, gis=None, gi_offsets=None):
+        """Builds the Taxonomy.
+
+        The gis added with `add_gi` are used, unless `gis` and `gi_offsets`
+        are given already laid out by taxid index.
+        """
+        if None in self._sci_names:
+            raise ValueError("NCBI dump files do not make sense")
+
+        names = bytearray()
+        name_offsets = array.array('q', [0])
+        for sci_name in self._sci_names:
+            names += sci_name.encode()
+            name_offsets.append(len(names))
+        self._sci_names = None
+
+        gi_index = None
+        if gis is None:
+            # Counting sort of the gis by taxid index; stable, so the gis of a
+            # taxid keep the order they were added in.
+            gi_offsets = self._count_offsets(self._gi_indices)
+            gis = array.array('q', bytes(8 * gi_offsets[-1]))
+            fill = array.array('q', gi_offsets[:-1])
+            for index, gi in zip(self._gi_indices, self._gi_values):
+                gis[fill[index]] = gi
+                fill[index] += 1
+            # gi_taxid_nucl.dmp lists gis in ascending order, in which case
+            # the gis as added already make up the gi index
+            if _is_sorted(self._gi_values):
+                gi_index = (self._gi_values, self._gi_indices)
+        self._gi_indices = self._gi_values = None
+
+        taxonomy = Taxonomy(self.taxids, self.parents, self.ranks,
+                            self._rank_names, bytes(names), name_offsets,
+                            self.children, self.child_offsets, gis,
+                            gi_offsets)
+        if gi_index is not None:
+            taxonomy.sorted_gis, taxonomy.sorted_gi_taxa = gi_index
+        return taxonomy
+
+    def _index(self, taxid):
+        value = int(taxid)
+        index = bisect.bisect_left(self.taxids, value)
+        if index == len(self.taxids) or self.taxids[index] != value:
+            raise ValueError("NCBI dump files do not make sense")
+        return index
+
+    def _count_offsets(self, indices):
+        offsets = array.array('q', bytes(8 * (len(self.taxids) + 1)))
+        for index in indices:
+            offsets[index + 1] += 1
+        for index in range(len(self.taxids)):
+            offsets[index + 1] += offsets[index]
+        return offsets
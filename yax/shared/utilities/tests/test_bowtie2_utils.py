@@ -0,0 +1,274 @@
+import concurrent.futures
+import contextlib
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from yax.shared.utilities import bowtie2_utils
+from yax.shared.utilities.bowtie2_utils import (bt2_align_command,
+                                                build_index, cached_index,
+                                                call_bt2_align, index_shards,
+                                                iter_bt2_align, merge_sam)
+from yax.shared.utilities.file_cache import FileCache
+
+# Stands in for bowtie2: writes a SAM header, then one record per FASTA read
+# given with -U (a file or - for stdin), to -S or stdout. A read aligns,
+# scoring -(its length), if its sequence is in the index built by the fake
+# bowtie2-build below.
+FAKE_BOWTIE2 = """\
+import os
+import sys
+args = sys.argv[1:]
+if "--fail" in args:
+    sys.stderr.write("index not found\\n")
+    sys.exit(1)
+index = args[args.index("-x") + 1]
+references = ""
+if os.path.exists(index + ".1.bt2"):
+    references = open(index + ".1.bt2").read()
+reads = args[args.index("-U") + 1]
+fh = sys.stdin if reads == "-" else open(reads)
+out = open(args[args.index("-S") + 1], "w") if "-S" in args else sys.stdout
+out.write("@HD\\tVN:1.0\\n@SQ\\tSN:%s\\n" % os.path.basename(index))
+out.flush()
+for line in fh:
+    line = line.strip()
+    if line.startswith(">"):
+        name = line[1:]
+    elif line in references:
+        out.write("%s\\t0\\t%s\\t1\\t42\\t*\\t*\\t0\\t0\\t*\\t*\\tAS:i:%d\\n"
+                  % (name, os.path.basename(index), -len(line)))
+    else:
+        out.write("%s\\t4\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\t*\\t*\\n" % name)
+    out.flush()
+"""
+
+# Stands in for bowtie2-build: writes the index file set, counting its calls.
+FAKE_BOWTIE2_BUILD = """\
+import sys
+fasta_fp, index_fp = sys.argv[-2:]
+with open(fasta_fp) as fh, open(index_fp + ".1.bt2", "w") as out:
+    out.write(" ".join(sys.argv[1:-2]) + fh.read())
+with open(sys.argv[0] + ".calls", "a") as fh:
+    fh.write("x")
+"""
+
+
+def write_script(fp, source):
+    with open(fp, mode='w') as fh:
+        fh.write("#!%s\n%s" % (sys.executable, source))
+    os.chmod(fp, os.stat(fp).st_mode | stat.S_IXUSR)
+
+
+class TestBowtie2Utils(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.temp_dir = self._temp_dir.name
+        fake_fp = os.path.join(self.temp_dir, 'bowtie2')
+        write_script(fake_fp, FAKE_BOWTIE2)
+        self.fake_build_fp = os.path.join(self.temp_dir, 'bowtie2-build')
+        write_script(self.fake_build_fp, FAKE_BOWTIE2_BUILD)
+        self._executables = bowtie2_utils.BOWTIE2, bowtie2_utils.BOWTIE2_BUILD
+        bowtie2_utils.BOWTIE2 = fake_fp
+        bowtie2_utils.BOWTIE2_BUILD = self.fake_build_fp
+
+        self.reads_fp = os.path.join(self.temp_dir, 'reads.fasta')
+        with open(self.reads_fp, mode='w') as fh:
+            fh.write(">r1\nACGT\n>r2\nGGCC\n")
+
+    def tearDown(self):
+        bowtie2_utils.BOWTIE2, bowtie2_utils.BOWTIE2_BUILD = self._executables
+        self._temp_dir.cleanup()
+
+    def test_bt2_align_command(self):
+        command = bt2_align_command("idx", "reads.fasta", "out.sam",
+                                    "--local -k 'a b'", threads=4)
+        self.assertEqual(command[1:], ["--local", "-k", "a b", "-p", "4",
+                                       "-x", "idx", "-f", "-U", "reads.fasta",
+                                       "-S", "out.sam"])
+        self.assertEqual(bt2_align_command("idx")[-2:], ["-U", "-"])
+
+    def test_call_bt2_align(self):
+        output_fp = os.path.join(self.temp_dir, 'out.sam')
+        call_bt2_align(self.reads_fp, "idx", output_fp, "")
+        with open(output_fp) as fh:
+            lines = fh.readlines()
+        self.assertEqual([line.split("\t")[0] for line in lines],
+                         ["@HD", "@SQ", "r1", "r2"])
+
+    def test_call_bt2_align_failure(self):
+        output_fp = os.path.join(self.temp_dir, 'out.sam')
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            call_bt2_align(self.reads_fp, "idx", output_fp, "--fail")
+        self.assertEqual(context.exception.returncode, 1)
+        self.assertIn("index not found", context.exception.stderr)
+
+    def test_iter_bt2_align_file(self):
+        lines = list(iter_bt2_align("idx", self.reads_fp))
+        self.assertEqual([line.split("\t")[0] for line in lines],
+                         ["@HD", "@SQ", "r1", "r2"])
+
+    def test_iter_bt2_align_pipe(self):
+        reads = (">r%d\nACGT\n" % n for n in range(5000))
+        names = [line.split("\t")[0] for line in iter_bt2_align("idx", reads)
+                 if not line.startswith("@")]
+        self.assertEqual(names, ["r%d" % n for n in range(5000)])
+
+    def test_iter_bt2_align_streams(self):
+        lines = iter_bt2_align("idx", iter([">r1\nACGT\n"]))
+        self.assertTrue(next(lines).startswith("@HD"))
+        self.assertTrue(next(lines).startswith("@SQ"))
+        self.assertTrue(next(lines).startswith("r1\t"))
+        self.assertEqual(list(lines), [])
+
+    def test_iter_bt2_align_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            list(iter_bt2_align("idx", self.reads_fp, "--fail"))
+        self.assertIn("index not found", context.exception.stderr)
+
+    def test_cached_index(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        index = cached_index(self.reads_fp, cache_dir)
+        with open(index + ".1.bt2") as fh:
+            self.assertEqual(fh.read(), ">r1\nACGT\n>r2\nGGCC\n")
+
+        # The same references, even in another file, reuse the index
+        copy_fp = os.path.join(self.temp_dir, 'copy.fasta')
+        with open(self.reads_fp) as fh, open(copy_fp, mode='w') as out:
+            out.write(fh.read())
+        self.assertEqual(cached_index(copy_fp, cache_dir), index)
+
+        other = cached_index(self.reads_fp, cache_dir, "--seed  1")
+        self.assertNotEqual(other, index)
+        self.assertEqual(cached_index(self.reads_fp, cache_dir, "--seed 1"),
+                         other)
+        with open(self.fake_build_fp + ".calls") as fh:
+            self.assertEqual(fh.read(), "xx")
+
+    def test_cached_index_pinned(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        with contextlib.ExitStack() as pins:
+            index = cached_index(self.reads_fp, cache_dir, pins=pins)
+            entry = os.path.basename(os.path.dirname(index))
+            # Even a full cache keeps an index which is in use
+            cache = FileCache(cache_dir, max_size=0)
+            cache.evict()
+            self.assertTrue(os.path.isdir(os.path.dirname(index)))
+        cache.evict()
+        self.assertFalse(os.path.exists(os.path.dirname(index)))
+        self.assertNotIn("." + entry + ".lock", os.listdir(cache_dir))
+
+    def write_references(self):
+        references_fp = os.path.join(self.temp_dir, 'references.fasta')
+        with open(references_fp, mode='w') as fh:
+            fh.write(">a\nACGTACGT\n>b\nGGCCTTAA\n>c\nACGTAAAA\n"
+                     ">d\nTTTTCCCC\n")
+        return references_fp
+
+    def test_build_index_threads(self):
+        index_fp = os.path.join(self.temp_dir, 'index')
+        build_index(self.write_references(), index_fp, threads=4)
+        with open(index_fp + ".1.bt2") as fh:
+            self.assertTrue(fh.read().startswith("--threads 4>a"))
+        self.assertEqual(index_shards(index_fp), [index_fp])
+
+    def test_build_index_shards(self):
+        index_fp = os.path.join(self.temp_dir, 'index')
+        build_index(self.write_references(), index_fp, threads=4, shards=2)
+
+        shards = index_shards(index_fp)
+        self.assertEqual(shards, [index_fp + ".shard0", index_fp + ".shard1"])
+        contents = []
+        for shard_fp in shards:
+            with open(shard_fp + ".1.bt2") as fh:
+                contents.append(fh.read())
+        self.assertEqual(contents, ["--threads 2>a\nACGTACGT\n>b\nGGCCTTAA\n",
+                                    "--threads 2>c\nACGTAAAA\n>d\nTTTTCCCC\n"])
+        # The FASTA files of the shards are removed once indexed
+        self.assertEqual([name for name in os.listdir(self.temp_dir)
+                          if os.path.isdir(os.path.join(self.temp_dir,
+                                                        name))], [])
+
+    def test_build_index_shards_within_budget(self):
+        index_fp = os.path.join(self.temp_dir, 'index')
+        with mock.patch.object(concurrent.futures, 'ThreadPoolExecutor',
+                               wraps=concurrent.futures.ThreadPoolExecutor
+                               ) as executor:
+            build_index(self.write_references(), index_fp, threads=1,
+                        shards=2)
+        executor.assert_called_once_with(max_workers=1)
+        with open(index_fp + ".shard1.1.bt2") as fh:
+            self.assertTrue(fh.read().startswith(">c"))
+
+    def test_call_bt2_align_shards(self):
+        index_fp = os.path.join(self.temp_dir, 'index')
+        build_index(self.write_references(), index_fp, shards=2)
+        with open(self.reads_fp, mode='w') as fh:
+            fh.write(">r1\nACGTA\n>r2\nTTTTC\n>r3\nAAAAA\n>r4\nACGT\n")
+        output_fp = os.path.join(self.temp_dir, 'out.sam')
+
+        # Streamed from both shards at once, then one shard at a time
+        for threads in (4, 1, None):
+            call_bt2_align(self.reads_fp, index_fp, output_fp, "", threads)
+            with open(output_fp) as fh:
+                lines = [line.rstrip("\n").split("\t") for line in fh]
+            self.assertEqual(lines[:3], [["@HD", "VN:1.0"],
+                                         ["@SQ", "SN:index.shard0"],
+                                         ["@SQ", "SN:index.shard1"]])
+            self.assertEqual([line[:3] for line in lines[3:]],
+                             [["r1", "0", "index.shard0"],
+                              ["r2", "0", "index.shard1"],
+                              ["r3", "4", "*"],
+                              ["r4", "0", "index.shard0"]])
+        # The temporary SAM files of the shards are removed
+        self.assertEqual([name for name in os.listdir(self.temp_dir)
+                          if os.path.isdir(os.path.join(self.temp_dir,
+                                                        name))], [])
+
+    def test_merge_sam(self):
+        first = ["@HD\tVN:1.0\n", "@SQ\tSN:a\n", "@PG\tID:bowtie2\n",
+                 "r1\t0\ta\t1\t1\t*\t*\t0\t0\t*\t*\tAS:i:-5\n",
+                 "r2\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*\n",
+                 "r3\t0\ta\t1\t1\t*\t*\t0\t0\t*\t*\tAS:i:-2\n",
+                 "r3\t256\ta\t9\t1\t*\t*\t0\t0\t*\t*\tAS:i:-8\n"]
+        second = ["@HD\tVN:1.0\n", "@SQ\tSN:b\n", "@PG\tID:bowtie2\n",
+                  "r1\t0\tb\t1\t1\t*\t*\t0\t0\t*\t*\tAS:i:-1\n",
+                  "r2\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*\n",
+                  "r3\t0\tb\t1\t1\t*\t*\t0\t0\t*\t*\tAS:i:-2\n"]
+        merged = [line.split("\t")[:3] for line in merge_sam([first, second])]
+        self.assertEqual(merged, [["@HD", "VN:1.0\n"], ["@SQ", "SN:a\n"],
+                                  ["@SQ", "SN:b\n"], ["@PG", "ID:bowtie2\n"],
+                                  ["r1", "0", "b"],
+                                  ["r2", "4", "*"],
+                                  ["r3", "0", "a"], ["r3", "256", "b"]])
+
+        with self.assertRaises(ValueError):
+            list(merge_sam([first, second[:-1]]))
+
+    def test_merge_sam_tie_across_shards(self):
+        first = ["@HD\tVN:1.0\n",
+                 "r1\t0\ta\t1\t42\t*\t*\t0\t0\t*\t*\tAS:i:-2\n",
+                 "r2\t0\ta\t1\t42\t*\t*\t0\t0\t*\t*\tAS:i:-2\n",
+                 "r3\t0\ta\t1\t0\t*\t*\t0\t0\t*\t*\tAS:i:-2\tXS:i:-2\n"]
+        second = ["@HD\tVN:1.0\n",
+                  "r1\t0\tb\t1\t42\t*\t*\t0\t0\t*\t*\tAS:i:-2\n",
+                  "r2\t0\tb\t1\t42\t*\t*\t0\t0\t*\t*\tAS:i:-9\n",
+                  "r3\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*\n"]
+        merged = [line.rstrip("\n").split("\t")
+                  for line in merge_sam([first, second])][1:]
+        self.assertEqual(
+            [fields[:5] + fields[11:] for fields in merged],
+            # Equally good in both shards: not unique
+            [["r1", "0", "a", "1", "1", "AS:i:-2", "XS:i:-2"],
+             # Better than the other shard: the second best is from there
+             ["r2", "0", "a", "1", "42", "AS:i:-2", "XS:i:-9"],
+             # Only aligned in one shard: left as reported
+             ["r3", "0", "a", "1", "0", "AS:i:-2", "XS:i:-2"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
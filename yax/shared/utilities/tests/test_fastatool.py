@@ -0,0 +1,182 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from yax.util import get_data_path
+from yax.shared.utilities import fastatool, taxidtool
+from yax.shared.utilities.taxonomy import Taxonomy
+
+
+class TestFastaTool(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.sequences_fp = os.path.join(self.temp_dir.name, 'sequences.fasta')
+        shutil.copy(get_data_path('sequences.fasta'), self.sequences_fp)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_header_gi(self):
+        self.assertEqual(fastatool.get_header_gi(">ACCESSION GI:40 Node4\n"),
+                         "40")
+        self.assertEqual(fastatool.get_header_gi(b">ACCESSION GI:40 Node4\n"),
+                         b"40")
+
+    def test_build_fasta_index(self):
+        fasta_index = fastatool.build_fasta_index(self.sequences_fp)
+        with open(self.sequences_fp, mode='rb') as fh:
+            data = fh.read()
+
+        self.assertEqual(len(fasta_index), data.count(b">"))
+        self.assertEqual(sum(fasta_index.lengths), len(data))
+        offset, length = fasta_index.locate('40')
+        self.assertEqual(offset, 0)
+        record = data[offset:offset + length]
+        self.assertTrue(record.startswith(b">ACCESSION GI:40 "))
+        self.assertEqual(record.count(b">"), 1)
+        self.assertTrue(data[offset + length:].startswith(b">"))
+
+        self.assertIsNone(fasta_index.locate('41'))
+        self.assertIsNone(fasta_index.locate('not a gi'))
+        self.assertNotIn('41', fasta_index)
+
+    def test_build_fasta_index_unsorted(self):
+        gis = [7, 3, 12, 3, 5, 1, 9, 7, 2]
+        with open(self.sequences_fp, mode='w') as fh:
+            for position, gi in enumerate(gis):
+                fh.write(">ACCESSION GI:%d Node%d\n%s\n"
+                         % (gi, position, "A" * (position + 1)))
+        with open(self.sequences_fp, mode='rb') as fh:
+            data = fh.read()
+
+        expected = fastatool.build_fasta_index(self.sequences_fp)
+        with mock.patch.object(fastatool, 'INDEX_SORT_CHUNK', 2):
+            fasta_index = fastatool.build_fasta_index(self.sequences_fp)
+
+        for built in (expected, fasta_index):
+            self.assertEqual(list(built.gis), sorted(gis))
+            records = [data[offset:offset + length] for offset, length
+                       in zip(built.offsets, built.lengths)]
+            self.assertEqual(sorted(records, key=lambda r: (
+                int(fastatool.get_header_gi(r.split(b"\n")[0])),
+                data.index(r))), records)
+            self.assertEqual(sorted(records), sorted(
+                b">" + r for r in data.split(b">")[1:]))
+        # Records sharing a gi keep their order in the file
+        offset, length = fasta_index.locate(3)
+        self.assertTrue(data[offset:offset + length].startswith(
+            b">ACCESSION GI:3 Node1\n"))
+
+    def test_open_fasta_index(self):
+        index_fp = self.sequences_fp + ".gidx"
+        built = fastatool.open_fasta_index(self.sequences_fp)
+        self.assertTrue(os.path.isfile(index_fp))
+
+        loaded = fastatool.load_fasta_index(self.sequences_fp, index_fp)
+        self.assertEqual(list(loaded.gis), list(built.gis))
+        self.assertEqual(list(loaded.offsets), list(built.offsets))
+        self.assertEqual(list(loaded.lengths), list(built.lengths))
+
+        # A changed sequences file invalidates the index
+        with open(self.sequences_fp, mode='a') as fh:
+            fh.write(">ACCESSION GI:999 Node9\nACGT\n")
+        self.assertIsNone(fastatool.load_fasta_index(self.sequences_fp,
+                                                     index_fp))
+        rebuilt = fastatool.open_fasta_index(self.sequences_fp)
+        self.assertIn('999', rebuilt)
+
+    def test_open_fasta_index_unwritable(self):
+        index_fp = os.path.join(self.temp_dir.name, 'missing',
+                                'index.gidx')
+        fasta_index = fastatool.open_fasta_index(self.sequences_fp, index_fp)
+        self.assertFalse(os.path.exists(index_fp))
+        self.assertEqual(list(fasta_index.gis),
+                         list(fastatool.build_fasta_index(
+                             self.sequences_fp).gis))
+
+    def test_output_sequences_with_index(self):
+        taxid_data = Taxonomy.from_taxid_data(
+            taxidtool.parse_taxid_data(get_data_path('taxid_data.txt')))
+        tree = taxidtool.build_tree(taxid_data, None, ['6'], ['20'])
+        gis_to_taxids = taxidtool.build_gis_to_taxids(tree)
+        fasta_index = fastatool.open_fasta_index(self.sequences_fp)
+
+        outputs = []
+        for index in (None, fasta_index):
+            with tempfile.TemporaryDirectory() as output_dir:
+                counts = taxidtool.output_sequences(
+                    taxid_data, tree, gis_to_taxids, self.sequences_fp,
+                    output_dir, 'species', index)
+                with open(os.path.join(output_dir, "_seqs.fasta")) as fh:
+                    outputs.append((fh.read(), counts))
+            with tempfile.TemporaryDirectory() as output_dir:
+                counts = taxidtool.output_sequences(
+                    taxid_data, tree, gis_to_taxids, self.sequences_fp,
+                    output_dir, 'species', index, compression="bgzip")
+                with gzip.open(os.path.join(output_dir, "_seqs.fasta.gz"),
+                               mode='rt') as fh:
+                    outputs.append((fh.read(), counts))
+
+        for output in outputs[1:]:
+            self.assertEqual(outputs[0], output)
+        sequences, counts = outputs[0]
+        self.assertTrue(sequences.startswith(">60-6\n"))
+        self.assertEqual(set(counts), {'6', '16', '18', '22'})
+        self.assertEqual(sum(counts.values()), sequences.count(">"))
+
+    def test_fasta_writer(self):
+        with open(self.sequences_fp, mode='rb') as fh:
+            data = fh.read()
+        records = [b">" + record for record in data.split(b"\n>")]
+        records[0] = records[0][1:]
+
+        for compression in fastatool.COMPRESSIONS:
+            output_fp = os.path.join(self.temp_dir.name, "out.fasta")
+            # A small block size forces many aligned flushes
+            with fastatool.FastaWriter(output_fp, compression,
+                                       block_size=100) as writer:
+                for record in records:
+                    header, body = record.split(b"\n", 1)
+                    writer.write_record(header + b"\n", body + b"\n")
+            if compression is None:
+                with open(output_fp, mode='rb') as fh:
+                    written = fh.read()
+            else:
+                with gzip.open(output_fp, mode='rb') as fh:
+                    written = fh.read()
+            self.assertEqual(written.rstrip(b"\n"), data.rstrip(b"\n"))
+
+    def test_fasta_writer_bgzip_blocks(self):
+        output_fp = os.path.join(self.temp_dir.name, "out.fasta.gz")
+        with fastatool.FastaWriter(output_fp, "bgzip") as writer:
+            with open(self.sequences_fp, mode='rb') as fh:
+                writer.copy_from(fh)
+        with open(output_fp, mode='rb') as fh:
+            compressed = fh.read()
+
+        # Walk the blocks through their BSIZE fields
+        position = 0
+        blocks = 0
+        while position < len(compressed):
+            self.assertEqual(compressed[position:position + 4],
+                             b"\x1f\x8b\x08\x04")
+            self.assertEqual(compressed[position + 12:position + 14], b"BC")
+            position += int.from_bytes(
+                compressed[position + 16:position + 18], 'little') + 1
+            blocks += 1
+        self.assertEqual(position, len(compressed))
+        self.assertEqual(blocks, os.path.getsize(self.sequences_fp) //
+                         fastatool.BGZF_BLOCK_SIZE + 2)
+        self.assertTrue(compressed.endswith(fastatool._BGZF_EOF))
+
+    def test_fasta_writer_unknown_compression(self):
+        with self.assertRaises(ValueError):
+            fastatool.FastaWriter(os.path.join(self.temp_dir.name, "out"),
+                                  "xz")
+
+
+if __name__ == '__main__':
+    unittest.main()
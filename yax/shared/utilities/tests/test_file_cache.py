@@ -0,0 +1,152 @@
+import contextlib
+import os
+import tempfile
+import time
+import unittest
+
+from yax.util import get_data_path
+from yax.shared.utilities.file_cache import FileCache
+from yax.shared.utilities.taxonomy import Taxonomy
+
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.temp_dir = self._temp_dir.name
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def write_input(self, name, content):
+        fp = os.path.join(self.temp_dir, name)
+        with open(fp, mode='w') as fh:
+            fh.write(content)
+        return fp
+
+    def test_key(self):
+        cache = FileCache(self.cache_dir)
+        fp = self.write_input('input', 'abc')
+        key = cache.key('kind', [fp])
+        self.assertTrue(key.startswith('kind-'))
+        self.assertEqual(cache.key('kind', [fp]), key)
+        self.assertNotEqual(cache.key('other', [fp]), key)
+        self.assertNotEqual(cache.key('kind', [fp], 'option'), key)
+
+        self.write_input('input', 'abcd')
+        self.assertNotEqual(cache.key('kind', [fp]), key)
+
+    def test_get_or_create(self):
+        cache = FileCache(self.cache_dir)
+        fp = self.write_input('input', 'abc')
+        key = cache.key('kind', [fp])
+        self.assertIsNone(cache.get(key))
+
+        calls = []
+
+        def write(output_fp):
+            calls.append(output_fp)
+            with open(output_fp, mode='w') as fh:
+                fh.write('derived')
+
+        entry_fp = cache.get_or_create(key, write)
+        self.assertEqual(cache.get_or_create(key, write), entry_fp)
+        self.assertEqual(len(calls), 1)
+        with open(entry_fp) as fh:
+            self.assertEqual(fh.read(), 'derived')
+        self.assertEqual(os.listdir(self.cache_dir), [key])
+
+    def test_failed_write_leaves_nothing(self):
+        cache = FileCache(self.cache_dir)
+
+        def write(output_fp):
+            raise RuntimeError()
+
+        with self.assertRaises(RuntimeError):
+            cache.put('kind-key', write)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_evict_least_recently_used(self):
+        cache = FileCache(self.cache_dir, max_size=25)
+
+        def write(output_fp):
+            with open(output_fp, mode='w') as fh:
+                fh.write('x' * 10)
+
+        for key in ('a', 'b'):
+            cache.put(key, write)
+        past = time.time() - 100
+        os.utime(cache.path('a'), (past, past))
+        os.utime(cache.path('b'), (past - 100, past - 100))
+        # Using b makes a the least recently used entry
+        cache.get('b')
+        cache.put('c', write)
+
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['b', 'c'])
+
+    def test_evict_skips_pinned(self):
+        cache = FileCache(self.cache_dir, max_size=25)
+
+        def write(output_fp):
+            with open(output_fp, mode='w') as fh:
+                fh.write('x' * 10)
+
+        with contextlib.ExitStack() as pins:
+            cache.get_or_create('a', write, pins=pins)
+            cache.put('b', write)
+            past = time.time() - 100
+            os.utime(cache.path('a'), (past, past))
+            # a is the least recently used, but in use, so b goes instead
+            cache.put('c', write)
+            self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                             ['.a.lock', 'a', 'c'])
+
+        # Once unpinned, a is evicted along with its lock file
+        cache.put('d', write)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['c', 'd'])
+
+    def test_content_key(self):
+        cache = FileCache(self.cache_dir)
+        fp = self.write_input('input', 'abc')
+        key = cache.content_key('kind', [fp])
+        self.assertEqual(cache.content_key('kind', [self.write_input(
+            'copy', 'abc')]), key)
+        self.assertNotEqual(cache.content_key('kind', [fp], 'option'), key)
+        self.write_input('input', 'abcd')
+        self.assertNotEqual(cache.content_key('kind', [fp]), key)
+
+    def test_directory_entry(self):
+        cache = FileCache(self.cache_dir, max_size=25)
+
+        def write(output_dir):
+            for name in ('x', 'y'):
+                with open(os.path.join(output_dir, name), mode='w') as fh:
+                    fh.write('z' * 10)
+
+        entry_dir = cache.get_or_create('a', write, directory=True)
+        self.assertEqual(sorted(os.listdir(entry_dir)), ['x', 'y'])
+        # Publishing an entry another run already published keeps theirs
+        self.assertEqual(cache.put('a', write, directory=True), entry_dir)
+        self.assertEqual(os.listdir(self.cache_dir), ['a'])
+
+        past = time.time() - 100
+        os.utime(entry_dir, (past, past))
+        cache.put('b', write, directory=True)
+        self.assertEqual(os.listdir(self.cache_dir), ['b'])
+
+    def test_taxonomy_from_dmp_cached(self):
+        dmp_fps = (get_data_path('nodes.dmp'), get_data_path('names.dmp'),
+                   get_data_path('gi_taxid_nucl.dmp'))
+        expected = Taxonomy.from_dmp(*dmp_fps)
+
+        cached = Taxonomy.from_dmp(*dmp_fps, cache_dir=self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertIsNotNone(cached.jumps)
+        again = Taxonomy.from_dmp(*dmp_fps, cache_dir=self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        for taxonomy in (cached, again):
+            self.assertEqual(dict(taxonomy), dict(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+from yax.util import get_data_path
+from yax.shared.utilities import file_chunks
+
+
+class TestFileChunks(unittest.TestCase):
+    def assertCoversRecords(self, fp, ranges, record_start):
+        with open(fp, mode='rb') as fh:
+            data = fh.read()
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(data))
+        for (_, end), (start, __) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+        for start, end in ranges:
+            self.assertTrue(data[start:end].startswith(record_start))
+            self.assertTrue(start == 0 or data[start - 1:start] == b"\n")
+
+    def test_split_file_lines(self):
+        fp = get_data_path('taxid_data.txt')
+        for num_chunks in range(1, 30):
+            ranges = file_chunks.split_file(fp, num_chunks)
+            self.assertLessEqual(len(ranges), num_chunks)
+            self.assertCoversRecords(fp, ranges, b"")
+
+            lines = [line for start, end in ranges
+                     for line in file_chunks.iter_chunk_lines(fp, start,
+                                                              end)]
+            with open(fp, mode='r') as fh:
+                self.assertEqual(lines, fh.readlines())
+
+    def test_split_file_fasta(self):
+        fp = get_data_path('sequences.fasta')
+        for num_chunks in range(1, 30):
+            ranges = file_chunks.split_file(fp, num_chunks,
+                                            record_start=b">")
+            self.assertCoversRecords(fp, ranges, b">")
+
+    def test_split_file_small_scan_blocks(self):
+        fp = get_data_path('sequences.fasta')
+        scan_block_size = file_chunks.SCAN_BLOCK_SIZE
+        file_chunks.SCAN_BLOCK_SIZE = 3
+        try:
+            ranges = file_chunks.split_file(fp, 7, record_start=b">")
+        finally:
+            file_chunks.SCAN_BLOCK_SIZE = scan_block_size
+        self.assertEqual(ranges,
+                         file_chunks.split_file(fp, 7, record_start=b">"))
+
+    def test_split_empty_file(self):
+        with tempfile.TemporaryDirectory() as dir_:
+            fp = os.path.join(dir_, 'empty')
+            open(fp, mode='w').close()
+            self.assertEqual(file_chunks.split_file(fp, 4), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
+import json
+import os
 import unittest
 import tempfile
+from unittest import mock
 
 from yax.util import get_data_path
 import yax.shared.utilities.taxidtool as taxidtool
+from yax.shared.utilities.taxonomy import Taxonomy
 
 
 class TestTaxIDTool(unittest.TestCase):
@@ -29,6 +33,31 @@ class TestTaxIDTool(unittest.TestCase):
         self.assertEqual(results['5'].parent_taxid, '3')
         self.assertEqual(results['8'].rank, 'species')
 
+    def test_iter_dmp_matches_parse_dmp(self):
+        names_fp = get_data_path('names.dmp')
+        nodes_fp = get_data_path('nodes.dmp')
+        gi_taxid_nucl_fp = get_data_path('gi_taxid_nucl.dmp')
+
+        # A tiny chunk size forces many refills of the line buffer
+        self.assertEqual(
+            dict(taxidtool.iter_names_dmp(names_fp, chunk_size=16)),
+            taxidtool.parse_names_dmp(names_fp))
+        self.assertEqual(
+            list(taxidtool.iter_nodes_dmp(nodes_fp, chunk_size=16)),
+            list(taxidtool.parse_nodes_dmp(nodes_fp).values()))
+
+        pairs = list(taxidtool.iter_gi_taxid_dmp(gi_taxid_nucl_fp,
+                                                 chunk_size=16))
+        self.assertIn(('40', '4'), pairs)
+        self.assertEqual(
+            sum(len(gis) for gis in
+                taxidtool.parse_gi_taxid_dmp(gi_taxid_nucl_fp).values()),
+            len(pairs))
+
+    def test_iter_dmp_is_lazy(self):
+        records = taxidtool.iter_nodes_dmp(get_data_path('nodes.dmp'))
+        self.assertEqual(next(records).taxid, '1')
+
     def test_build_taxid_data(self):
         nodes_fp = get_data_path('nodes.dmp')
         names_fp = get_data_path('names.dmp')
@@ -47,6 +76,22 @@ class TestTaxIDTool(unittest.TestCase):
         self.assertEqual(results['23'].rank, 'species')
         self.assertEqual(set(results['1'].children), set(['3', '2']))
 
+    def test_build_lineages(self):
+        nodes = taxidtool.parse_nodes_dmp(get_data_path('nodes.dmp'))
+        children = {taxid: [] for taxid in nodes}
+        for record in nodes.values():
+            if record.taxid != record.parent_taxid:
+                children[record.parent_taxid].append(record.taxid)
+
+        lineages = taxidtool.build_lineages(nodes, children)
+
+        self.assertEqual(set(lineages), set(nodes))
+        self.assertEqual(lineages['1'], [])
+        self.assertEqual(lineages['23'], ['1', '3', '7'])
+        # Lineages must not share list objects
+        lineages['23'].append('23')
+        self.assertEqual(lineages['19'], ['1', '3', '7'])
+
     def test_write_taxid_data(self):
         nodes_fp = get_data_path('nodes.dmp')
         names_fp = get_data_path('names.dmp')
@@ -78,6 +123,11 @@ class TestTaxIDTool(unittest.TestCase):
         self.assertEqual(results['23'].rank, 'species')
         self.assertEqual(set(results['1'].children), set(['3', '2']))
 
+    def test_decode_id_list(self):
+        for ids in ([], ['1'], ['1', '22', '333']):
+            self.assertEqual(
+                taxidtool.decode_id_list(json.dumps(ids)), ids)
+
     def test_build_gis_to_taxids(self):
         taxid_data_fp = get_data_path('taxid_data.txt')
         taxid_data = taxidtool.parse_taxid_data(taxid_data_fp)
@@ -111,6 +161,95 @@ class TestTaxIDTool(unittest.TestCase):
 
         self.assertEqual(set(results.keys()), {'6', '16', '18', '22'})
 
+    def test_output_sequences_failed_worker(self):
+        taxid_data = taxidtool.parse_taxid_data(
+            get_data_path('taxid_data.txt'))
+        tree = taxidtool.build_tree(taxid_data, None, ['3'], ['20'])
+        filter_sequences = taxidtool._filter_sequences
+
+        def fail_last_part(sequences_input_fp, start, end, selected,
+                           output_fp):
+            filter_sequences(sequences_input_fp, start, end, selected,
+                             output_fp)
+            if start:
+                raise RuntimeError()
+
+        with tempfile.TemporaryDirectory() as output_dir, \
+                mock.patch.object(taxidtool.concurrent.futures,
+                                  'ProcessPoolExecutor',
+                                  taxidtool.concurrent.futures.
+                                  ThreadPoolExecutor), \
+                mock.patch.object(taxidtool, '_filter_sequences',
+                                  fail_last_part):
+            with self.assertRaises(RuntimeError):
+                taxidtool.output_sequences(
+                    taxid_data, tree, taxidtool.build_gis_to_taxids(tree),
+                    get_data_path('sequences.fasta'), output_dir, 'species',
+                    workers=2)
+            self.assertEqual(os.listdir(output_dir), [])
+
+    def test_select_sequences_in_bulk(self):
+        taxid_data = taxidtool.parse_taxid_data(
+            get_data_path('taxid_data.txt'))
+        taxonomy = Taxonomy.from_taxid_data(taxid_data)
+        for level in ('species', None):
+            tree = taxidtool.build_tree(taxid_data, None, ['3'], ['20'])
+            expected = taxidtool._select_sequences(
+                taxid_data, taxidtool.build_gis_to_taxids(tree), level)
+            tree = taxidtool.build_tree(taxonomy, None, ['3'], ['20'])
+            self.assertEqual(taxidtool._select_sequences(
+                taxonomy, taxidtool.build_gis_to_taxids(tree), level),
+                expected)
+
+    def test_output_sequences_parallel(self):
+        taxid_data = taxidtool.parse_taxid_data(
+            get_data_path('taxid_data.txt'))
+        sequences_input_fp = get_data_path('sequences.fasta')
+        tree = taxidtool.build_tree(taxid_data, sequences_input_fp,
+                                    ['3'], ['20'])
+        gis_to_taxids = taxidtool.build_gis_to_taxids(tree)
+
+        outputs = []
+        for workers in (1, 3, 200):
+            with tempfile.TemporaryDirectory() as output_dir:
+                counts = taxidtool.output_sequences(
+                    taxid_data, tree, gis_to_taxids, sequences_input_fp,
+                    output_dir, 'species', workers=workers)
+                taxidtool.output_tree(taxid_data, tree, output_dir, counts)
+                with open(os.path.join(output_dir, "_seqs.fasta")) as fh:
+                    sequences = fh.read()
+                with open(os.path.join(output_dir, ".tree")) as fh:
+                    tree_lines = fh.read()
+                self.assertEqual(sorted(os.listdir(output_dir)),
+                                 [".tree", "_seqs.fasta"])
+            outputs.append((sequences, counts, tree_lines))
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+        sequences, counts, tree_lines = outputs[0]
+        self.assertEqual(sum(counts.values()), sequences.count(">"))
+        self.assertEqual(sum(counts.values()), len(gis_to_taxids))
+        self.assertNotIn('20', counts)
+        self.assertTrue(tree_lines)
+        for line in tree_lines.splitlines():
+            fields = line.split("\t")
+            self.assertEqual(fields[0], '1')
+            self.assertEqual(int(fields[2]), sum(counts.values()))
+
+        # A Taxonomy writes the same tree from its indices, without
+        # building a record per node
+        taxonomy = Taxonomy.from_taxid_data(taxid_data)
+        taxonomy.build_indexes()
+        for inclusion_tree in (taxonomy.subtree(['3'], ['20']), taxonomy):
+            with tempfile.TemporaryDirectory() as output_dir, \
+                    mock.patch.object(Taxonomy, 'record',
+                                      side_effect=AssertionError):
+                taxidtool.output_tree(taxonomy, inclusion_tree, output_dir,
+                                      counts)
+                with open(os.path.join(output_dir, ".tree")) as fh:
+                    self.assertEqual(sorted(fh), sorted(
+                        tree_lines.splitlines(keepends=True)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,416 @@
+import array
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from yax.util import get_data_path
+import yax.shared.utilities.taxidtool as taxidtool
+from yax.shared.utilities import taxonomy as taxonomy_module
+from yax.shared.utilities.taxonomy import Taxonomy
+
+
+class TestTaxonomy(unittest.TestCase):
+    def setUp(self):
+        self.nodes_fp = get_data_path('nodes.dmp')
+        self.names_fp = get_data_path('names.dmp')
+        self.gi_taxid_nucl_fp = get_data_path('gi_taxid_nucl.dmp')
+        self.taxid_data = taxidtool.build_taxid_data(self.nodes_fp,
+                                                     self.names_fp,
+                                                     self.gi_taxid_nucl_fp)
+        self.taxonomy = Taxonomy.from_dmp(self.nodes_fp,
+                                          self.names_fp,
+                                          self.gi_taxid_nucl_fp)
+
+    def assertSameTree(self, taxonomy, taxid_data):
+        self.assertEqual(len(taxonomy), len(taxid_data))
+        self.assertEqual(set(taxonomy), set(taxid_data))
+        for taxid, record in taxid_data.items():
+            self.assertEqual(taxonomy[taxid], record)
+
+    def test_from_dmp(self):
+        self.assertSameTree(self.taxonomy, self.taxid_data)
+
+    def test_from_taxid_data(self):
+        taxid_data = taxidtool.parse_taxid_data(
+            get_data_path('taxid_data.txt'))
+        taxonomy = Taxonomy.from_taxid_data(taxid_data)
+
+        self.assertEqual(taxonomy['23'].parents, ['1', '3', '7'])
+        self.assertEqual(taxonomy['1'].children, ['3', '2'])
+        for taxid, record in taxid_data.items():
+            self.assertEqual(taxonomy[taxid].assoc_gis, record.assoc_gis)
+            self.assertEqual(taxonomy[taxid].parents, record.parents)
+            self.assertEqual(set(taxonomy[taxid].children),
+                             set(record.children))
+
+    def test_lookup(self):
+        self.assertIn('23', self.taxonomy)
+        self.assertIn(23, self.taxonomy)
+        self.assertNotIn('24', self.taxonomy)
+        self.assertNotIn('not a taxid', self.taxonomy)
+        with self.assertRaises(KeyError):
+            self.taxonomy['24']
+
+        index = self.taxonomy.index('6')
+        self.assertEqual(self.taxonomy.name(index), 'Node6')
+        self.assertEqual(self.taxonomy.rank(index), 'genus')
+        self.assertEqual(list(self.taxonomy.assoc_gis(index)), [60, 61])
+        self.assertEqual(
+            [self.taxonomy.taxids[i]
+             for i in self.taxonomy.ancestors(index)], [1, 2])
+
+    def test_can_replace_taxid_data(self):
+        self.assertEqual(taxidtool.build_gis_to_taxids(self.taxonomy),
+                         taxidtool.build_gis_to_taxids(self.taxid_data))
+        self.assertEqual(
+            set(taxidtool.build_tree(self.taxonomy, None, ["6"], ["20"])),
+            {'6', '16', '18', '22'})
+
+    def test_write_load(self):
+        with tempfile.TemporaryDirectory() as dir_:
+            fp = os.path.join(dir_, 'tax_id_data.bin')
+            self.taxonomy.write(fp)
+            loaded = Taxonomy.load(fp)
+
+            self.assertSameTree(loaded, self.taxid_data)
+            self.assertIsInstance(loaded.taxids, memoryview)
+            self.assertEqual(loaded.rank_names, self.taxonomy.rank_names)
+            self.assertFalse(os.path.exists(fp + '.tmp'))
+
+            # A mapped taxonomy can be written back out again
+            fp2 = os.path.join(dir_, 'tax_id_data2.bin')
+            loaded.write(fp2)
+            with open(fp, mode='rb') as fh, open(fp2, mode='rb') as fh2:
+                self.assertEqual(fh.read(), fh2.read())
+
+    def test_load_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            Taxonomy.load(get_data_path('taxid_data.txt'))
+
+        with tempfile.TemporaryDirectory() as dir_:
+            fp = os.path.join(dir_, 'tax_id_data.bin')
+            self.taxonomy.write(fp)
+            with open(fp, mode='r+b') as fh:
+                fh.seek(len(taxonomy_module.FORMAT_MAGIC))
+                fh.write(bytes([taxonomy_module.FORMAT_VERSION + 1]))
+            with self.assertRaises(ValueError):
+                Taxonomy.load(fp)
+
+    def test_lca(self):
+        taxonomy = self.taxonomy
+        for taxid_a in taxonomy:
+            lineage_a = taxonomy[taxid_a].parents + [taxid_a]
+            for taxid_b in taxonomy:
+                lineage_b = taxonomy[taxid_b].parents + [taxid_b]
+                expected = [a for a, b in zip(lineage_a, lineage_b)
+                            if a == b][-1]
+                observed = taxonomy.lca(taxonomy.index(taxid_a),
+                                        taxonomy.index(taxid_b))
+                self.assertEqual(str(taxonomy.taxids[observed]), expected)
+
+        index = taxonomy.index('23')
+        self.assertEqual(taxonomy.depths[index], 3)
+        self.assertEqual(taxonomy.level_ancestor(index, 1),
+                         taxonomy.index('3'))
+        self.assertEqual(taxonomy.level_ancestor(index, 3), index)
+
+    def test_bulk_lca_disconnected(self):
+        record = taxidtool.TaxIDDataRecord
+        taxonomy = Taxonomy.from_taxid_data({
+            '1': record('1', 'Node1', [], ['2'], [], 'no rank'),
+            '2': record('2', 'Node2', [], [], ['1'], 'no rank'),
+            '3': record('3', 'Node3', [], ['4'], [], 'no rank'),
+            '4': record('4', 'Node4', [], [], ['3'], 'no rank')})
+        indices = taxonomy.bulk_index(['2', '4', '1', '2'])
+        for numpy in (taxonomy_module.numpy, None):
+            with mock.patch.object(taxonomy_module, 'numpy', numpy):
+                self.assertEqual(
+                    list(taxonomy.bulk_lca(indices, indices[::-1])),
+                    [indices[0], -1, -1, indices[0]])
+
+    def test_lca_index_is_written(self):
+        self.taxonomy.build_lca_index()
+        with tempfile.TemporaryDirectory() as dir_:
+            fp = os.path.join(dir_, 'tax_id_data.bin')
+            self.taxonomy.write(fp)
+            loaded = Taxonomy.load(fp)
+            self.assertEqual(list(loaded.depths), list(self.taxonomy.depths))
+            self.assertEqual(list(loaded.jumps), list(self.taxonomy.jumps))
+
+    def test_subtree_index(self):
+        taxonomy = self.taxonomy
+        taxonomy.build_subtree_index()
+        self.assertEqual(sorted(taxonomy.preorder), list(range(len(taxonomy))))
+        for taxid in taxonomy:
+            index = taxonomy.index(taxid)
+            branch = taxidtool.build_branch(self.taxid_data, [taxid])
+            self.assertEqual(taxonomy.subtree_sizes[index], len(branch))
+            for other in taxonomy:
+                self.assertEqual(
+                    taxonomy.in_subtree(taxonomy.index(other), index),
+                    other in branch)
+
+    def test_subtree_gi_count(self):
+        taxonomy = self.taxonomy
+        for taxid in taxonomy:
+            branch = taxidtool.build_branch(self.taxid_data, [taxid])
+            self.assertEqual(
+                taxonomy.subtree_gi_count(taxonomy.index(taxid)),
+                sum(len(record.assoc_gis) for record in branch.values()))
+
+    def test_subtree(self):
+        cases = [(['6'], []),
+                 (['6'], ['20']),
+                 (['2', '7'], ['4', '20', '21']),
+                 (['4', '2'], ['8']),
+                 (['1'], ['2', '5', '7'])]
+        for inclusion_roots, exclusion_roots in cases:
+            expected = taxidtool.build_tree(self.taxid_data, None,
+                                            list(inclusion_roots),
+                                            exclusion_roots)
+            observed = self.taxonomy.subtree(inclusion_roots,
+                                             exclusion_roots)
+
+            self.assertEqual(len(observed), len(expected))
+            self.assertEqual(set(observed), set(expected))
+            for taxid in self.taxonomy:
+                self.assertEqual(taxid in observed, taxid in expected)
+            for taxid, record in expected.items():
+                self.assertEqual(observed[taxid], record)
+
+        view = self.taxonomy.subtree(['6'], ['20'])
+        self.assertNotIn('20', view)
+        self.assertNotIn('not a taxid', view)
+        with self.assertRaises(KeyError):
+            view['20']
+        self.assertIsInstance(
+            taxidtool.build_tree(self.taxonomy, None, ['6'], ['20']),
+            type(view))
+
+    def test_gi_index(self):
+        taxonomy = self.taxonomy
+        self.assertEqual(taxonomy.gi_index('230'), taxonomy.index('23'))
+        self.assertEqual(taxonomy.gi_index(81), taxonomy.index('8'))
+        with self.assertRaises(KeyError):
+            taxonomy.gi_index('999')
+        self.assertEqual(list(taxonomy.sorted_gis),
+                         sorted(taxonomy.sorted_gis))
+
+    def test_gi_index_merged_chunks(self):
+        self.taxonomy.build_gi_index()
+        expected = (list(self.taxonomy.sorted_gis),
+                    list(self.taxonomy.sorted_gi_taxa))
+        self.assertEqual(expected[0], sorted(expected[0]))
+        for numpy in (taxonomy_module.numpy, None):
+            with mock.patch.object(taxonomy_module, 'numpy', numpy), \
+                    mock.patch.object(taxonomy_module, 'GI_SORT_CHUNK', 3):
+                self.taxonomy.build_gi_index()
+            self.assertIsInstance(self.taxonomy.sorted_gis, array.array)
+            self.assertEqual((list(self.taxonomy.sorted_gis),
+                              list(self.taxonomy.sorted_gi_taxa)), expected)
+            self.assertEqual(self.taxonomy.gi_index('230'),
+                             self.taxonomy.index('23'))
+
+    def test_gi_index_from_sorted_dmp(self):
+        self.assertIsNone(self.taxonomy.sorted_gis)
+        with open(self.gi_taxid_nucl_fp) as fh:
+            lines = sorted(fh, key=lambda line: int(line.split()[0]))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            gi_taxid_nucl_fp = os.path.join(temp_dir, 'gi_taxid_nucl.dmp')
+            with open(gi_taxid_nucl_fp, mode='w') as fh:
+                fh.writelines(lines)
+            taxonomy = Taxonomy.from_dmp(self.nodes_fp, self.names_fp,
+                                         gi_taxid_nucl_fp)
+
+        # Built while reading the dump, in gi order already
+        self.assertIsNotNone(taxonomy.sorted_gis)
+        self.taxonomy.build_gi_index()
+        self.assertEqual(list(taxonomy.sorted_gis),
+                         list(self.taxonomy.sorted_gis))
+        self.assertEqual(list(taxonomy.sorted_gi_taxa),
+                         list(self.taxonomy.sorted_gi_taxa))
+
+    def test_build_gis_to_taxids(self):
+        lookup = taxidtool.build_gis_to_taxids(self.taxonomy)
+        self.assertEqual(dict(lookup),
+                         taxidtool.build_gis_to_taxids(self.taxid_data))
+        self.assertIsNone(lookup.get('999'))
+
+        tree = self.taxonomy.subtree(['6'], ['20'])
+        lookup = taxidtool.build_gis_to_taxids(tree)
+        expected = taxidtool.build_gis_to_taxids(
+            taxidtool.build_tree(self.taxid_data, None, ['6'], ['20']))
+        self.assertEqual(len(lookup), len(expected))
+        self.assertEqual(dict(lookup), expected)
+        self.assertNotIn('200', lookup)
+        self.assertNotIn('80', lookup)
+        self.assertEqual(lookup['160'], '16')
+
+    def test_subtree_inside_exclusion(self):
+        with self.assertRaises(ValueError):
+            self.taxonomy.subtree(['16'], ['6'])
+
+    def test_indexes_are_written(self):
+        self.taxonomy.build_indexes()
+        with tempfile.TemporaryDirectory() as dir_:
+            fp = os.path.join(dir_, 'tax_id_data.bin')
+            self.taxonomy.write(fp)
+            loaded = Taxonomy.load(fp)
+            for name in ('preorder', 'enter', 'subtree_sizes', 'subtree_gis',
+                         'sorted_gis', 'sorted_gi_taxa'):
+                self.assertEqual(list(getattr(loaded, name)),
+                                 list(getattr(self.taxonomy, name)))
+            self.assertEqual(set(loaded.subtree(['6'], ['20'])),
+                             {'6', '16', '18', '22'})
+            self.assertEqual(set(loaded.rollups), {'species'})
+            self.assertEqual(list(loaded.rollup('species')),
+                             list(self.taxonomy.rollup('species')))
+
+    def test_rollup(self):
+        taxonomy = self.taxonomy
+        for rank in set(taxonomy.rank_names) | {'no such rank'}:
+            for taxid, record in self.taxid_data.items():
+                expected = taxidtool._truncate_taxid(self.taxid_data, taxid,
+                                                     rank)
+                index = taxonomy.rank_ancestor(taxonomy.index(taxid), rank)
+                self.assertEqual(str(taxonomy.taxids[index]), expected)
+
+    def test_bulk_queries(self):
+        self.taxonomy.build_indexes()
+        with tempfile.TemporaryDirectory() as dir_:
+            fp = os.path.join(dir_, 'taxonomy.bin')
+            self.taxonomy.write(fp)
+            loaded = Taxonomy.load(fp)
+            for numpy in (taxonomy_module.numpy, None):
+                with mock.patch.object(taxonomy_module, 'numpy', numpy):
+                    self.check_bulk_queries(self.taxonomy)
+                    self.check_bulk_queries(loaded)
+
+    def check_bulk_queries(self, taxonomy):
+        taxids = sorted(self.taxid_data, key=int, reverse=True)
+        indices = taxonomy.bulk_index(taxids)
+        self.assertEqual(list(indices), [taxonomy.index(t) for t in taxids])
+        self.assertEqual([str(t) for t in taxonomy.bulk_taxid(indices)],
+                         taxids)
+        self.assertEqual(taxonomy.bulk_name(indices),
+                         ["Node%s" % taxid for taxid in taxids])
+        self.assertEqual(list(taxonomy.bulk_depth(indices)),
+                         [len(self.taxid_data[t].parents) for t in taxids])
+        self.assertEqual(
+            list(taxonomy.bulk_rank_ancestor(indices, 'species')),
+            [taxonomy.rank_ancestor(index, 'species') for index in indices])
+        reversed_indices = indices[::-1]
+        self.assertEqual(
+            list(taxonomy.bulk_lca(indices, reversed_indices)),
+            [taxonomy.lca(a, b) for a, b in zip(indices, reversed_indices)])
+        with self.assertRaises(ValueError):
+            taxonomy.bulk_lca(indices, indices[1:])
+        with self.assertRaises(KeyError):
+            taxonomy.bulk_index(['1', '99999'])
+
+        self.assertEqual(list(taxonomy.bulk_gi_index(['40', '41', 'x', 60])),
+                         [taxonomy.index('4'), -1, -1, taxonomy.index('6')])
+
+        repeated = taxids * 3 + [int(taxid) for taxid in taxids]
+        indices = taxonomy.bulk_index(repeated)
+        self.assertEqual(list(indices), [taxonomy.index(t) for t in repeated])
+        self.assertEqual(taxonomy.bulk_name(indices),
+                         [taxonomy.name(index) for index in indices])
+        self.assertEqual(
+            list(taxonomy.bulk_lca(indices, indices[::-1])),
+            [taxonomy.lca(a, b) for a, b in zip(indices, indices[::-1])])
+        self.assertEqual(
+            list(taxonomy.bulk_gi_index(['60', 40, '40', 'x', '60', 999])),
+            [taxonomy.index('6'), taxonomy.index('4'), taxonomy.index('4'),
+             -1, taxonomy.index('6'), -1])
+
+        every_pair = [(a, b) for a in range(len(taxonomy))
+                      for b in range(len(taxonomy))]
+        self.assertEqual(
+            list(taxonomy.bulk_lca([a for a, _ in every_pair],
+                                   [b for _, b in every_pair])),
+            [taxonomy.lca(a, b) for a, b in every_pair])
+        self.assertEqual(list(taxonomy.bulk_parent(indices)),
+                         [taxonomy.parents[index] for index in indices])
+
+    def test_from_tsv(self):
+        taxid_data_fp = get_data_path('taxid_data.txt')
+        expected = Taxonomy.from_taxid_data(
+            taxidtool.parse_taxid_data(taxid_data_fp))
+
+        chunk_size = taxonomy_module.TSV_CHUNK_SIZE
+        try:
+            # Small chunks so the file is decoded by several processes
+            taxonomy_module.TSV_CHUNK_SIZE = 64
+            for workers in (1, 4):
+                taxonomy = Taxonomy.from_tsv(taxid_data_fp, workers=workers)
+                self.assertEqual(dict(taxonomy), dict(expected))
+                self.assertEqual(list(taxonomy.gis), list(expected.gis))
+        finally:
+            taxonomy_module.TSV_CHUNK_SIZE = chunk_size
+
+    def test_update(self):
+        NodeRecord = taxidtool.NodeRecord
+        diff = dict(
+            deleted=list(taxidtool.iter_delnodes_dmp(
+                get_data_path('delnodes.dmp'))),
+            merged=list(taxidtool.iter_merged_dmp(
+                get_data_path('merged.dmp'))),
+            nodes=[NodeRecord('24', '7', 'species'),
+                   NodeRecord('22', '4', 'species')],
+            names=[('24', 'Node24'), ('9', 'Renamed9')],
+            gis=[('2400', '24'), ('40', '6'), ('2100', '21'), ('999', '0')])
+        self.assertEqual(diff['deleted'], ['23'])
+        self.assertEqual(diff['merged'], [('21', '19')])
+        updated = self.taxonomy.update(**diff)
+
+        expected = {taxid: record for taxid, record in self.taxid_data.items()
+                    if taxid not in ('21', '23')}
+        expected['24'] = taxidtool.TaxIDDataRecord(
+            '24', 'Node24', ['2400'], [], ['1', '3', '7'], 'species')
+        expected['22'] = expected['22']._replace(parents=['1', '2', '4'])
+        expected['9'] = expected['9']._replace(sci_name='Renamed9')
+        expected['4'] = expected['4']._replace(assoc_gis=[])
+        expected['6'] = expected['6']._replace(
+            assoc_gis=expected['6'].assoc_gis + ['40'])
+        expected['19'] = expected['19']._replace(
+            assoc_gis=expected['19'].assoc_gis +
+            self.taxid_data['21'].assoc_gis + ['2100'])
+
+        self.assertEqual(set(updated), set(expected))
+        for taxid, record in expected.items():
+            observed = updated[taxid]
+            self.assertEqual(observed.sci_name, record.sci_name)
+            self.assertEqual(observed.parents, record.parents)
+            self.assertEqual(observed.rank, record.rank)
+            self.assertEqual(observed.assoc_gis, record.assoc_gis)
+        self.assertEqual(set(updated['7'].children), {'17', '19', '24'})
+        self.assertEqual(set(updated['4'].children),
+                         {'8', '10', '12', '14', '22'})
+
+        # A memory mapped taxonomy is updated the same way
+        self.taxonomy.build_indexes()
+        with tempfile.TemporaryDirectory() as dir_:
+            fp = os.path.join(dir_, 'tax_id_data.bin')
+            self.taxonomy.write(fp)
+            loaded_update = Taxonomy.load(fp).update(**diff)
+            self.assertEqual(dict(loaded_update), dict(updated))
+
+    def test_update_deleted_parent(self):
+        with self.assertRaises(ValueError):
+            self.taxonomy.update(deleted=['7'])
+        with self.assertRaises(ValueError):
+            self.taxonomy.update(nodes=[taxidtool.NodeRecord('24', '7',
+                                                             'species')])
+
+    def test_unknown_taxid(self):
+        taxid_data = taxidtool.parse_taxid_data(
+            get_data_path('taxid_data.txt'))
+        del taxid_data['3']
+        with self.assertRaises(ValueError):
+            Taxonomy.from_taxid_data(taxid_data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -53,7 +53,8 @@ class ExeNode:
                  output,
                  details,
                  input_artifacts,
-                 input_params):
+                 input_params,
+                 cache_dir=None):
         """
         """
         input_ = {
@@ -61,6 +62,10 @@ class ExeNode:
             'working_dir': working_dir,
             'details': details
         }
+        # Only modules which can reuse data between runs ask for the cache
+        if cache_dir is not None and \
+                'cache_dir' in inspect.signature(self.module).parameters:
+            input_['cache_dir'] = cache_dir
 
         input_.update(input_artifacts)
         input_.update(input_params)
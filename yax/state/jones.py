@@ -29,6 +29,11 @@ class Indiana:
         """Directory where working directories will be stored."""
         return os.path.join(self.data_dir, 'working')
 
+    @property
+    def cache_dir(self):
+        """Directory where data reused between runs will be cached."""
+        return os.path.join(self.data_dir, 'cache')
+
     @property
     def arch_path(self):
         """Filepath to where the architectural configuration will be stored."""
@@ -88,6 +93,7 @@ class Indiana:
             os.mkdir(self.data_dir)
             os.mkdir(self.artifacts_dir)
             os.mkdir(self.working_dir)
+            os.mkdir(self.cache_dir)
             shutil.copyfile(pipeline, self.arch_path)
         except Exception:
             shutil.rmtree(self.data_dir)
@@ -166,7 +172,8 @@ class Indiana:
         input_params = self.map.get_arguments_for_node(node, run_id)
 
         with tempfile.TemporaryDirectory(dir=self.working_dir) as working_dir:
-            node(working_dir, outputs, details, input_artifacts, input_params)
+            node(working_dir, outputs, details, input_artifacts, input_params,
+                 cache_dir=self.cache_dir)
 
     def reconstruct_config(self, run_key):
         config = configparser.ConfigParser()
@@ -21,6 +21,32 @@ def in2out1(w, o, x: Artifact, y: Artifact) -> Artifact:
     pass
 
 
+class TestCall(unittest.TestCase):
+    class Output:
+        def complete(self):
+            pass
+
+    def test_cache_dir_only_passed_when_accepted(self):
+        calls = []
+
+        def with_cache(working_dir, output, details, cache_dir=None) \
+                -> Artifact:
+            calls.append(cache_dir)
+            return output
+
+        def without_cache(working_dir, output, details) -> Artifact:
+            calls.append('called')
+            return output
+
+        for module in (with_cache, without_cache):
+            node = ExeNode('foo', module, output='a')
+            node('working', self.Output(), {}, {}, {}, cache_dir='cache')
+        ExeNode('foo', with_cache, output='a')(
+            'working', self.Output(), {}, {}, {})
+
+        self.assertEqual(calls, ['cache', 'called', None])
+
+
 class TestAdjacencyMatrix(unittest.TestCase):
     def test_empty(self):
         graph = ExeGraph()